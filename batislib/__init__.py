@@ -15,6 +15,16 @@ subcommands = [
          'List installed applications'),
     ('uninstall', '.uninstall:main',
          'Remove an installed application'),
+    ('owns', '.registry:owns_main',
+         'Find which application installed a file'),
+    ('rollback', '.snapshots:main',
+         'Go back to an earlier version of an application'),
+    ('verify-installed', '.integrity:main',
+         'Check installed applications for changed files'),
+    ('cache', '.cache:main',
+         'List or prune cached downloads'),
+    ('run-triggers', '.triggers:main',
+         'Update desktop caches after deferred installs'),
     # Developer focussed
     ('verify', '.verify:main',
          'Check an application directory or tarball for problems'),
@@ -44,7 +54,7 @@ def main(argv=None):
         print('Batis - install and distribute desktop applications')
         print('Subcommands:')
         for name, ep, descr in subcommands:
-            print('  {:<12} - {}'.format(name, descr))
+            print('  {:<16} - {}'.format(name, descr))
         return 0
     
     for name, ep, descr in subcommands:
@@ -0,0 +1,246 @@
+"""Caches of downloaded builds and index files"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from .install import ensure_dir_exists
+from .log import enable_colourful_output
+from .util import compress_user, format_size, parse_size
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+
+# Interrupted downloads are kept this long (in seconds) to be resumed
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+
+def default_cache_dir():
+    """The cache location: $BATIS_CACHE_DIR, or batis in the XDG cache dir.
+
+    Point BATIS_CACHE_DIR at a shared directory to share downloads between
+    users. Entries are checked against the hash from the index each time
+    they're used, before they're unpacked, so users can't tamper with each
+    other's installs this way.
+    """
+    if os.environ.get('BATIS_CACHE_DIR'):
+        return os.environ['BATIS_CACHE_DIR']
+    XDG_CACHE_HOME = os.environ.get('XDG_CACHE_HOME') or '~/.cache'
+    return os.path.expanduser(pjoin(XDG_CACHE_HOME, 'batis'))
+
+def default_max_size():
+    """The size limit from $BATIS_CACHE_SIZE (e.g. '5G'), or 2 GiB"""
+    if os.environ.get('BATIS_CACHE_SIZE'):
+        return parse_size(os.environ['BATIS_CACHE_SIZE'])
+    return DEFAULT_MAX_SIZE
+
+class DownloadCache(object):
+    """Downloaded tarballs, stored by SHA-512 hash.
+
+    Each entry's modification time records when it was last used, and the
+    least recently used entries are removed to keep the cache under
+    max_size bytes. A max_size of 0 disables the cache.
+    """
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = default_cache_dir()
+        if max_size is None:
+            max_size = default_max_size()
+        self.directory = pjoin(directory, 'downloads')
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _path(self, sha512):
+        return pjoin(self.directory, sha512.lower())
+
+    def get(self, sha512):
+        """Get the path of a cached download, or None if it's not cached"""
+        path = self._path(sha512)
+        try:
+            # Mark it as recently used
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def remove(self, sha512):
+        try:
+            os.unlink(self._path(sha512))
+        except OSError:
+            pass
+
+    def new_entry(self, sha512=None):
+        """Open a file in the cache to write a download into.
+
+        If sha512 is given, the partial download is kept if this process
+        fails, and this will open it for appending the next time, so it may
+        already contain data. Pass the file to :meth:`commit` once the
+        download is verified, or to :meth:`discard` if it's corrupted.
+        """
+        ensure_dir_exists(self.directory)
+        if sha512 is not None:
+            f = open(pjoin(self.directory, '.partial-' + sha512.lower()), 'ab')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # Another process is downloading the same build
+                f.close()
+            else:
+                return f
+        return tempfile.NamedTemporaryFile(dir=self.directory,
+                                           prefix='.partial-', delete=False)
+
+    def commit(self, f, sha512):
+        f.close()
+        os.rename(f.name, self._path(sha512))
+        self.prune()
+
+    def discard(self, f):
+        f.close()
+        os.unlink(f.name)
+
+    def entries(self):
+        """List (sha512, size, last used) for cached downloads, oldest first"""
+        res = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return res
+        for name in names:
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(pjoin(self.directory, name))
+            except OSError:
+                continue  # Removed by another process
+            res.append((name, st.st_size, st.st_mtime))
+        res.sort(key=lambda e: e[2])
+        return res
+
+    def prune(self, max_size=None):
+        """Remove the least recently used downloads until under max_size.
+
+        Returns a list of the removed hashes.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        self._remove_stale_partials()
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        removed = []
+        for sha512, size, _ in entries:
+            if total <= max_size:
+                break
+            self.remove(sha512)
+            removed.append(sha512)
+            total -= size
+        return removed
+
+    def _remove_stale_partials(self):
+        cutoff = time.time() - PARTIAL_MAX_AGE
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = pjoin(self.directory, name)
+            try:
+                if name.startswith('.partial-') \
+                        and os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+class IndexCache(object):
+    """Index files, with the validators to make conditional requests for them.
+
+    Each entry stores the parsed index along with the ETag and Last-Modified
+    headers it was served with, so we can ask the server to send it only if
+    it has changed.
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = pjoin(directory, 'indexes')
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return pjoin(self.directory, key + '.json')
+
+    def get(self, url):
+        """Get a dict with 'index', 'etag' and 'last_modified', or None"""
+        try:
+            with open(self._path(url)) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def store(self, url, index, etag=None, last_modified=None):
+        ensure_dir_exists(self.directory)
+        entry = {'url': url, 'index': index, 'etag': etag,
+                 'last_modified': last_modified}
+        with tempfile.NamedTemporaryFile('w', dir=self.directory,
+                                         prefix='.partial-',
+                                         delete=False) as f:
+            json.dump(entry, f)
+        os.rename(f.name, self._path(url))
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def list_main(cache, args):
+    entries = cache.entries()
+    for sha512, size, last_used in reversed(entries):
+        print('{}  {:>10}  {}'.format(sha512[:16], format_size(size),
+              time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))))
+    print('{} downloads, {} in {} (limit {})'.format(len(entries),
+            format_size(sum(e[1] for e in entries)),
+            compress_user(cache.directory), format_size(cache.max_size)))
+
+def prune_main(cache, args):
+    if args.all:
+        max_size = 0
+        IndexCache().clear()
+        try:
+            os.unlink(pjoin(default_cache_dir(), 'mirrors.json'))
+        except OSError:
+            pass
+    elif args.max_size is not None:
+        max_size = parse_size(args.max_size)
+    else:
+        max_size = cache.max_size
+    removed = cache.prune(max_size)
+    log.info('Removed %d cached downloads', len(removed))
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='batis cache')
+    subparsers = ap.add_subparsers(dest='command')
+    subparsers.required = True
+    list_ap = subparsers.add_parser('list', help='List cached downloads')
+    list_ap.set_defaults(func=list_main)
+    prune_ap = subparsers.add_parser('prune',
+            help='Remove the least recently used downloads')
+    prune_ap.add_argument('--max-size',
+            help='Shrink the cache to this size, e.g. 500M '
+                 '(default: $BATIS_CACHE_SIZE, or 2G)')
+    prune_ap.add_argument('--all', action='store_true',
+            help='Remove all cached downloads, index files and mirror '
+                 'rankings')
+    prune_ap.set_defaults(func=prune_main)
+    args = ap.parse_args(argv)
+
+    enable_colourful_output(level=logging.INFO)
+    args.func(DownloadCache(), args)
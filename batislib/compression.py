@@ -0,0 +1,236 @@
+"""Compression support for application tarballs"""
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import struct
+import tarfile
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    # Python 2, or Python built without liblzma
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# name: (tarball file extension, magic bytes at the start of the file)
+codecs = OrderedDict([
+    ('gz', ('.app.tar.gz', b'\x1f\x8b')),
+    ('xz', ('.app.tar.xz', b'\xfd7zXZ\x00')),
+    ('zst', ('.app.tar.zst', b'\x28\xb5\x2f\xfd')),
+    ('bz2', ('.app.tar.bz2', b'BZh')),
+    ('none', ('.app.tar', None)),
+])
+
+# bz2 is only recognised for reading; there's no reason to create it.
+PACK_CODECS = ('gz', 'xz', 'zst', 'none')
+
+MAGIC_LEN = max(len(m) for (_, m) in codecs.values() if m)
+
+# Decompression speed barely depends on the level; higher levels pack slowly.
+ZSTD_LEVEL = 10
+
+# Uncompressed data is split into blocks of this size to compress in parallel
+PARALLEL_BLOCKSIZE = 1024 * 1024
+
+# Deflate can refer back up to 32 KiB, so each block is primed with this much
+# of the data before it.
+DICT_SIZE = 32 * 1024
+
+def resolve_jobs(jobs):
+    """Turn a --jobs option into a number of threads: 0 means one per CPU"""
+    if not jobs:
+        return cpu_count()
+    return jobs
+
+def codec_available(name):
+    if name == 'xz':
+        return lzma is not None
+    elif name == 'zst':
+        return zstandard is not None
+    return name in codecs
+
+def available_codecs():
+    """The codecs which can be used to pack tarballs here"""
+    return [c for c in PACK_CODECS if codec_available(c)]
+
+def tarball_extension(codec):
+    return codecs[codec][0]
+
+def detect_codec(header):
+    """Identify the compression from the first bytes of a file.
+
+    Returns 'none' if no known compression format is found.
+    """
+    for name, (_, magic) in codecs.items():
+        if magic and header.startswith(magic):
+            return name
+    return 'none'
+
+def detect_file_codec(path):
+    with open(path, 'rb') as f:
+        return detect_codec(f.read(MAGIC_LEN))
+
+def is_tarball(path):
+    """Check if path looks like a tarball, with any compression we know"""
+    if detect_file_codec(path) == 'none':
+        return tarfile.is_tarfile(path)
+    return True
+
+class _PrefixedReader(object):
+    """Give back bytes already read from a stream before reading more of it"""
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.fileobj.read()
+        else:
+            data = self.prefix[:size]
+            if len(data) < size:
+                data += self.fileobj.read(size - len(data))
+        self.prefix = self.prefix[len(data):]
+        return data
+
+def open_tar_stream(fileobj, bufsize=tarfile.RECORDSIZE):
+    """Open a tarball for reading in stream mode (``r|``).
+
+    The compression format is detected from the first bytes, so fileobj
+    doesn't need to be seekable.
+    """
+    header = b''
+    while len(header) < MAGIC_LEN:
+        chunk = fileobj.read(MAGIC_LEN - len(header))
+        if not chunk:
+            break
+        header += chunk
+    stream = _PrefixedReader(header, fileobj)
+
+    codec = detect_codec(header)
+    if codec == 'zst':
+        if zstandard is None:
+            raise ValueError("This tarball is compressed with zstd: "
+                             "install the 'zstandard' module to unpack it")
+        stream = zstandard.ZstdDecompressor().stream_reader(
+                        stream, read_across_frames=True, closefd=False)
+        mode = 'r|'
+    elif codec == 'none':
+        mode = 'r|'
+    else:
+        mode = 'r|' + codec
+    return tarfile.open(fileobj=stream, mode=mode, bufsize=bufsize)
+
+@contextmanager
+def tar_writer(path, codec='gz', jobs=1):
+    """Context manager giving a TarFile which writes a compressed tarball.
+
+    jobs is the number of threads to use where the codec supports it.
+    """
+    if not codec_available(codec):
+        raise ValueError("Compression format %r is not available" % codec)
+
+    with open(path, 'wb') as raw:
+        stream = None
+        if codec == 'gz' and jobs > 1:
+            stream = ParallelGzipWriter(raw, jobs)
+            tf = tarfile.open(fileobj=stream, mode='w|')
+        elif codec == 'zst':
+            cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL,
+                                            threads=(jobs if jobs > 1 else 0))
+            stream = cctx.stream_writer(raw, closefd=False)
+            tf = tarfile.open(fileobj=stream, mode='w|')
+        elif codec == 'none':
+            tf = tarfile.open(fileobj=raw, mode='w')
+        else:
+            tf = tarfile.open(fileobj=raw, mode='w:' + codec)
+
+        yield tf
+
+        tf.close()
+        if stream is not None:
+            stream.close()
+
+def _deflate_block(data, zdict, level, last):
+    if zdict:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS,
+                             zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # A sync flush ends the output on a byte boundary without marking the
+    # final block, so the compressed blocks can simply be concatenated.
+    return c.compress(data) + c.flush(zlib.Z_FINISH if last
+                                      else zlib.Z_SYNC_FLUSH)
+
+class ParallelGzipWriter(object):
+    """Write a gzip stream, compressing blocks of data in a thread pool.
+
+    This works like pigz: each block is deflated independently, using the end
+    of the previous block as a preset dictionary, and the results are joined
+    into one ordinary gzip member. zlib releases the GIL while it compresses,
+    so the threads can use several cores.
+
+    The output is written to fileobj, which is not closed by :meth:`close`.
+    """
+    def __init__(self, fileobj, jobs, level=9, blocksize=PARALLEL_BLOCKSIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.blocksize = blocksize
+        self.pool = ThreadPool(jobs)
+        self.max_pending = jobs * 2
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.zdict = b''
+        self.crc = 0
+        self.size = 0
+        self._write_header()
+
+    def _write_header(self):
+        if self.level == 9:
+            xfl = 2
+        elif self.level == 1:
+            xfl = 4
+        else:
+            xfl = 0
+        # Magic, deflate, no flags, mtime, extra flags, OS = Unix
+        self.fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0,
+                                       int(time.time()), xfl, 3))
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.size += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.blocksize:
+            self._submit(b''.join(self.buffer), last=False)
+            self.buffer = []
+            self.buffered = 0
+
+    def _submit(self, block, last):
+        self.pending.append(self.pool.apply_async(_deflate_block,
+                                (block, self.zdict, self.level, last)))
+        self.zdict = block[-DICT_SIZE:]
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.pool is None:
+            return
+        self._submit(b''.join(self.buffer), last=True)
+        self.buffer = []
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        self.fileobj.write(struct.pack('<II', self.crc,
+                                       self.size & 0xffffffff))
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
@@ -0,0 +1,286 @@
+"""Upgrade installed applications by downloading only the files which changed
+
+``batis pack --delta`` writes an uncompressed tarball as well as the normal
+one, and a JSON file listing its members, with each file's hash and the
+offset of its data in the tarball. An index can point to these in a build's
+``delta`` field. When the application is already installed, files which
+match the hashes recorded in the installed copy are copied from it, and the
+rest are fetched from the uncompressed tarball with HTTP range requests.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tarfile
+import time
+
+import requests
+
+from .install import ApplicationInstaller, ensure_dir_exists, make_staging_dir
+from .tarball import _check_member, load_file_hashes
+from .urlinstall import (CHUNK_SIZE, DEFAULT_CONNECTIONS, DOWNLOAD_RETRIES,
+                         RETRY_BACKOFF, SEGMENT_SIZE, TIMEOUT, ChunkStream,
+                         CorruptedDownload, _is_transient, _iter_raw,
+                         _user_agent)
+from .util import format_size
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+DELTA_FORMAT_VERSION = [1, 0]
+
+# Changed files closer together than this in the tarball are fetched with
+# one request, up to SEGMENT_SIZE bytes at a time.
+MERGE_GAP = 64 * 1024
+
+def delta_manifest_path(payload):
+    """Where to write the member list for an uncompressed tarball"""
+    if payload.endswith('.tar'):
+        payload = payload[:-len('.tar')]
+    return payload + '.files.json'
+
+def write_delta_manifest(payload):
+    """List the members of an uncompressed tarball for delta upgrades.
+
+    Returns the path of the JSON file written next to it.
+    """
+    members = []
+    with tarfile.open(payload, 'r:') as tf:
+        for tarinfo in tf:
+            m = {'name': tarinfo.name, 'mode': tarinfo.mode,
+                 'mtime': tarinfo.mtime}
+            if tarinfo.isdir():
+                m['type'] = 'dir'
+            elif tarinfo.issym():
+                m.update(type='symlink', linkname=tarinfo.linkname)
+            elif tarinfo.islnk():
+                m.update(type='link', linkname=tarinfo.linkname)
+            elif tarinfo.isfile():
+                h = hashlib.sha256()
+                f = tf.extractfile(tarinfo)
+                for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+                    h.update(chunk)
+                m.update(type='file', size=tarinfo.size,
+                         offset=tarinfo.offset_data, sha256=h.hexdigest())
+            else:
+                continue
+            members.append(m)
+
+    manifest = {'format_version': DELTA_FORMAT_VERSION,
+                'name': members[0]['name'].split('/')[0],
+                'members': members}
+    path = delta_manifest_path(payload)
+    with open(path, 'w') as f:
+        json.dump(manifest, f)
+    return path
+
+def fetch_delta_manifest(delta, session=None):
+    if ('manifest_sha512' not in delta) \
+            and not delta['manifest_url'].startswith('https:'):
+        raise KeyError("'manifest_sha512' field is required for HTTP downloads")
+    if session is None:
+        session = requests
+    r = session.get(delta['manifest_url'], timeout=TIMEOUT,
+                    headers={'user-agent': _user_agent()})
+    r.raise_for_status()
+    if 'manifest_sha512' in delta \
+            and hashlib.sha512(r.content).hexdigest() != delta['manifest_sha512']:
+        raise CorruptedDownload()
+    manifest = json.loads(r.content.decode('utf-8'))
+    if manifest['format_version'][0] > DELTA_FORMAT_VERSION[0]:
+        raise ValueError('Unknown delta format version %s'
+                         % manifest['format_version'])
+    return manifest
+
+def _fetch_range(url, start, end, session, retries=DOWNLOAD_RETRIES):
+    """Yield bytes start to end-1 of url, resuming if the connection fails"""
+    headers = {'user-agent': _user_agent(), 'accept-encoding': 'identity'}
+    pos = start
+    failures = 0
+    while pos < end:
+        headers['range'] = 'bytes=%d-%d' % (pos, end - 1)
+        try:
+            with session.get(url, headers=headers, stream=True,
+                             timeout=TIMEOUT) as r:
+                r.raise_for_status()
+                m = re.match(r'bytes (\d+)-',
+                             r.headers.get('content-range', ''))
+                if r.status_code != 206 or not m or int(m.group(1)) != pos:
+                    raise ValueError("%s doesn't support range requests"
+                                     % url)
+                for chunk in _iter_raw(r):
+                    chunk = chunk[:end - pos]
+                    pos += len(chunk)
+                    failures = 0
+                    yield chunk
+                    if pos >= end:
+                        break
+            if pos < end:
+                raise requests.ConnectionError(
+                    'Connection closed after %d of %d bytes'
+                    % (pos - start, end - start))
+        except Exception as e:
+            failures += 1
+            if failures > retries or not _is_transient(e):
+                raise
+            time.sleep(RETRY_BACKOFF * 2 ** (failures - 1))
+
+def _group_ranges(members):
+    """Group files to download into ranges of nearby data"""
+    groups = []
+    for m in sorted(members, key=lambda m: m['offset']):
+        if groups:
+            first, last = groups[-1][0], groups[-1][-1]
+            gap = m['offset'] - (last['offset'] + last['size'])
+            if gap <= MERGE_GAP \
+                    and (m['offset'] + m['size'] - first['offset']
+                         <= SEGMENT_SIZE):
+                groups[-1].append(m)
+                continue
+        groups.append([m])
+    return groups
+
+def _set_attrs(path, m):
+    os.chmod(path, m['mode'])
+    os.utime(path, (m['mtime'], m['mtime']))
+
+def _create(path):
+    """Open a new file for writing, refusing to replace anything at path.
+
+    In particular, this won't write through a symlink to somewhere else.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    return os.fdopen(fd, 'wb')
+
+def _fetch_group(url, staging_dir, session, group):
+    start = group[0]['offset']
+    end = group[-1]['offset'] + group[-1]['size']
+    stream = ChunkStream(_fetch_range(url, start, end, session))
+    pos = start
+    for m in group:
+        stream.read(m['offset'] - pos)
+        path = pjoin(staging_dir, m['name'])
+        h = hashlib.sha256()
+        remaining = m['size']
+        with _create(path) as f:
+            while remaining:
+                data = stream.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise requests.ConnectionError('Download ended early')
+                h.update(data)
+                f.write(data)
+                remaining -= len(data)
+        if h.hexdigest() != m['sha256']:
+            raise CorruptedDownload()
+        _set_attrs(path, m)
+        pos = m['offset'] + m['size']
+
+def _copy_verified(src, dst, sha256):
+    """Copy an unchanged file from the installed application.
+
+    Returns False if it has been modified since it was installed.
+    """
+    try:
+        fsrc = open(src, 'rb')
+    except (IOError, OSError):
+        return False
+    h = hashlib.sha256()
+    with fsrc, _create(dst) as fdst:
+        for chunk in iter(partial(fsrc.read, CHUNK_SIZE), b''):
+            h.update(chunk)
+            fdst.write(chunk)
+    if h.hexdigest() != sha256:
+        os.unlink(dst)
+        return False
+    return True
+
+def _member_tarinfo(m):
+    tarinfo = tarfile.TarInfo(m['name'])
+    tarinfo.type = {'dir': tarfile.DIRTYPE, 'file': tarfile.REGTYPE,
+                    'symlink': tarfile.SYMTYPE, 'link': tarfile.LNKTYPE
+                   }[m['type']]
+    tarinfo.linkname = m.get('linkname', '')
+    return tarinfo
+
+def fetch_delta(build, scheme, session=None,
+                connections=DEFAULT_CONNECTIONS):
+    """Prepare the new version of an installed application from the old one.
+
+    build['delta'] has the 'url' of the uncompressed tarball, and the
+    'manifest_url' (and 'manifest_sha512') of its member list. Each file is
+    checked against its hash. Returns an :class:`ApplicationInstaller` for
+    the staged application, or None if the application isn't installed with
+    file hashes to compare against.
+    """
+    delta = build['delta']
+    if session is None:
+        session = requests
+    manifest = fetch_delta_manifest(delta, session)
+    name = manifest['name']
+    installed = pjoin(scheme['application'], name)
+    old = load_file_hashes(installed)
+    if old is None:
+        return None
+
+    by_hash = {}
+    for path, info in old['files'].items():
+        by_hash.setdefault(info['sha256'], pjoin(installed, path))
+
+    staging_dir = make_staging_dir(scheme)
+    try:
+        symlinks, seen = set(), set()
+        dirs, hardlinks, to_fetch = [], [], []
+        reused = 0
+        for m in manifest['members']:
+            m = dict(m, name=_check_member(_member_tarinfo(m), symlinks))
+            if m['name'].split('/')[0] != name:
+                raise ValueError("Delta member outside application "
+                                 "directory: %r" % m['name'])
+            # Files are fetched after the loop, so a later member mustn't
+            # put something else at the same path first.
+            if m['name'] in seen:
+                raise ValueError("Duplicate delta member: %r" % m['name'])
+            seen.add(m['name'])
+            path = pjoin(staging_dir, m['name'])
+            if m['type'] == 'dir':
+                ensure_dir_exists(path)
+                dirs.append(m)
+                continue
+
+            ensure_dir_exists(os.path.dirname(path))
+            if m['type'] == 'symlink':
+                os.symlink(m['linkname'], path)
+                symlinks.add(m['name'])
+            elif m['type'] == 'link':
+                hardlinks.append(m)
+            elif m['sha256'] in by_hash \
+                    and _copy_verified(by_hash[m['sha256']], path,
+                                       m['sha256']):
+                _set_attrs(path, m)
+                reused += m['size']
+            else:
+                to_fetch.append(m)
+
+        log.info('Downloading %d changed files (%s); reusing %s',
+                 len(to_fetch), format_size(sum(m['size'] for m in to_fetch)),
+                 format_size(reused))
+        with ThreadPoolExecutor(max_workers=max(connections, 1)) as executor:
+            list(executor.map(partial(_fetch_group, delta['url'], staging_dir,
+                                      session), _group_ranges(to_fetch)))
+
+        for m in hardlinks:
+            os.link(pjoin(staging_dir, m['linkname']),
+                    pjoin(staging_dir, m['name']))
+        for m in reversed(dirs):
+            _set_attrs(pjoin(staging_dir, m['name']), m)
+    except:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    return ApplicationInstaller(pjoin(staging_dir, name), scheme,
+                                staging_dir=staging_dir)
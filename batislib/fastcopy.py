@@ -0,0 +1,133 @@
+"""Copy files using the fastest method the system supports
+
+In order, we try:
+
+1. Sharing the data with a reflink (the FICLONE ioctl), on copy-on-write
+   filesystems like btrfs and XFS. This is almost instant.
+2. os.copy_file_range() or os.sendfile(), so the kernel copies the data
+   without passing it through Python.
+3. Reading and writing the data in Python.
+
+With hardlink=True, files are hard linked instead if possible. The copy then
+shares everything with the original, so this is only safe if neither will be
+modified.
+"""
+import errno
+import fcntl
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+
+pjoin = os.path.join
+
+# ioctl to make a file share another file's data (from linux/fs.h)
+FICLONE = 0x40049409
+
+COPY_CHUNK = 1024 * 1024
+
+# Errors which mean a method doesn't work for these files, so we should try
+# the next one.
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                errno.ENOSYS, errno.EBADF}
+
+_NO_HARDLINK = {errno.EXDEV, errno.EPERM, errno.EMLINK}
+
+def _clone(fsrc, fdst):
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (IOError, OSError) as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+def _copy_with(syscall, fsrc, fdst):
+    copied = 0
+    while True:
+        try:
+            n = syscall(fsrc.fileno(), fdst.fileno())
+        except OSError as e:
+            if copied == 0 and e.errno in _UNSUPPORTED:
+                return False
+            raise
+        if n == 0:
+            return True
+        copied += n
+
+def _copy_file_range(fsrc, fdst):
+    if not hasattr(os, 'copy_file_range'):  # Python < 3.8
+        return False
+    return _copy_with(lambda i, o: os.copy_file_range(i, o, COPY_CHUNK),
+                      fsrc, fdst)
+
+def _sendfile(fsrc, fdst):
+    if not hasattr(os, 'sendfile'):  # Python 2
+        return False
+    return _copy_with(lambda i, o: os.sendfile(o, i, None, COPY_CHUNK),
+                      fsrc, fdst)
+
+def copyfile(src, dst, hardlink=False):
+    """Copy the contents of the file src to a new file dst.
+
+    Returns True if dst was made as a hard link to src.
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            if e.errno not in _NO_HARDLINK:
+                raise
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for method in (_clone, _copy_file_range, _sendfile):
+            if method(fsrc, fdst):
+                return False
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK)
+    return False
+
+def copy(src, dst, hardlink=False):
+    """Copy a file and its permissions, like shutil.copy()"""
+    if not copyfile(src, dst, hardlink):
+        shutil.copymode(src, dst)
+
+def copy2(src, dst, hardlink=False):
+    """Copy a file with its permissions and times, like shutil.copy2()"""
+    if not copyfile(src, dst, hardlink):
+        shutil.copystat(src, dst)
+
+def _copy2_pair(hardlink, pair):
+    copy2(pair[0], pair[1], hardlink)
+
+def copytree(src, dst, hardlink=False, jobs=1):
+    """Copy a directory, like shutil.copytree() following symlinks
+
+    The directories are made first, in order, and then the files are copied
+    by *jobs* threads.
+    """
+    dirs, files = [], []
+    for dirpath, dirnames, filenames in os.walk(src, followlinks=True):
+        target = os.path.normpath(pjoin(dst, os.path.relpath(dirpath, src)))
+        os.makedirs(target)
+        dirs.append((dirpath, target))
+        for filename in filenames:
+            files.append((pjoin(dirpath, filename), pjoin(target, filename)))
+
+    if jobs > 1 and len(files) > 1:
+        pool = ThreadPool(jobs)
+        try:
+            # Iterating raises the first error from any of the copies
+            for _ in pool.imap_unordered(partial(_copy2_pair, hardlink),
+                                         files, chunksize=16):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for pair in files:
+            _copy2_pair(hardlink, pair)
+
+    # Set the directories' permissions after writing their contents
+    for dirpath, target in reversed(dirs):
+        shutil.copystat(dirpath, target)
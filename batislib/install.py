@@ -1,21 +1,43 @@
 import argparse
 import errno
+import filecmp
+from functools import partial
 import glob
+import hashlib
 import json
 import logging
+from multiprocessing import cpu_count
 import os
 import re
 import shutil
-from subprocess import call, PIPE, STDOUT
+import stat
+from subprocess import PIPE, STDOUT
+from tempfile import mkdtemp
+import threading
 
 pjoin = os.path.join
 basename = os.path.basename
 
-from . import distro, tarball
+from . import (distro, fastcopy, integrity, registry, snapshots, store, sync,
+               tarball)
+from .compression import resolve_jobs
 from .log import enable_colourful_output
+from .steps import StepGraph
+from .triggers import TriggerQueue
+from .util import exchange_paths
 
 log = logging.getLogger(__name__)
 
+# Where the list of files installed outside the application directory is kept
+INSTALLED_FILES = 'batis_info/installed_files.json'
+# The build's hash and version, and the application directory's files. This
+# is separate so older versions of Batis can still read installed_files.json.
+INSTALLED_FILES_META = 'batis_info/installed_files_meta.json'
+INSTALLED_FILES_VERSION = [1, 1]
+# Written by Batis after installing, so not part of the application
+MANIFEST_FILES = (INSTALLED_FILES, INSTALLED_FILES + '.tmp',
+                  INSTALLED_FILES_META, INSTALLED_FILES_META + '.tmp')
+
 # These locations are not all used by the code below; it shells out to XDG
 # commands like xdg-mime and xdg-icon-resource. They should install
 # to these locations, however.
@@ -49,6 +71,13 @@ def get_install_scheme(name):
     return {k: os.path.expanduser(v.format(XDG_DATA_HOME=XDG_DATA_HOME))
             for (k,v) in scheme.items()}
 
+# Unless told otherwise, write an application's files with one thread per
+# CPU, up to this many
+MAX_DEFAULT_JOBS = 8
+
+def default_jobs():
+    return min(cpu_count(), MAX_DEFAULT_JOBS)
+
 PKG_FORMAT_MAJOR = 1
 PKG_FORMAT_MINOR = 0
 
@@ -62,42 +91,280 @@ class FuturePackageFormat(Exception):
                 "Please upgrade Batis to install this package."
                 ).format(self.major_version, PKG_FORMAT_MAJOR)
 
+def _cleanup(staging_dir, tidy=None):
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    if tidy is not None:
+        tidy()
+
+def make_staging_dir(scheme):
+    """Make a directory to prepare an application in before installing it.
+
+    This is on the destination filesystem, so the application can be renamed
+    into place.
+    """
+    ensure_dir_exists(scheme['application'])
+    return mkdtemp(prefix='.batis-staging-', dir=scheme['application'])
+
+def file_sha512(path):
+    """Get the SHA-512 hash of a file, as a hex string"""
+    h = hashlib.sha512()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, tarball.STREAM_BUFSIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def load_installed_files(appdir):
+    """Load the manifest of an installed application.
+
+    Returns a dict with the list of installed 'files', and the
+    'source_sha512' and 'version' of the build if they were recorded.
+    'app_files' describes the files in the application directory (see
+    :func:`.integrity.describe_tree`). Older versions of Batis wrote only
+    the list of files.
+    """
+    with open(pjoin(appdir, INSTALLED_FILES)) as f:
+        manifest = {'files': json.load(f)}
+    try:
+        with open(pjoin(appdir, INSTALLED_FILES_META)) as f:
+            meta = json.load(f)
+    except (IOError, OSError):
+        return manifest
+    manifest.update((k, v) for k, v in meta.items() if k != 'files')
+    return manifest
+
+def _write_json(path, data):
+    # Replace the file, in case a snapshot shares it
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=2)
+    os.rename(path + '.tmp', path)
+
+def _is_intact(appdir, manifest):
+    """Check that an installed application's files are all in place.
+
+    This only compares sizes and times, so it's quick, but won't notice if
+    files are changed without changing those.
+    """
+    try:
+        for info in manifest['files']:
+            if info['type'] == 'symlink':
+                if not os.path.islink(info['path']):
+                    return False
+                continue
+            st = os.stat(info['path'])
+            if 'size' in info and (st.st_size, st.st_mtime) \
+                    != (info['size'], info['mtime']):
+                return False
+
+        hashes = tarball.load_file_hashes(appdir)
+        if hashes is not None:
+            for relpath, info in hashes['files'].items():
+                if os.lstat(pjoin(appdir, relpath)).st_size != info['size']:
+                    return False
+    except OSError:
+        return False
+    return True
+
+def find_installed_build(scheme, sha512):
+    """Find an application installed from the tarball with this hash.
+
+    Returns its directory if it's there and intact, or None.
+    """
+    for name in registry.find_by_source(scheme, sha512):
+        appdir = pjoin(scheme['application'], name)
+        try:
+            manifest = load_installed_files(appdir)
+        except (IOError, OSError, ValueError):
+            continue
+        if manifest.get('source_sha512') == sha512 \
+                and _is_intact(appdir, manifest):
+            return appdir
+    return None
+
 class ApplicationInstaller(object):
-    def __init__(self, path, scheme):
+    def __init__(self, path, scheme, staging_dir=None, hardlink=False,
+                 jobs=None, source_sha512=None, version=None, keep_versions=None,
+                 shared_store=None):
         """Class with the main installation logic
 
-        :param path: Application tarball/directory to install
+        :param path: Application tarball/directory to install, or a file
+          object to read a tarball from
         :param scheme: dictionary of directories to install into
+        :param staging_dir: if path is a directory already prepared inside a
+          directory from :func:`make_staging_dir`, pass that here, so the
+          application is moved into place and the staging directory removed.
+        :param hardlink: when installing from a directory, hard link its files
+          into place instead of copying them, where possible. Only use this if
+          neither copy will be modified.
+        :param jobs: the number of threads to write the application's files
+          with, when unpacking a tarball or copying a directory (default
+          from :func:`default_jobs`).
+        :param source_sha512: the SHA-512 hash of the tarball being installed,
+          to record in the manifest.
+        :param version: the version being installed, if it's not in the
+          application's metadata.
+        :param keep_versions: how many earlier versions to keep snapshots of,
+          to roll back to (default from :func:`.snapshots.keep_versions`).
+        :param shared_store: hard link the application's files with identical
+          files from other applications (default from
+          :func:`.store.store_enabled`).
         """
-        if os.path.isfile(path):
-            self.directory = tarball.unpack_app_tarball(path)
+        self.scheme = scheme
+        self.hardlink = hardlink
+        if jobs is None:
+            jobs = default_jobs()
+        self.jobs = jobs
+        self.source_sha512 = source_sha512
+        if keep_versions is None:
+            keep_versions = snapshots.keep_versions()
+        self.keep_versions = keep_versions
+        if shared_store is None:
+            shared_store = store.store_enabled()
+        self.shared_store = shared_store
+        self.staging_dir = staging_dir
+        if staging_dir is not None:
+            self.directory = path
+            try:
+                self._load_metadata()
+            except:
+                self.discard_staging()
+                raise
+        elif hasattr(path, 'read') or os.path.isfile(path):
+            # Unpack into a staging directory on the destination filesystem,
+            # so copy_application can just rename it into place.
+            self.staging_dir = make_staging_dir(scheme)
+            try:
+                self.directory = tarball.unpack_app_tarball(
+                    path, self.staging_dir, jobs)
+                self._load_metadata()
+            except:
+                self.discard_staging()
+                raise
         else:
             self.directory = os.path.abspath(path)
+            self._load_metadata()
+
+        self.name = os.path.basename(self.directory)
+        self.version = version or self.metadata.get('version')
+        self.installed_files = []
+        # Files the version being upgraded had installed, by path
+        self.previous_files = {}
+        self.cleanup_thread = None
+        # Caches to rebuild after installing; see :meth:`install`
+        self.triggers = TriggerQueue(scheme)
+
+    def _load_metadata(self):
         self.directory = self.directory.rstrip('/')
-        self.scheme = scheme
         with open(self._relative('batis_info', 'metadata.json')) as f:
             self.metadata = json.load(f)
-        
+
         if self.metadata['format_version'][0] > 1:
             raise FuturePackageFormat(self.metadata['format_version'][0])
-        
-        self.installed_files = []
 
-    def install_file(self, src, destination):
+        # Read this now: install() may be moving the directory while it
+        # installs the system packages.
+        deps_file = self._relative('batis_info', 'dependencies.json')
+        if os.path.isfile(deps_file):
+            with open(deps_file) as f:
+                self.dependencies = json.load(f)
+        else:
+            self.dependencies = None
+
+    def discard_staging(self, background=False, tidy=None):
+        """Remove the staging directory a tarball was unpacked into, if any.
+
+        With background=True, it's removed in a separate thread, so we don't
+        wait to delete the previous version of a big application. tidy is a
+        function to call afterwards in the same thread.
+        """
+        if self.staging_dir is not None:
+            if background:
+                self.cleanup_thread = threading.Thread(target=_cleanup,
+                                            args=(self.staging_dir, tidy))
+                self.cleanup_thread.start()
+            else:
+                shutil.rmtree(self.staging_dir, ignore_errors=True)
+            self.staging_dir = None
+
+    def _unchanged(self, destination, src=None, contents=None, link=None,
+                   sha256=None):
+        """Check if the version being upgraded installed the same file
+
+        If the file is the size and age recorded in its manifest, it's
+        compared with the new one by the hash recorded there, without
+        reading it.
+        """
+        previous = self.previous_files.get(destination)
+        if previous is None:
+            return False
+        if link is not None:
+            return os.path.islink(destination) \
+                    and os.readlink(destination) == link
+        if not os.path.isfile(destination) or os.path.islink(destination):
+            return False
+        if 'sha256' in previous:
+            st = os.stat(destination)
+            if previous.get('size') == st.st_size \
+                    and previous.get('mtime') == st.st_mtime:
+                return previous['sha256'] == sha256
+        if contents is not None:
+            with open(destination) as f:
+                return f.read() == contents
+        return filecmp.cmp(src, destination, shallow=False)
+
+    def _prepare_destination(self, destination):
         ensure_dir_exists(os.path.dirname(destination))
         if os.path.lexists(destination):
-            log.warn("Replacing file at %s", destination)
+            if destination not in self.previous_files:
+                owner = registry.file_owners(self.scheme,
+                                             [destination]).get(destination)
+                if owner is not None and owner != self.name:
+                    log.warn("Replacing file at %s installed by %s",
+                             destination, owner)
+                else:
+                    log.warn("Replacing file at %s", destination)
             os.unlink(destination)
-        shutil.copy(src, destination)
-        self.installed_files.append({'path': destination, 'type': 'file'})
+
+    def install_file(self, src, destination, contents=None):
+        """Copy a file outside the application directory.
+
+        If contents is given, it is written to the file instead of the
+        contents of src. Returns False if the file was already there from the
+        version being upgraded, so nothing was written, or True otherwise.
+        """
+        if contents is not None:
+            data = contents
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            sha256 = hashlib.sha256(data).hexdigest()
+        else:
+            sha256 = tarball.hash_file(src)
+        info = {'path': destination, 'type': 'file', 'sha256': sha256}
+        self.installed_files.append(info)
+
+        changed = not self._unchanged(destination, src, contents, sha256=sha256)
+        if changed:
+            self._prepare_destination(destination)
+            fastcopy.copy(src, destination)
+            if contents is not None:
+                with open(destination, 'w') as f:
+                    f.write(contents)
+        st = os.stat(destination)
+        info.update(size=st.st_size, mode=stat.S_IMODE(st.st_mode),
+                    mtime=st.st_mtime)
+        return changed
     
     def install_symlink(self, src, destination):
-        ensure_dir_exists(os.path.dirname(destination))
-        if os.path.lexists(destination):
-            log.warn("Replacing file at %s", destination)
-            os.unlink(destination)
+        """Make a symlink outside the application directory.
+
+        Returns True if it was created, like :meth:`install_file`.
+        """
+        self.installed_files.append({'path': destination, 'type': 'symlink',
+                                     'target': src})
+        if self._unchanged(destination, link=src):
+            return False
+        self._prepare_destination(destination)
         os.symlink(src, destination)
-        self.installed_files.append({'path': destination, 'type': 'symlink'})
+        return True
 
     def _relative(self, *path):
         return os.path.join(self.directory, *path)
@@ -107,14 +374,11 @@ class ApplicationInstaller(object):
 
         If this fails, returns a short string representing the reason.
         """
-        deps_file = self._relative('batis_info', 'dependencies.json')
-        if not os.path.isfile(deps_file):
+        deps = self.dependencies
+        if deps is None:
             log.debug("No dependencies.json; skipping installing system packages")
             return
 
-        with open(deps_file) as f:
-            deps = json.load(f)
-
         log.info('Installing system packages')
 
         spec = distro.select_dependencies_spec(deps['system_packages'])
@@ -139,21 +403,109 @@ class ApplicationInstaller(object):
                       deps['description'])
             return 'install failed'
 
-    def copy_application(self):
+    def copy_application(self, in_place=False):
+        """Put the application directory in place.
+
+        If in_place is True and an earlier version is installed, only the
+        files which differ are changed (see :func:`.sync.sync_tree`).
+        Otherwise, the new version is prepared in a staging directory beside
+        the destination, and swapped with the old version in one step, so the
+        application directory is never missing or half written. The old
+        version is then deleted in the background.
+
+        Either way, the files an earlier version installed outside the
+        application directory are left in place if they haven't changed, and
+        removed by :meth:`remove_stale_files` if the new version doesn't
+        install them.
+        """
         basename = os.path.basename(self.directory)
         destination = os.path.join(self.scheme['application'], basename)
-        if os.path.isdir(destination):
-            if os.path.isfile(pjoin(destination, 'batis_info',
-                                    'installed_files.json')):
-                log.info('Removing previously installed application at %s',
-                         destination)
-                from .uninstall import ApplicationUninstaller
-                ApplicationUninstaller(destination, self.scheme).run()
-            else:
-                log.warn('Removing existing directory %s', destination)
-                shutil.rmtree(destination)
-        log.info('Copying application directory to %s', destination)
-        shutil.copytree(self.directory, destination)
+        keep_snapshot = self.keep_versions > 0 \
+                and os.path.isfile(pjoin(destination, INSTALLED_FILES))
+        if in_place and os.path.isdir(destination):
+            self._load_previous_files(destination)
+            if keep_snapshot:
+                # sync_tree replaces files with other links rather than
+                # changing them, so this can share them.
+                snapshots.link_snapshot(self.scheme, basename, destination)
+            log.info('Updating application directory %s', destination)
+            changed = sync.sync_tree(self.directory, destination,
+                                     keep=MANIFEST_FILES)
+            log.info('%d files changed', len(changed))
+            if self.shared_store:
+                store.share_tree(self.scheme, destination, self.jobs)
+            self._tidy(basename, keep_snapshot)
+            if self.staging_dir is not None:
+                self.directory = destination
+                self.discard_staging()
+            return
+
+        if self.staging_dir is None:
+            self.staging_dir = make_staging_dir(self.scheme)
+            staged = pjoin(self.staging_dir, basename)
+            log.info('Copying application directory to %s', staged)
+            fastcopy.copytree(self.directory, staged, self.hardlink,
+                              self.jobs)
+            self.directory = staged
+
+        if self.shared_store:
+            store.share_tree(self.scheme, self.directory, self.jobs)
+
+        if not os.path.isdir(destination):
+            log.info('Moving application directory to %s', destination)
+            os.rename(self.directory, destination)
+            self.directory = destination
+            self.discard_staging()
+            return
+
+        previously_installed = os.path.isfile(pjoin(destination,
+                                                    INSTALLED_FILES))
+        if previously_installed:
+            log.info('Replacing previously installed application at %s',
+                     destination)
+            # Its files outside the application directory are replaced
+            # only if they change; see remove_stale_files
+            self._load_previous_files(destination)
+        else:
+            log.warn('Replacing existing directory %s', destination)
+
+        old = self.directory
+        if not exchange_paths(self.directory, destination):
+            # Without an atomic exchange, the destination is briefly missing
+            old = pjoin(self.staging_dir, basename + '.old')
+            os.rename(destination, old)
+            os.rename(self.directory, destination)
+        self.directory = destination
+
+        if keep_snapshot:
+            # Keep the old version to roll back to
+            snapshots.save_snapshot(self.scheme, basename, old)
+        self.discard_staging(background=True,
+                             tidy=partial(self._tidy, basename, keep_snapshot))
+
+    def _tidy(self, basename, snapshot_kept):
+        """Prune snapshots and the shared store after replacing a version"""
+        if snapshot_kept:
+            snapshots.tidy_snapshots(self.scheme, basename, self.keep_versions)
+        store.collect_garbage(self.scheme)
+
+    def _load_previous_files(self, appdir):
+        try:
+            self.previous_files = {i['path']: i for i in
+                                   load_installed_files(appdir)['files']}
+        except (IOError, OSError, ValueError):
+            self.previous_files = {}
+
+    def remove_stale_files(self):
+        """Remove files which the version being upgraded installed, but
+        this version doesn't."""
+        current = set(i['path'] for i in self.installed_files)
+        stale = sorted(set(self.previous_files) - current)
+        if stale:
+            from .uninstall import ApplicationUninstaller
+            uninstaller = ApplicationUninstaller(None, self.scheme,
+                                                 self.triggers)
+            uninstaller.remove_paths(stale, self.name)
 
     def install_commands(self):
         log.info("Symlinking commands to %s", self.scheme['commands'])
@@ -173,6 +525,7 @@ class ApplicationInstaller(object):
         log.info("Installing icons")
         for theme in os.listdir(icon_dir):
             themedir = self._relative('batis_info', 'icons', theme)
+            changed = False
             for sizestr in os.listdir(themedir):
                 m = re.match(r'(\d+)x\1', sizestr)
                 if not m:
@@ -184,70 +537,55 @@ class ApplicationInstaller(object):
                         src = pjoin(contextdir, basename)
                         dest = pjoin(self.scheme['icons'],
                                      theme, sizestr, context, basename)
-                        self.install_file(src, dest)
+                        changed |= self.install_file(src, dest)
 
-            try:
-                rc = call(['xdg-icon-resource', 'forceupdate', '--theme', theme])
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    log.warn('xdg-icon-resource is not available')
-                else:
-                    raise
-            else:
-                if rc != 0:
-                    log.warn('xdg-icon-resource failed')
+            if changed:
+                self.triggers.icons_changed(theme)
 
     def install_mimetypes(self):
         source_files = glob.glob(self._relative('batis_info', 'mime', '*.xml')) 
+        changed = False
         for file in source_files:
             dest = pjoin(self.scheme['mimetypes'], 'packages', basename(file))
             log.info("Installing mimetype package file %s", file)
-            self.install_file(file, dest)
+            changed |= self.install_file(file, dest)
         
-        if source_files:
-            try:
-                rc = call(['update-mime-database', self.scheme['mimetypes']])
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    log.warn('update-mime-database is not available')
-                else:
-                    raise
-            else:
-                if rc != 0:
-                    log.warn('update-mime-database failed')
+        if changed:
+            self.triggers.mime_changed()
 
     def install_desktop_files(self):
         install_dir = pjoin(self.scheme['application'],
                             os.path.basename(self.directory))
         files = glob.glob(self._relative('batis_info', 'desktop', '*.desktop'))
+        changed = False
         for file in files:
             dest = pjoin(self.scheme['desktop'], basename(file))
             log.info("Installing desktop file: %r", file)
-            self.install_file(file, dest)
 
             # Rewrite any instances of {{INSTALL_DIR}}
-            with open(dest) as f:
-                contents = f.read()
-            with open(dest, 'w') as f:
-                f.write(contents.replace('{{INSTALL_DIR}}', install_dir))
+            with open(file) as f:
+                contents = f.read().replace('{{INSTALL_DIR}}', install_dir)
+            changed |= self.install_file(file, dest, contents)
         
-        if files:
-            try:
-                rc = call(['update-desktop-database', self.scheme['desktop']])
-            except OSError as e:
-                if e.errno == errno.ENOENT:
-                    log.warn('update-desktop-database is not available')
-                else:
-                    raise
-            else:
-                if rc != 0:
-                    log.warn('update-desktop-database failed')
+        if changed:
+            self.triggers.desktop_changed()
     
     def write_manifest(self):
-        with open(pjoin(self.scheme['application'],
-                        os.path.basename(self.directory),
-                        'batis_info', 'installed_files.json'), 'w') as f:
-            json.dump(self.installed_files, f, indent=2)
+        name = os.path.basename(self.directory)
+        appdir = pjoin(self.scheme['application'], name)
+        files = sorted(self.installed_files, key=lambda i: i['path'])
+        meta = {
+            'format_version': INSTALLED_FILES_VERSION,
+            'source_sha512': self.source_sha512,
+            'version': self.version,
+            'app_files': integrity.describe_tree(appdir,
+                                skip=set(MANIFEST_FILES), jobs=self.jobs),
+        }
+        _write_json(pjoin(appdir, INSTALLED_FILES_META), meta)
+        # The list of files goes last; its modification time is taken as
+        # when the application was installed.
+        _write_json(pjoin(appdir, INSTALLED_FILES), files)
+        registry.record_install(self.scheme, name, dict(meta, files=files))
 
     def ensure_path_env(self):
         """Ensure $PATH includes the directory where shell commands are installed"""
@@ -263,27 +601,54 @@ class ApplicationInstaller(object):
 
             log.warn("You may need to log out and back in to use this application")
 
-    def install(self, backend=False):
+    def install(self, backend=False, in_place=False, triggers=None):
+        """Install the application.
+
+        in_place=True upgrades an installed version by changing only what
+        differs; see :meth:`copy_application`.
+
+        The desktop, mime type and icon caches are updated at the end. To
+        update them once after several operations, pass a shared
+        :class:`.TriggerQueue` as triggers, and call its ``finish()`` method
+        afterwards.
+        """
+        if triggers is not None:
+            self.triggers = triggers
+
         def emit(msg):
             if backend:
                 print(msg)
 
-        emit('step: system_packages')
-        failure = self.install_system_packages(backend)
-        if failure:
-            emit('problem: system_packages: ' + failure)
-        emit('step: copy_dir')
-        self.copy_application()
-        emit('step: install_commands')
-        self.install_commands()
-        emit('step: install_icons')
-        self.install_icons()
-        emit('step: install_mimetypes')
-        self.install_mimetypes()
-        emit('step: install_desktop')
-        self.install_desktop_files()
-        emit('step: write_manifest')
-        self.write_manifest()
+        def step_finished(name, result):
+            if name == 'system_packages' and result:
+                emit('problem: system_packages: ' + result)
+
+        def write_manifest():
+            self.remove_stale_files()
+            self.write_manifest()
+
+        # The system packages are installed while the application is copied,
+        # and the files outside the application directory are then installed
+        # in parallel. The step events still come in this order.
+        exports = ['install_commands', 'install_icons', 'install_mimetypes',
+                   'install_desktop']
+        graph = StepGraph()
+        graph.add('system_packages',
+                  lambda: self.install_system_packages(backend))
+        graph.add('copy_dir', lambda: self.copy_application(in_place))
+        graph.add('install_commands', self.install_commands, ['copy_dir'])
+        graph.add('install_icons', self.install_icons, ['copy_dir'])
+        graph.add('install_mimetypes', self.install_mimetypes, ['copy_dir'])
+        graph.add('install_desktop', self.install_desktop_files, ['copy_dir'])
+        graph.add('write_manifest', write_manifest, exports)
+
+        try:
+            graph.run(started=lambda name: emit('step: ' + name),
+                      finished=step_finished)
+            if triggers is None:
+                self.triggers.finish()
+        finally:
+            self.discard_staging()
         emit('finished')
 
 def main(argv=None):
@@ -292,6 +657,20 @@ def main(argv=None):
             help='Install systemwide, instead of for the user')
     ap.add_argument('--backend', action='store_true',
             help=argparse.SUPPRESS)
+    ap.add_argument('--in-place', action='store_true',
+            help='Upgrade an installed version by changing only the files '
+                 'which differ')
+    ap.add_argument('--hardlink', action='store_true',
+            help='Hard link files from an application directory instead of '
+                 'copying them, if it will not be modified')
+    ap.add_argument('-j', '--jobs', type=int,
+            help='Write files using this many threads (0 to use one per CPU; '
+                 'default: one per CPU, up to %d)' % MAX_DEFAULT_JOBS)
+    ap.add_argument('--defer-triggers', action='store_true',
+            help="Don't update desktop, mime type and icon caches until "
+                 "'batis run-triggers' is run")
+    ap.add_argument('--reinstall', action='store_true',
+            help='Install the tarball even if it is already installed')
     ap.add_argument('path', help='The application tarball or directory to install')
     args = ap.parse_args(argv)
     if args.backend:
@@ -299,8 +678,25 @@ def main(argv=None):
     else:
         enable_colourful_output(level=logging.INFO)
     scheme = get_install_scheme('system' if args.system else 'user')
-    ai = ApplicationInstaller(args.path, scheme)
-    ai.install(args.backend)
+
+    sha512 = None
+    if os.path.isfile(args.path):
+        sha512 = file_sha512(args.path)
+        existing = None if args.reinstall \
+                   else find_installed_build(scheme, sha512)
+        if existing is not None:
+            log.info('This build is already installed at %s', existing)
+            if args.backend:
+                print('finished')
+            return
+
+    ai = ApplicationInstaller(args.path, scheme, hardlink=args.hardlink,
+                              jobs=None if args.jobs is None
+                                   else resolve_jobs(args.jobs),
+                              source_sha512=sha512)
+    triggers = TriggerQueue(scheme, defer=args.defer_triggers)
+    ai.install(args.backend, in_place=args.in_place, triggers=triggers)
+    triggers.finish()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,163 @@
+"""Check that installed applications haven't been changed since installation
+
+When an application is installed, the size, permissions and SHA-256 hash of
+each file in its directory is recorded in installed_files_meta.json, and
+those of the files it installs elsewhere in installed_files.json.
+``batis verify-installed``
+hashes the files again, and reports any which are missing, modified, or
+were added since.
+"""
+from __future__ import print_function
+
+import argparse
+from multiprocessing.pool import ThreadPool
+import os
+import stat
+
+from .tarball import hash_file, load_file_hashes
+
+pjoin = os.path.join
+
+def _describe(path, sha256=None):
+    """Describe a file as in the manifest, hashing it if sha256 isn't given"""
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return {'type': 'symlink', 'target': os.readlink(path)}
+    if sha256 is None:
+        sha256 = hash_file(path)
+    return {'type': 'file', 'size': st.st_size,
+            'mode': stat.S_IMODE(st.st_mode), 'mtime': st.st_mtime,
+            'sha256': sha256}
+
+def _walk(directory, skip):
+    """Yield the relative paths of files and symlinks in a directory"""
+    for dirpath, dirnames, filenames in os.walk(directory):
+        reldir = os.path.relpath(dirpath, directory)
+        for name in filenames + [d for d in dirnames
+                                 if os.path.islink(pjoin(dirpath, d))]:
+            relpath = name if reldir == '.' else pjoin(reldir, name)
+            if relpath not in skip:
+                yield relpath
+
+def describe_tree(directory, skip=(), jobs=1):
+    """Describe the files in an installed application directory
+
+    Returns a dict of relative paths to the size, mode and hash of files, or
+    the target of symlinks. Hashes from batis_info/files.json are used for
+    files which are the size it gives, instead of hashing them again.
+    """
+    packaged = load_file_hashes(directory)
+    packaged = {} if packaged is None else packaged['files']
+
+    def describe(relpath):
+        path = pjoin(directory, relpath)
+        known = packaged.get(relpath)
+        if known is not None and os.lstat(path).st_size == known['size'] \
+                and not os.path.islink(path):
+            return relpath, _describe(path, known['sha256'])
+        return relpath, _describe(path)
+
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        return dict(pool.imap_unordered(describe, _walk(directory, skip),
+                                        chunksize=16))
+    finally:
+        pool.close()
+        pool.join()
+
+def check_file(path, expected, quick=False):
+    """Compare a file with its description in the manifest.
+
+    Returns None if it matches, or 'missing' or 'modified'. With quick=True,
+    files with the recorded size and modification time aren't hashed.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 'missing'
+    if expected['type'] == 'symlink':
+        if not stat.S_ISLNK(st.st_mode):
+            return 'modified'
+        if 'target' in expected and os.readlink(path) != expected['target']:
+            return 'modified'
+        return None
+    if not stat.S_ISREG(st.st_mode) or st.st_size != expected.get('size'):
+        return 'modified'
+    if 'mode' in expected and stat.S_IMODE(st.st_mode) != expected['mode']:
+        return 'modified'
+    if quick and st.st_mtime == expected.get('mtime'):
+        return None
+    if hash_file(path) != expected.get('sha256'):
+        return 'modified'
+    return None
+
+def verify_application(appdir, manifest, quick=False, pool=None):
+    """Check the files an application installed against its manifest
+
+    Returns a sorted list of (problem, path) pairs, where problem is
+    'missing', 'modified' or 'extra'. pool is a ThreadPool to hash files in.
+    """
+    from .install import MANIFEST_FILES
+    if 'app_files' not in manifest:
+        raise ValueError('{} was installed by an older version of Batis, '
+                         'which did not record its files'.format(appdir))
+
+    checks = [(pjoin(appdir, relpath), info)
+              for relpath, info in manifest['app_files'].items()]
+    checks += [(info['path'], info) for info in manifest.get('files', [])
+               if info['type'] == 'symlink' or 'size' in info]
+
+    def check(item):
+        return item[0], check_file(item[0], item[1], quick)
+    results = pool.imap_unordered(check, checks, chunksize=16) \
+              if pool is not None else map(check, checks)
+    problems = [(problem, path) for path, problem in results if problem]
+
+    skip = set(MANIFEST_FILES)
+    problems += [('extra', pjoin(appdir, relpath))
+                 for relpath in _walk(appdir, skip)
+                 if relpath not in manifest['app_files']]
+    return sorted(problems)
+
+def main(argv=None):
+    from .compression import resolve_jobs
+    from .install import get_install_scheme, load_installed_files
+    from .registry import installed_applications
+    ap = argparse.ArgumentParser(prog='batis verify-installed')
+    ap.add_argument('--quick', action='store_true',
+            help="Don't hash files whose size and modification time are "
+                 "as they were installed")
+    ap.add_argument('--system', action='store_true',
+            help='Check systemwide applications, instead of the user')
+    ap.add_argument('-j', '--jobs', type=int, default=0,
+            help='Hash files using this many threads (default: one per CPU)')
+    ap.add_argument('name', nargs='*',
+            help='Applications to check (default: all installed)')
+    args = ap.parse_args(argv)
+    scheme = get_install_scheme('system' if args.system else 'user')
+
+    names = args.name or [a['name'] for a in installed_applications(scheme)]
+    failed = 0
+    pool = ThreadPool(resolve_jobs(args.jobs))
+    try:
+        for name in names:
+            appdir = pjoin(scheme['application'], name)
+            try:
+                manifest = load_installed_files(appdir)
+                problems = verify_application(appdir, manifest, args.quick,
+                                              pool)
+            except (IOError, OSError, ValueError) as e:
+                print('{}: could not check: {}'.format(name, e))
+                failed += 1
+                continue
+            for problem, path in problems:
+                print('{}: {}: {}'.format(name, problem, path))
+            if problems:
+                failed += 1
+            else:
+                print('{}: OK'.format(name))
+    finally:
+        pool.close()
+        pool.join()
+
+    return 1 if failed else 0
@@ -1,31 +1,29 @@
 import argparse
-from pathlib import Path
 import sys
 
 from .install import get_install_scheme
+from .registry import installed_applications
 
 def iter_installed_applications():
     for schemename in ['user', 'system']:
-        appsdir = Path(get_install_scheme(schemename)['application'])
-        for d in appsdir.iterdir():
-            if (d / 'batis_info').is_dir():
-                yield d.absolute()
+        scheme = get_install_scheme(schemename)
+        for app in installed_applications(scheme):
+            app['scheme'] = schemename
+            yield app
 
 def display_installed_applications():
-    names = sorted(d.name for d in iter_installed_applications())
+    names = sorted(app['name'] for app in iter_installed_applications())
     for n in names:
         print(n)
 
 def json_installed_applications():
-    res = []
-    for d in iter_installed_applications():
-        res.append({'name': d.name, 'path': str(d)})
+    res = list(iter_installed_applications())
 
     import json
     json.dump(res, sys.stdout, indent=1)
 
 def main(argv=None):
-    ap = argparse.ArgumentParser(prog='batis installtar')
+    ap = argparse.ArgumentParser(prog='batis list')
     ap.add_argument('--json', action='store_true',
             help='Format output as a machine-readable JSON array')
     args = ap.parse_args(argv)
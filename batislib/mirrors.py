@@ -0,0 +1,146 @@
+"""Pick the fastest of several URLs for a download"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from .cache import default_cache_dir
+from .install import ensure_dir_exists
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+# Bytes to fetch from each URL to measure it
+PROBE_SIZE = 64 * 1024
+
+# URLs are ranked by the estimated time to download this much
+RANK_SIZE = 1024 * 1024
+
+PROBE_TIMEOUT = (5, 10)
+
+# How long (in seconds) to remember how fast a host was
+RANKING_MAX_AGE = 24 * 60 * 60
+
+def _host(url):
+    return urlparse(url).netloc.lower()
+
+def probe(url, session=None):
+    """Time fetching the start of url.
+
+    Returns the estimated seconds to download RANK_SIZE bytes from it,
+    counting the time to the first byte plus the rate the rest of the probe
+    arrived at, or infinity if the request failed.
+    """
+    if session is None:
+        session = requests
+    from .urlinstall import _user_agent
+    headers = {'user-agent': _user_agent(), 'accept-encoding': 'identity',
+               'range': 'bytes=0-%d' % (PROBE_SIZE - 1)}
+    t0 = time.monotonic()
+    try:
+        with session.get(url, headers=headers, stream=True,
+                         timeout=PROBE_TIMEOUT) as r:
+            r.raise_for_status()
+            first = None
+            received = 0
+            for chunk in r.iter_content(8192):
+                if first is None:
+                    first = time.monotonic()
+                    first_len = len(chunk)
+                received += len(chunk)
+                if received >= PROBE_SIZE:
+                    break
+            end = time.monotonic()
+    except requests.RequestException as e:
+        log.debug('Probing %s failed: %s', url, e)
+        return float('inf')
+
+    if first is None:
+        return float('inf')
+    latency = first - t0
+    if end > first and received > first_len:
+        rate = (received - first_len) / (end - first)
+        return latency + RANK_SIZE / rate
+    return latency
+
+class MirrorRanking(object):
+    """Probe results for each host, kept for RANKING_MAX_AGE seconds.
+
+    These are stored in mirrors.json in the cache directory, so we don't
+    probe the same hosts every time we install something.
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = directory
+        self.path = pjoin(directory, 'mirrors.json')
+        self.lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, url):
+        """Get the cached score for url's host, or None"""
+        entry = self._load().get(_host(url))
+        if entry is None or entry['time'] < time.time() - RANKING_MAX_AGE:
+            return None
+        return entry['score']
+
+    def store(self, scores):
+        """Record scores, a dict of {url: seconds}"""
+        with self.lock:
+            data = self._load()
+            now = time.time()
+            for url, score in scores.items():
+                # JSON has no infinity; failed hosts are just probed again
+                if math.isfinite(score):
+                    data[_host(url)] = {'score': score, 'time': now}
+            ensure_dir_exists(self.directory)
+            with tempfile.NamedTemporaryFile('w', dir=self.directory,
+                                             prefix='.partial-',
+                                             delete=False) as f:
+                json.dump(data, f)
+            os.rename(f.name, self.path)
+
+def rank_urls(urls, session=None, ranking=None):
+    """Sort URLs for the same file, fastest first.
+
+    URLs are probed concurrently, except those whose host has a score in
+    *ranking*, a :class:`MirrorRanking`, if given. URLs which can't be
+    reached go last.
+    """
+    if len(urls) < 2:
+        return list(urls)
+
+    scores = {}
+    if ranking is not None:
+        for url in urls:
+            score = ranking.get(url)
+            if score is not None:
+                scores[url] = score
+
+    to_probe = [u for u in urls if u not in scores]
+    if to_probe:
+        with ThreadPoolExecutor(max_workers=len(to_probe)) as executor:
+            probed = dict(zip(to_probe, executor.map(
+                    lambda u: probe(u, session), to_probe)))
+        if ranking is not None:
+            ranking.store(probed)
+        scores.update(probed)
+
+    ranked = sorted(urls, key=scores.__getitem__)
+    log.debug('Mirrors ranked: %s', ', '.join('%s (%.2fs)' % (u, scores[u])
+                                             for u in ranked))
+    return ranked
@@ -0,0 +1,329 @@
+"""A database of the applications installed in each install scheme
+
+``batis list`` and ``batis installtar`` look up installed applications here,
+instead of opening every application directory, which is slow with many
+applications or a home directory on a network filesystem. The database is
+``.batis-registry.sqlite3`` in the application directory of the install
+scheme. Installing and uninstalling update it.
+
+It also records which application installed each file outside its own
+directory, such as a command in ``~/.local/bin``, so ``batis owns <path>``
+can find it. If a second application installs a file at the same path, the
+file belongs to that one, and uninstalling the first leaves it alone.
+
+If it's missing, e.g. after upgrading from a version of Batis without it, it
+is rebuilt from the application directories the first time it's needed.
+Applications installed or removed without updating it, e.g. by an older
+version of Batis, are found by comparing it with the list of application
+directories when it's opened.
+"""
+from __future__ import print_function
+
+import argparse
+from contextlib import closing
+import errno
+import logging
+import os
+import sqlite3
+import stat
+import sys
+import time
+
+from .tarball import load_file_hashes
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+REGISTRY_FILE = '.batis-registry.sqlite3'
+
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS applications (
+    name TEXT PRIMARY KEY,
+    version TEXT,
+    source_sha512 TEXT,
+    size INTEGER,
+    installed_time REAL
+);
+CREATE TABLE IF NOT EXISTS exported_files (
+    application TEXT NOT NULL,
+    path TEXT NOT NULL,
+    type TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS exported_files_application
+    ON exported_files (application);
+CREATE INDEX IF NOT EXISTS exported_files_path ON exported_files (path);
+"""
+
+def registry_path(scheme):
+    return pjoin(scheme['application'], REGISTRY_FILE)
+
+def _connect(path):
+    # Installs running at the same time wait for each other's transactions
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version < SCHEMA_VERSION:
+        try:
+            conn.executescript(_SCHEMA)
+            conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        except sqlite3.OperationalError as e:
+            # Read only; the queries still work, if more slowly
+            log.debug('Could not update registry %s: %s', path, e)
+    return conn
+
+def application_size(appdir, count_files=True):
+    """The total size of an application's files, in bytes
+
+    This uses the sizes in batis_info/files.json if it's there, so it doesn't
+    need to look at every file. Otherwise, the files are added up, unless
+    count_files is False, in which case this returns None.
+    """
+    hashes = load_file_hashes(appdir)
+    if hashes is not None:
+        return sum(info['size'] for info in hashes['files'].values())
+    if not count_files:
+        return None
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(appdir):
+        for name in filenames:
+            st = os.lstat(pjoin(dirpath, name))
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+    return size
+
+def _record(conn, name, manifest, size, installed_time):
+    files = manifest.get('files', [])
+    conn.execute('DELETE FROM applications WHERE name = ?', (name,))
+    conn.execute('DELETE FROM exported_files WHERE application = ?', (name,))
+    # Files which other applications installed belong to this one now
+    conn.executemany('DELETE FROM exported_files WHERE path = ?',
+                     [(i['path'],) for i in files])
+    conn.execute('INSERT INTO applications VALUES (?, ?, ?, ?, ?)',
+                 (name, manifest.get('version'), manifest.get('source_sha512'),
+                  size, installed_time))
+    conn.executemany('INSERT INTO exported_files VALUES (?, ?, ?)',
+                     [(name, i['path'], i['type']) for i in files])
+
+def _is_application(appsdir, name):
+    # Not staging directories, snapshots, etc.
+    return not name.startswith('.') \
+        and os.path.isdir(pjoin(appsdir, name, 'batis_info'))
+
+def _remove(conn, name):
+    conn.execute('DELETE FROM applications WHERE name = ?', (name,))
+    conn.execute('DELETE FROM exported_files WHERE application = ?', (name,))
+
+def _scan(scheme, names=None):
+    """Find installed applications by looking in their directories"""
+    from .install import INSTALLED_FILES, load_installed_files
+    appsdir = scheme['application']
+    if names is None:
+        names = os.listdir(appsdir)
+    for name in sorted(names):
+        appdir = pjoin(appsdir, name)
+        if not _is_application(appsdir, name):
+            continue
+        try:
+            manifest = load_installed_files(appdir)
+            installed_time = os.stat(pjoin(appdir, INSTALLED_FILES)).st_mtime
+        except (IOError, OSError, ValueError):
+            manifest = {}
+            installed_time = os.stat(appdir).st_mtime
+        # Don't go through every file of an application installed without
+        # files.json; its size is left unknown.
+        yield name, manifest, application_size(appdir, count_files=False), \
+            installed_time
+
+def _fill(conn, scheme, names=None):
+    if names is None:
+        log.info('Listing installed applications in %s', scheme['application'])
+    # If applications installed the same file, the latest one owns it
+    with conn:
+        for args in sorted(_scan(scheme, names), key=lambda a: a[3]):
+            _record(conn, *args)
+
+def _differences(conn, scheme):
+    """Compare the registry with the application directories.
+
+    Returns the names of applications which aren't in the registry, and of
+    those in the registry whose directories have gone.
+    """
+    appsdir = scheme['application']
+    on_disk = set(os.listdir(appsdir))
+    registered = {row['name'] for row in
+                  conn.execute('SELECT name FROM applications')}
+    added = [n for n in on_disk - registered if _is_application(appsdir, n)]
+    return added, sorted(registered - on_disk)
+
+def _update(conn, scheme, added, removed):
+    log.info('Updating the list of installed applications in %s',
+             scheme['application'])
+    with conn:
+        for name in removed:
+            _remove(conn, name)
+    _fill(conn, scheme, added)
+
+def _fill_in_memory(scheme, copy_from=None, added=None, removed=()):
+    """Make a registry in memory, for when the real one can't be written.
+
+    With copy_from, the path of an out of date registry, its contents are
+    copied, and only the *added* and *removed* applications are updated.
+    Otherwise, every application directory is scanned.
+    """
+    conn = _connect(':memory:')
+    if copy_from is None:
+        _fill(conn, scheme)
+        return conn
+
+    conn.execute('ATTACH DATABASE ? AS disk', (copy_from,))
+    with conn:
+        for table in ('applications', 'exported_files'):
+            conn.execute('INSERT INTO main.{0} SELECT * FROM disk.{0}'
+                         .format(table))
+    conn.execute('DETACH DATABASE disk')
+    _update(conn, scheme, added, removed)
+    return conn
+
+def open_registry(scheme):
+    """Connect to the registry for an install scheme, making it if needed.
+
+    Returns None if the scheme's application directory doesn't exist. If the
+    registry doesn't exist and can't be made, e.g. listing system
+    applications as a user, it's made in memory for this connection. If it
+    needs updating but can't be written to, it's copied into memory and
+    updated there.
+    """
+    path = registry_path(scheme)
+    if not os.path.isdir(scheme['application']):
+        return None
+    if os.path.isfile(path):
+        conn = _connect(path)
+        added, removed = _differences(conn, scheme)
+        if not (added or removed):
+            return conn
+        if os.access(path, os.W_OK):
+            _update(conn, scheme, added, removed)
+            return conn
+        conn.close()
+        return _fill_in_memory(scheme, path, added, removed)
+    if not os.access(scheme['application'], os.W_OK):
+        return _fill_in_memory(scheme)
+
+    # Fill in a new registry under a temporary name, so nothing sees it
+    # half made.
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with closing(_connect(tmp)) as conn:
+        _fill(conn, scheme)
+    try:
+        # If another process made the registry first, use that one
+        os.link(tmp, path)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            pass
+        elif e.errno in (errno.EPERM, errno.EMLINK):
+            os.rename(tmp, path)
+        else:
+            raise
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    return _connect(path)
+
+def record_install(scheme, name, manifest):
+    """Add or update an installed application.
+
+    manifest is as returned by :func:`.install.load_installed_files`.
+    """
+    appdir = pjoin(scheme['application'], name)
+    size = application_size(appdir)
+    conn = open_registry(scheme)
+    with closing(conn), conn:
+        _record(conn, name, manifest, size, time.time())
+
+def record_uninstall(scheme, name):
+    """Remove an application from the registry"""
+    conn = open_registry(scheme)
+    if conn is None:
+        return
+    with closing(conn), conn:
+        _remove(conn, name)
+
+def release_files(scheme, name, paths):
+    """Record that an application's files at these paths were removed"""
+    conn = open_registry(scheme)
+    if conn is None:
+        return
+    with closing(conn), conn:
+        conn.executemany('DELETE FROM exported_files '
+                         'WHERE application = ? AND path = ?',
+                         [(name, p) for p in paths])
+
+def _to_dict(scheme, row):
+    d = dict(zip(row.keys(), row))
+    d['path'] = pjoin(scheme['application'], row['name'])
+    return d
+
+def installed_applications(scheme):
+    """Get a list of dicts describing the applications installed in a scheme
+
+    The keys are 'name', 'path', 'version', 'source_sha512', 'size' (in
+    bytes) and 'installed_time' (seconds since the epoch).
+    """
+    conn = open_registry(scheme)
+    if conn is None:
+        return []
+    with closing(conn):
+        rows = conn.execute('SELECT * FROM applications ORDER BY name')
+        return [_to_dict(scheme, row) for row in rows]
+
+def find_by_source(scheme, sha512):
+    """Get the names of applications installed from the tarball with a hash"""
+    conn = open_registry(scheme)
+    if conn is None:
+        return []
+    with closing(conn):
+        rows = conn.execute('SELECT name FROM applications '
+                            'WHERE source_sha512 = ?', (sha512,))
+        return [row['name'] for row in rows]
+
+def file_owners(scheme, paths):
+    """Find which applications installed files outside their directories
+
+    Returns a dict mapping each path which belongs to an application to its
+    name.
+    """
+    conn = open_registry(scheme)
+    if conn is None:
+        return {}
+    with closing(conn):
+        owners = {}
+        for path in paths:
+            row = conn.execute('SELECT application FROM exported_files '
+                               'WHERE path = ?', (path,)).fetchone()
+            if row is not None:
+                owners[path] = row['application']
+        return owners
+
+def owns_main(argv=None):
+    from .install import get_install_scheme
+    ap = argparse.ArgumentParser(prog='batis owns')
+    ap.add_argument('path', nargs='+',
+            help='A file installed outside an application directory')
+    args = ap.parse_args(argv)
+
+    # Not resolving symlinks: commands are symlinks into the application
+    paths = [os.path.abspath(p) for p in args.path]
+    missing = set(paths)
+    for schemename in ['user', 'system']:
+        owners = file_owners(get_install_scheme(schemename), paths)
+        for path in paths:
+            if path in owners and path in missing:
+                print('{}: {} ({})'.format(path, owners[path], schemename))
+                missing.discard(path)
+
+    for path in sorted(missing):
+        print('{}: not installed by any application'.format(path),
+              file=sys.stderr)
+    return 1 if missing else 0
@@ -0,0 +1,215 @@
+"""Keep earlier versions of installed applications, to roll back to
+
+When an application is upgraded, the version it replaces is moved into
+``.batis-snapshots/<name>/<n>`` in the application directory of the install
+scheme, with the highest number for the latest. Files which are the same in
+a snapshot and the installed version are hard linked together, so a
+snapshot only takes up space for the files which changed.
+
+``batis rollback <name>`` swaps the installed version with the latest
+snapshot, and updates the commands, icons, mime types and desktop files to
+match. It doesn't need to download or copy the application.
+"""
+from __future__ import print_function
+
+import argparse
+import errno
+import logging
+import os
+import shutil
+
+from .log import enable_colourful_output
+from .tarball import load_file_hashes
+from .util import compress_user, exchange_paths
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+SNAPSHOTS_DIR = '.batis-snapshots'
+
+# How many earlier versions of each application to keep
+DEFAULT_KEEP_VERSIONS = 2
+
+def keep_versions():
+    """The number of versions to keep, from $BATIS_KEEP_VERSIONS or 2"""
+    if os.environ.get('BATIS_KEEP_VERSIONS'):
+        return int(os.environ['BATIS_KEEP_VERSIONS'])
+    return DEFAULT_KEEP_VERSIONS
+
+def snapshots_dir(scheme, name):
+    return pjoin(scheme['application'], SNAPSHOTS_DIR, name)
+
+def list_snapshots(scheme, name):
+    """Get the snapshots of an application, oldest first, as (n, path)"""
+    d = snapshots_dir(scheme, name)
+    if not os.path.isdir(d):
+        return []
+    return sorted((int(n), pjoin(d, n)) for n in os.listdir(d) if n.isdigit())
+
+def _next_snapshot(scheme, name):
+    snapshots = list_snapshots(scheme, name)
+    n = snapshots[-1][0] + 1 if snapshots else 1
+    d = snapshots_dir(scheme, name)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    return pjoin(d, str(n))
+
+def save_snapshot(scheme, name, path):
+    """Move an application directory which is being replaced into a snapshot.
+
+    This is a rename, so path must be on the same filesystem.
+    """
+    snapshot = _next_snapshot(scheme, name)
+    os.rename(path, snapshot)
+    log.info('Keeping the previous version in %s', compress_user(snapshot))
+    return snapshot
+
+def _link_tree(src, dst):
+    """Copy a directory, hard linking the files instead of copying them"""
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.normpath(pjoin(dst, os.path.relpath(dirpath, src)))
+        os.mkdir(target)
+        dirs.append((dirpath, target))
+        for name in dirnames + filenames:
+            path = pjoin(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), pjoin(target, name))
+            elif name in filenames:
+                try:
+                    os.link(path, pjoin(target, name))
+                except OSError:
+                    shutil.copy2(path, pjoin(target, name))
+
+    for dirpath, target in reversed(dirs):
+        shutil.copystat(dirpath, target)
+
+def link_snapshot(scheme, name, path):
+    """Snapshot an application directory which will be changed in place.
+
+    The snapshot is made of hard links, so files in the application
+    directory must be replaced, not modified, to leave it unchanged.
+    """
+    snapshot = _next_snapshot(scheme, name)
+    _link_tree(path, snapshot)
+    log.info('Keeping the previous version in %s', compress_user(snapshot))
+    return snapshot
+
+def _dedupe(snapshot, active, active_files):
+    """Hard link files in a snapshot to identical files in active
+
+    Files are matched by the hashes in their batis_info/files.json.
+    """
+    hashes = load_file_hashes(snapshot)
+    if hashes is None:
+        return
+    for relpath, info in hashes['files'].items():
+        if active_files.get(relpath) != info:
+            continue
+        src, dst = pjoin(active, relpath), pjoin(snapshot, relpath)
+        try:
+            st_src, st_dst = os.lstat(src), os.lstat(dst)
+            if st_src.st_ino == st_dst.st_ino \
+                    or st_src.st_size != st_dst.st_size:
+                continue
+            tmp = dst + '.batis-link'
+            os.link(src, tmp)
+            os.rename(tmp, dst)
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                return
+            if e.errno != errno.ENOENT:
+                raise
+
+def tidy_snapshots(scheme, name, keep):
+    """Share unchanged files between the snapshots and the installed version,
+    and remove all but the latest *keep* snapshots."""
+    snapshots = list_snapshots(scheme, name)
+    for n, path in snapshots[:max(len(snapshots) - keep, 0)]:
+        shutil.rmtree(path, ignore_errors=True)
+    active = pjoin(scheme['application'], name)
+    active_hashes = load_file_hashes(active)
+    if active_hashes is not None:
+        for n, path in snapshots[-keep:] if keep else []:
+            _dedupe(path, active, active_hashes['files'])
+
+def remove_snapshots(scheme, name):
+    shutil.rmtree(snapshots_dir(scheme, name), ignore_errors=True)
+
+def _snapshot_version(path):
+    from .install import load_installed_files
+    try:
+        return load_installed_files(path).get('version')
+    except (IOError, OSError, ValueError):
+        return None
+
+def rollback(scheme, name, version=None):
+    """Switch an installed application back to its latest snapshot.
+
+    If version is given, use the latest snapshot of that version instead.
+    The version being replaced becomes the latest snapshot, so rolling back
+    again undoes this.
+    """
+    from .install import ApplicationInstaller, load_installed_files
+    snapshots = list_snapshots(scheme, name)
+    if version is not None:
+        snapshots = [s for s in snapshots if _snapshot_version(s[1]) == version]
+    if not snapshots:
+        raise ValueError('No earlier version of {} is kept{}'.format(
+            name, '' if version is None else ' with version ' + version))
+    snapshot = snapshots[-1][1]
+    active = pjoin(scheme['application'], name)
+
+    try:
+        previous_files = load_installed_files(active)['files']
+    except (IOError, OSError, ValueError):
+        previous_files = []
+    restored = load_installed_files(snapshot)
+
+    replaced = _next_snapshot(scheme, name)
+    if exchange_paths(snapshot, active):
+        os.rename(snapshot, replaced)
+    else:
+        os.rename(active, replaced)
+        os.rename(snapshot, active)
+
+    # Install the files outside the application directory which differ
+    ai = ApplicationInstaller(active, scheme,
+                              source_sha512=restored.get('source_sha512'),
+                              version=restored.get('version'))
+    ai.previous_files = {i['path']: i for i in previous_files}
+    ai.install_commands()
+    ai.install_icons()
+    ai.install_mimetypes()
+    ai.install_desktop_files()
+    ai.remove_stale_files()
+    ai.write_manifest()
+    ai.triggers.finish()
+    return ai
+
+def main(argv=None):
+    from .uninstall import find_installed_application
+    ap = argparse.ArgumentParser(prog='batis rollback')
+    ap.add_argument('--list', action='store_true',
+            help='List the earlier versions which are kept')
+    ap.add_argument('--version',
+            help='The version to go back to (default: the latest kept)')
+    ap.add_argument('name', help='The application name to roll back')
+    args = ap.parse_args(argv)
+    enable_colourful_output(level=logging.INFO)
+
+    appdir, scheme = find_installed_application(args.name)
+    if args.list:
+        for n, path in reversed(list_snapshots(scheme, args.name)):
+            print(n, _snapshot_version(path) or '(unknown version)')
+        return 0
+
+    try:
+        ai = rollback(scheme, args.name, args.version)
+    except ValueError as e:
+        log.error('%s', e)
+        return 1
+    log.info('Rolled back %s to version %s', args.name,
+             ai.version or '(unknown)')
+    return 0
@@ -0,0 +1,68 @@
+"""Run steps concurrently, each once the steps it depends on have finished"""
+from multiprocessing.pool import ThreadPool
+import threading
+
+class _Step(object):
+    def __init__(self, name, func, after):
+        self.name = name
+        self.func = func
+        self.after = after
+        # An Event wakes every waiting thread; on Python 2, a pool's
+        # AsyncResult only wakes one of them.
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def _run_step(step, dependencies):
+    try:
+        for dep in dependencies:
+            dep.done.wait()
+            if dep.error is not None:
+                # Fail with the same error as the dependency
+                step.error = dep.error
+                return
+        step.result = step.func()
+    except Exception as e:
+        step.error = e
+    finally:
+        step.done.set()
+
+class StepGraph(object):
+    def __init__(self):
+        self.steps = []
+
+    def add(self, name, func, after=()):
+        """Add a step. after lists the names of steps which must finish first"""
+        self.steps.append(_Step(name, func, tuple(after)))
+
+    def run(self, started=None, finished=None):
+        """Run all the steps, and return a dict of their results by name.
+
+        Independent steps run at the same time, but the callbacks are called
+        in the order the steps were added: ``started(name)`` once the step
+        before has finished, and ``finished(name, result)`` when the step is
+        done. If a step fails, any steps depending on it fail too, and the
+        error is raised after the steps already running have finished.
+        """
+        by_name = {step.name: step for step in self.steps}
+        # One thread per step, so steps waiting for others can't use them all
+        pool = ThreadPool(max(len(self.steps), 1))
+        results = {}
+        try:
+            for step in self.steps:
+                pool.apply_async(_run_step,
+                                 (step, [by_name[a] for a in step.after]))
+
+            for step in self.steps:
+                if started is not None:
+                    started(step.name)
+                step.done.wait()
+                if step.error is not None:
+                    raise step.error
+                results[step.name] = step.result
+                if finished is not None:
+                    finished(step.name, step.result)
+        finally:
+            pool.close()
+            pool.join()
+        return results
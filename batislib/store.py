@@ -0,0 +1,140 @@
+"""Store identical files from different applications only once
+
+If $BATIS_SHARED_STORE is set to 1, each installed file is hashed, and hard
+linked to a file in ``.batis-store`` in the application directory of the
+install scheme, named by its hash and permissions. Applications with the
+same files, such as a bundled runtime, then share one copy of them.
+
+The link count of a file in the store shows how many applications (or
+snapshots of them) are using it. When it drops to 1, only the store has the
+file, and :func:`collect_garbage` deletes it.
+
+Because the files are shared, applications must not modify their own files.
+"""
+import errno
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import stat
+
+from .tarball import hash_file
+from .util import format_size
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+STORE_DIR = '.batis-store'
+
+_NO_HARDLINK = {errno.EXDEV, errno.EPERM, errno.EMLINK}
+
+def store_enabled():
+    """Check $BATIS_SHARED_STORE to see if the shared store should be used"""
+    return os.environ.get('BATIS_SHARED_STORE', '').lower() in \
+        {'1', 'yes', 'true'}
+
+def store_dir(scheme):
+    return pjoin(scheme['application'], STORE_DIR)
+
+def _blob_path(root, sha256, mode):
+    return pjoin(root, sha256[:2], '%s-%o' % (sha256[2:], mode))
+
+def _share_file(root, path):
+    """Hard link a file with the copy in the store, or add it to the store.
+
+    Returns the number of bytes saved.
+    """
+    st = os.lstat(path)
+    blob = _blob_path(root, hash_file(path), stat.S_IMODE(st.st_mode))
+    while True:
+        try:
+            blob_st = os.lstat(blob)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            blob_st = None
+
+        if blob_st is None:
+            try:
+                os.makedirs(os.path.dirname(blob))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.link(path, blob)
+                return 0
+            except OSError as e:
+                if e.errno in _NO_HARDLINK:
+                    return 0
+                if e.errno != errno.EEXIST:
+                    raise
+                continue  # Another thread added the same file first
+
+        if blob_st.st_ino == st.st_ino:
+            return 0
+        if stat.S_IMODE(blob_st.st_mode) != stat.S_IMODE(st.st_mode):
+            # Something changed the file in the store; don't share it again
+            log.warn('Removing %s from the store, as its permissions '
+                        'have changed', blob)
+            try:
+                os.unlink(blob)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            continue
+        tmp = path + '.batis-store'
+        try:
+            os.link(blob, tmp)
+        except OSError as e:
+            if e.errno in _NO_HARDLINK:
+                return 0
+            if e.errno != errno.ENOENT:
+                raise
+            continue  # Deleted by collect_garbage(), so add it again
+        os.rename(tmp, path)
+        return st.st_size
+
+def share_tree(scheme, tree, jobs=1):
+    """Hard link the files in tree with identical files in the store.
+
+    Files which aren't in the store yet are added to it. Returns the number
+    of bytes saved.
+    """
+    root = store_dir(scheme)
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(tree):
+        for name in filenames:
+            path = pjoin(dirpath, name)
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                paths.append(path)
+
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        saved = sum(pool.imap_unordered(lambda p: _share_file(root, p),
+                                        paths, chunksize=16))
+    finally:
+        pool.close()
+        pool.join()
+    if saved:
+        log.info('Sharing %s of files with other applications',
+                 format_size(saved))
+    return saved
+
+def collect_garbage(scheme):
+    """Delete files in the store which no application is using.
+
+    Returns the number of bytes freed.
+    """
+    root = store_dir(scheme)
+    if not os.path.isdir(root):
+        return 0
+    freed = 0
+    for subdir in os.listdir(root):
+        for name in os.listdir(pjoin(root, subdir)):
+            path = pjoin(root, subdir, name)
+            st = os.lstat(path)
+            if st.st_nlink == 1:
+                os.unlink(path)
+                freed += st.st_size
+    return freed
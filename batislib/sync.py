@@ -0,0 +1,143 @@
+"""Update an installed application directory to match a new version in place"""
+import logging
+import os
+import shutil
+import stat
+
+from . import fastcopy
+from .tarball import hash_file
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+def _scan(root, keep):
+    """Map relative paths under root to their lstat results"""
+    entries = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = pjoin(dirpath, name)
+            relpath = os.path.relpath(path, root)
+            if relpath not in keep:
+                entries[relpath] = os.lstat(path)
+    return entries
+
+def _same_contents(src, dst, st_src, st_dst):
+    """Compare two entries by type, then size and mtime, then by hash"""
+    if stat.S_IFMT(st_src.st_mode) != stat.S_IFMT(st_dst.st_mode):
+        return False
+    if stat.S_ISLNK(st_src.st_mode):
+        return os.readlink(src) == os.readlink(dst)
+    if not stat.S_ISREG(st_src.st_mode):
+        return True
+    if st_src.st_size != st_dst.st_size:
+        return False
+    if st_src.st_mtime == st_dst.st_mtime:
+        return True
+    return hash_file(src) == hash_file(dst)
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def _replace_with_copy(src, dst):
+    """Copy src over dst, so dst is never missing or half written"""
+    tmp = pjoin(os.path.dirname(dst), '.batis-tmp-' + os.path.basename(dst))
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), tmp)
+    else:
+        fastcopy.copy2(src, tmp)
+    if os.path.isdir(dst) and not os.path.islink(dst):
+        shutil.rmtree(dst)
+    os.rename(tmp, dst)
+
+def _copy_stat(src, dst, st_dst):
+    """Give dst the permissions and times of src.
+
+    A file with other hard links, from a snapshot or the shared store, is
+    replaced with a copy instead, so the other paths don't change with it.
+    """
+    if st_dst.st_nlink > 1:
+        _replace_with_copy(src, dst)
+    else:
+        shutil.copystat(src, dst)
+
+def sync_tree(src, dst, keep=()):
+    """Make the directory dst match src, touching only what differs.
+
+    Files are compared by size and modification time, and by hash if only
+    the time differs. Changed files are replaced by renaming a new copy over
+    them, files which were moved are renamed rather than copied, and files
+    which are no longer in src are deleted. Paths relative to dst in *keep*
+    are left alone. Files with more than one link are replaced rather than
+    modified, so dst can share files with other directories.
+
+    Returns a sorted list of the relative paths which were added, changed
+    or removed.
+    """
+    new = _scan(src, keep)
+    old = _scan(dst, keep)
+    changed = set()
+
+    # Files which are going away, by size, in case they were moved
+    removed_files = {}
+    for relpath in set(old) - set(new):
+        if stat.S_ISREG(old[relpath].st_mode):
+            removed_files.setdefault(old[relpath].st_size, []).append(relpath)
+
+    # Sorting puts directories before their contents
+    for relpath in sorted(new):
+        st = new[relpath]
+        s, d = pjoin(src, relpath), pjoin(dst, relpath)
+        if relpath in old:
+            if _same_contents(s, d, st, old[relpath]):
+                if not stat.S_ISLNK(st.st_mode) and \
+                        stat.S_IMODE(st.st_mode) \
+                        != stat.S_IMODE(old[relpath].st_mode):
+                    changed.add(relpath)
+                    if stat.S_ISDIR(st.st_mode):
+                        pass  # Set at the end
+                    elif old[relpath].st_nlink > 1:
+                        _replace_with_copy(s, d)
+                    else:
+                        os.chmod(d, stat.S_IMODE(st.st_mode))
+                continue
+            elif stat.S_ISDIR(st.st_mode) or stat.S_ISDIR(old[relpath].st_mode):
+                _remove(d)
+
+        changed.add(relpath)
+        if stat.S_ISDIR(st.st_mode):
+            # The real permissions are set at the end, in case they stop us
+            # writing inside it.
+            os.mkdir(d, 0o700)
+            continue
+
+        if stat.S_ISREG(st.st_mode):
+            for moved in removed_files.get(st.st_size, []):
+                if os.path.lexists(pjoin(dst, moved)) \
+                        and hash_file(pjoin(dst, moved)) == hash_file(s):
+                    log.debug('Renaming %s to %s', moved, relpath)
+                    os.rename(pjoin(dst, moved), d)
+                    _copy_stat(s, d, old[moved])
+                    removed_files[st.st_size].remove(moved)
+                    break
+            else:
+                _replace_with_copy(s, d)
+        else:
+            _replace_with_copy(s, d)
+
+    # Deepest first, so files are gone before their directories
+    for relpath in sorted(set(old) - set(new), reverse=True):
+        changed.add(relpath)
+        if os.path.lexists(pjoin(dst, relpath)):
+            _remove(pjoin(dst, relpath))
+
+    for relpath in new:
+        if stat.S_ISDIR(new[relpath].st_mode):
+            os.chmod(pjoin(dst, relpath), stat.S_IMODE(new[relpath].st_mode))
+
+    return sorted(changed)
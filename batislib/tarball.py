@@ -1,30 +1,193 @@
 import argparse
+from collections import deque
+import copy
+from functools import partial
+import hashlib
+import io
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import posixpath
+import shutil
+import stat
 import sys
 import tarfile
 from tempfile import mkdtemp
+import time
 
+from .compression import (available_codecs, open_tar_stream, resolve_jobs,
+                          tar_writer, tarball_extension)
 from .log import enable_colourful_output
+from .util import format_size
 
 pjoin = os.path.join
 
 log = logging.getLogger(__name__)
 
-def unpack_app_tarball(path):
-    """Unpack the .app.tar.gz file to a temporary directory.
+# Read compressed tarballs in bigger chunks than tarfile's default 10 KiB
+STREAM_BUFSIZE = 256 * 1024
 
-    Returns the path of the directory containing ``batis_info``.
+# Every package lists the hashes of its files here, so upgrades can tell
+# which files have changed.
+FILE_HASHES = 'batis_info/files.json'
+FILE_HASHES_VERSION = [1, 0]
+
+# When extracting with several threads, files up to this size are read into
+# memory and written by a worker thread, with at most PARALLEL_MAX_PENDING
+# bytes waiting to be written. Bigger files are written directly.
+PARALLEL_MAX_FILE_SIZE = 4 * 1024 * 1024
+PARALLEL_MAX_PENDING = 32 * 1024 * 1024
+
+# TarFile.chown() has a numeric_owner parameter from Python 3.5
+_CHOWN_ARGS = (False,) if sys.version_info >= (3, 5) else ()
+
+def _check_member(tarinfo, symlinks):
+    """Sanity check a tarball member before extracting it.
+
+    symlinks is the set of symlink names extracted so far: files shouldn't be
+    written through a symlink from the same archive, which could point
+    anywhere. That includes a later member with the same name as a symlink,
+    which would be opened through it, and hard links to a symlink.
+
+    Returns the member's name normalized, so different spellings of the same
+    path, like ``./x`` and ``x//y``, match. Add that to symlinks.
     """
-    tf = tarfile.open(path)
+    if tarinfo.name.startswith('/') or '..' in tarinfo.name.split('/'):
+        raise ValueError("Bad filename in tarball: %r" % tarinfo.name)
+    name = posixpath.normpath(tarinfo.name)
+    parts = name.split('/')
+    if name in symlinks:
+        raise ValueError("Filename in tarball replaces a symlink: %r" % name)
+    for i in range(1, len(parts)):
+        if '/'.join(parts[:i]) in symlinks:
+            raise ValueError("Filename in tarball is inside a symlink: %r"
+                             % name)
+    if tarinfo.islnk():
+        link = tarinfo.linkname
+        if link.startswith('/') or '..' in link.split('/'):
+            raise ValueError("Bad hard link in tarball: %r -> %r"
+                             % (name, link))
+        link_parts = posixpath.normpath(link).split('/')
+        for i in range(1, len(link_parts) + 1):
+            if '/'.join(link_parts[:i]) in symlinks:
+                raise ValueError("Hard link in tarball goes through a "
+                                 "symlink: %r -> %r" % (name, link))
+    return name
+
+def _write_member(tf, tarinfo, path, data):
+    """Write a file read from a tarball, and set its attributes like tarfile"""
+    with open(path, 'wb') as f:
+        f.write(data)
+    try:
+        tf.chown(tarinfo, path, *_CHOWN_ARGS)
+        tf.chmod(tarinfo, path)
+        tf.utime(tarinfo, path)
+    except tarfile.ExtractError:
+        if tf.errorlevel > 1:
+            raise
+
+def extract_stream(tf, target, jobs=1):
+    """Extract a tarfile opened in stream mode (``r|*``) into target.
+
+    Members are checked and written one at a time as they are read, so this
+    makes a single pass over the archive, and doesn't keep the full member
+    list in memory.
+
+    If jobs is more than 1, the data for small files is read from the stream
+    in order, and written out by that many threads. Directories, links and
+    large files are still created in order by the calling thread.
+    """
+    extract_kwargs = {}
+    if hasattr(tarfile, 'tar_filter'):
+        # Python 3.12+: we do our own checks, so keep the behaviour of
+        # earlier versions without a deprecation warning.
+        extract_kwargs['filter'] = 'tar'
+
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    pending = deque()  # (result, name, size) for files being written
+    pending_bytes = [0]
 
-    # Sanity check file names: shouldn't extract files outside the target dir
-    for name in tf.getnames():
-        if name.startswith('/') or '..' in name.split(os.sep):
-            raise ValueError("Bad filename in tarball: %r" % name)
+    def wait_oldest():
+        result, name, size = pending.popleft()
+        result.get()
+        pending_bytes[0] -= size
 
-    target = mkdtemp()
-    tf.extractall(target)
+    directories = []
+    symlinks = set()
+    try:
+        for tarinfo in tf:
+            name = _check_member(tarinfo, symlinks)
+            if tarinfo.islnk() or \
+                    any(n == name for (r, n, size) in pending):
+                # Hard link targets and replaced files must be written first
+                while pending:
+                    wait_oldest()
+
+            if pool is not None and tarinfo.isreg() \
+                    and tarinfo.size <= PARALLEL_MAX_FILE_SIZE:
+                if 'filter' in extract_kwargs:
+                    tarinfo = tarfile.tar_filter(tarinfo, target)
+                path = os.path.join(target, tarinfo.name)
+                upperdirs = os.path.dirname(path)
+                if not os.path.exists(upperdirs):
+                    os.makedirs(upperdirs)
+                data = tf.extractfile(tarinfo).read()
+                pending.append((pool.apply_async(_write_member,
+                                                 (tf, tarinfo, path, data)),
+                                name, len(data)))
+                pending_bytes[0] += len(data)
+                while len(pending) > jobs * 4 \
+                        or pending_bytes[0] > PARALLEL_MAX_PENDING:
+                    wait_oldest()
+                tf.members = []
+                continue
+
+            if tarinfo.isdir():
+                # Like extractall, create directories writable and set their
+                # real permissions after their contents are extracted.
+                directories.append(tarinfo)
+                tarinfo = copy.copy(tarinfo)
+                tarinfo.mode = 0o700
+            elif tarinfo.issym():
+                symlinks.add(name)
+            tf.extract(tarinfo, target, **extract_kwargs)
+            # tarfile remembers every member it reads; we don't need them.
+            tf.members = []
+
+        while pending:
+            wait_oldest()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    directories.sort(key=lambda ti: ti.name, reverse=True)
+    for tarinfo in directories:
+        dirpath = os.path.join(target, tarinfo.name)
+        os.chmod(dirpath, tarinfo.mode & 0o7777)
+        os.utime(dirpath, (tarinfo.mtime, tarinfo.mtime))
+
+def unpack_app_tarball(path, target=None, jobs=1):
+    """Unpack an application tarball into target.
+
+    The compression format is detected from the data, not the file name.
+    path may also be a readable file object, which doesn't need to be
+    seekable, e.g. a pipe or an HTTP response body. If target is not given,
+    a new temporary directory is created. jobs is the number of threads
+    writing files (see :func:`extract_stream`).
+    Returns the path of the directory containing ``batis_info``.
+    """
+    if target is None:
+        target = mkdtemp()
+
+    if hasattr(path, 'read'):
+        with open_tar_stream(path, bufsize=STREAM_BUFSIZE) as tf:
+            extract_stream(tf, target, jobs)
+    else:
+        with open(path, 'rb') as f, \
+                open_tar_stream(f, bufsize=STREAM_BUFSIZE) as tf:
+            extract_stream(tf, target, jobs)
 
     if os.path.isdir(os.path.join(target, 'batis_info')):
         return target
@@ -36,38 +199,156 @@ def unpack_app_tarball(path):
 
     raise ValueError("Could not find batis_info directory in tarball")
 
-def pack_tarball(directory, output_file=None, name=None, install_script=True):
+def hash_file(path):
+    """Get the SHA-256 hash of a file, as a hex string"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, STREAM_BUFSIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class _HashingReader(object):
+    """Wrap a file being added to a tarball, hashing the data read from it"""
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+def _hash_added_files(tf, name):
+    """Record the hashes of regular files as they are added to tf.
+
+    Returns the dict which will be filled in for :data:`FILE_HASHES`, so
+    the files don't need to be read a second time to hash them.
+    """
+    res = {}
+    prefix = name + '/'
+    addfile = tf.addfile
+
+    def hashing_addfile(tarinfo, fileobj=None):
+        if not tarinfo.name.startswith(prefix):
+            return addfile(tarinfo, fileobj)
+        relpath = tarinfo.name[len(prefix):]
+        if tarinfo.isreg() and fileobj is not None:
+            reader = _HashingReader(fileobj)
+            addfile(tarinfo, reader)
+            res[relpath] = {'sha256': reader.hash.hexdigest(),
+                            'size': tarinfo.size,
+                            'mode': stat.S_IMODE(tarinfo.mode)}
+        else:
+            addfile(tarinfo, fileobj)
+            if tarinfo.islnk() and tarinfo.linkname.startswith(prefix):
+                # A hard link to a file already added
+                target = res.get(tarinfo.linkname[len(prefix):])
+                if target is not None:
+                    res[relpath] = dict(target)
+
+    # TarFile.add() calls self.addfile() for each member
+    tf.addfile = hashing_addfile
+    return res
+
+def load_file_hashes(directory):
+    """Load the file hashes from an application directory, or return None"""
+    try:
+        with open(pjoin(directory, FILE_HASHES)) as f:
+            data = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if data.get('format_version', [None])[0] != FILE_HASHES_VERSION[0]:
+        return None
+    return data
+
+def pack_tarball(directory, output_file=None, name=None, install_script=True,
+                 jobs=1, codec='gz'):
+    """Pack an application directory into a tarball.
+
+    codec is one of :data:`compression.PACK_CODECS`. If jobs is more than 1,
+    the data is compressed in parallel by that many threads, where the codec
+    allows it. The hashes of the files are added as :data:`FILE_HASHES`.
+    Returns the path of the tarball.
+    """
     directory = os.path.abspath(directory).rstrip(os.sep)
     if name is None:
         name = os.path.basename(directory)
     
     if output_file is None:
         td = mkdtemp()
-        output_file = pjoin(td, name+'.app.tar.gz')
+        output_file = pjoin(td, name + tarball_extension(codec))
     elif os.path.exists(output_file):
         os.unlink(output_file)
     
-    tf = tarfile.open(output_file, mode='w:gz')
     log.info('Creating tarball %s', output_file)
-    tf.add(directory, arcname=name)
-    
-    if install_script:
-        log.info('Adding install.sh script and Batis files')
-        batislibdir = os.path.dirname(__file__)
-        install_res = pjoin(os.path.dirname(batislibdir), 'install_resources')
-        tf.add(pjoin(install_res, 'install.sh'), arcname=name+'/install.sh')
-        tf.add(pjoin(install_res, 'selfinstall.py'),
-               arcname=name+'/batis_info/selfinstall.py')
-
-        def filter_exclude_pycache(tarinfo):
-            if '__pycache__' not in tarinfo.name:
+    with tar_writer(output_file, codec, jobs) as tf:
+        files = _hash_added_files(tf, name)
+
+        def filter_exclude(tarinfo):
+            # Leave out any stale file hashes, e.g. from an installed copy
+            if tarinfo.name != name + '/' + FILE_HASHES:
                 return tarinfo
-        tf.add(batislibdir, arcname=name+'/batis_info/batislib',
-               filter=filter_exclude_pycache)
-    
-    tf.close()
+        tf.add(directory, arcname=name, filter=filter_exclude)
+
+        if install_script:
+            log.info('Adding install.sh script and Batis files')
+            batislibdir = os.path.dirname(os.path.abspath(__file__))
+            install_res = pjoin(os.path.dirname(batislibdir),
+                                'install_resources')
+            tf.add(pjoin(install_res, 'install.sh'),
+                   arcname=name+'/install.sh')
+            tf.add(pjoin(install_res, 'selfinstall.py'),
+                   arcname=name+'/batis_info/selfinstall.py')
+
+            def filter_exclude_pycache(tarinfo):
+                if '__pycache__' not in tarinfo.name:
+                    return tarinfo
+            tf.add(batislibdir, arcname=name+'/batis_info/batislib',
+                   filter=filter_exclude_pycache)
+
+        hashes = json.dumps({'format_version': FILE_HASHES_VERSION,
+                             'files': files}, indent=0, sort_keys=True)
+        hashes = hashes.encode('utf-8')
+        tarinfo = tarfile.TarInfo(name + '/' + FILE_HASHES)
+        tarinfo.size = len(hashes)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o644
+        tf.addfile(tarinfo, io.BytesIO(hashes))
+
     return output_file
 
+def compare_codecs(directory, name=None, install_script=True, jobs=1):
+    """Pack a directory with each available codec, and print the results.
+
+    This shows the size of each tarball, the time to pack it, and the time to
+    unpack it again, which is what users wait for when installing.
+    """
+    td = mkdtemp()
+    try:
+        results = []
+        for codec in available_codecs():
+            path = pjoin(td, 'app' + tarball_extension(codec))
+            start = time.time()
+            pack_tarball(directory, path, name, install_script, jobs, codec)
+            pack_time = time.time() - start
+
+            unpack_dir = pjoin(td, 'unpacked-' + codec)
+            start = time.time()
+            unpack_app_tarball(path, unpack_dir)
+            unpack_time = time.time() - start
+            shutil.rmtree(unpack_dir)
+
+            results.append((codec, os.path.getsize(path),
+                            pack_time, unpack_time))
+            os.unlink(path)
+    finally:
+        shutil.rmtree(td)
+
+    print('{:<6} {:>12} {:>10} {:>10}'.format('Codec', 'Size', 'Pack', 'Unpack'))
+    for codec, size, pack_time, unpack_time in results:
+        print('{:<6} {:>12} {:>9.2f}s {:>9.2f}s'.format(
+                codec, format_size(size), pack_time, unpack_time))
+
 def pack_main(argv=None):
     ap = argparse.ArgumentParser(prog='batis pack')
     ap.add_argument('-n', '--name',
@@ -78,6 +359,18 @@ def pack_main(argv=None):
         help="Skip verifying the application directory before packing it")
     ap.add_argument('--no-install-script', action='store_true',
         help="Don't include a ./install.sh script inside the tarball")
+    ap.add_argument('-j', '--jobs', type=int, default=1,
+        help="Compress using this many threads (0 to use one per CPU)")
+    ap.add_argument('-c', '--compression', default='gz',
+        choices=available_codecs(),
+        help="The compression format to use (default: gz)")
+    ap.add_argument('--delta', action='store_true',
+        help="Also write an uncompressed tarball and a list of its files, "
+             "so installed copies can be upgraded by downloading only the "
+             "files which changed")
+    ap.add_argument('--compare-codecs', action='store_true',
+        help="Report the size and pack/unpack times with each compression "
+             "format, instead of writing a tarball")
     ap.add_argument('directory', help="The directory to package")
     args = ap.parse_args(argv)
     
@@ -94,5 +387,28 @@ def pack_main(argv=None):
             print(len(problems), "problems found in", args.directory)
             sys.exit(1)
     
-    pack_tarball(args.directory, args.output_file, args.name,
-                 install_script=(not args.no_install_script))
+    if args.compare_codecs:
+        compare_codecs(args.directory, args.name,
+                       install_script=(not args.no_install_script),
+                       jobs=resolve_jobs(args.jobs))
+        return
+
+    start = time.time()
+    path = pack_tarball(args.directory, args.output_file, args.name,
+                 install_script=(not args.no_install_script),
+                 jobs=resolve_jobs(args.jobs), codec=args.compression)
+    log.info('Packed %s (%s) in %.1f seconds', path,
+             format_size(os.path.getsize(path)), time.time() - start)
+
+    if args.delta:
+        from .delta import write_delta_manifest
+        payload = path
+        if args.compression != 'none':
+            ext = tarball_extension(args.compression)
+            base = path[:-len(ext)] if path.endswith(ext) else path
+            payload = pack_tarball(args.directory,
+                        base + tarball_extension('none'), args.name,
+                        install_script=(not args.no_install_script),
+                        jobs=resolve_jobs(args.jobs), codec='none')
+        manifest = write_delta_manifest(payload)
+        log.info('Wrote %s and %s for delta upgrades', payload, manifest)
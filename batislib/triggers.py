@@ -0,0 +1,135 @@
+"""Rebuild desktop integration caches once for a group of changes
+
+Installing or removing desktop files, mime type definitions or icons means
+running a command to rebuild the cache for them. A :class:`TriggerQueue`
+notes which caches need rebuilding, so each command runs once at the end,
+however many applications were installed or removed. Triggers can also be
+deferred: they are saved to a file, and run later by ``batis run-triggers``.
+"""
+import argparse
+import errno
+import json
+import logging
+import os
+from subprocess import call
+
+from .log import enable_colourful_output
+
+pjoin = os.path.join
+
+log = logging.getLogger(__name__)
+
+# Deferred triggers are saved in the application directory of each scheme
+PENDING_FILE = '.batis-pending-triggers.json'
+
+def _run(cmd):
+    try:
+        rc = call(cmd)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            log.warn('%s is not available', cmd[0])
+        else:
+            raise
+    else:
+        if rc != 0:
+            log.warn('%s failed', cmd[0])
+
+class TriggerQueue(object):
+    def __init__(self, scheme, defer=False):
+        """Collect the caches to rebuild for one install scheme.
+
+        If defer is True, :meth:`finish` saves the triggers for
+        ``batis run-triggers`` instead of running them.
+        """
+        self.scheme = scheme
+        self.defer = defer
+        self.desktop = False
+        self.mime = False
+        self.icon_themes = set()
+
+    def desktop_changed(self):
+        self.desktop = True
+
+    def mime_changed(self):
+        self.mime = True
+
+    def icons_changed(self, theme):
+        self.icon_themes.add(theme)
+
+    def path_changed(self, path):
+        """Note the cache affected by adding or removing the file at path"""
+        if path.startswith(self.scheme['desktop']):
+            self.desktop_changed()
+        elif path.startswith(self.scheme['mimetypes']):
+            self.mime_changed()
+        elif path.startswith(self.scheme['icons']):
+            theme = path[len(self.scheme['icons']):].lstrip('/').split('/')[0]
+            self.icons_changed(theme)
+
+    def is_empty(self):
+        return not (self.desktop or self.mime or self.icon_themes)
+
+    @property
+    def pending_file(self):
+        return pjoin(self.scheme['application'], PENDING_FILE)
+
+    def load_pending(self):
+        """Add the triggers saved by earlier deferred operations"""
+        try:
+            with open(self.pending_file) as f:
+                pending = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        self.desktop |= pending.get('desktop', False)
+        self.mime |= pending.get('mime', False)
+        self.icon_themes.update(pending.get('icon_themes', []))
+
+    def save(self):
+        """Save the queued triggers, along with any already pending"""
+        self.load_pending()
+        if not os.path.isdir(self.scheme['application']):
+            os.makedirs(self.scheme['application'])
+        tmp = self.pending_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'desktop': self.desktop, 'mime': self.mime,
+                       'icon_themes': sorted(self.icon_themes)}, f)
+        os.rename(tmp, self.pending_file)
+        self._clear()
+
+    def run(self):
+        """Rebuild the caches, including for any deferred triggers"""
+        self.load_pending()
+        if self.desktop:
+            _run(['update-desktop-database', self.scheme['desktop']])
+        if self.mime:
+            _run(['update-mime-database', self.scheme['mimetypes']])
+        for theme in sorted(self.icon_themes):
+            _run(['xdg-icon-resource', 'forceupdate', '--theme', theme])
+        self._clear()
+        try:
+            os.unlink(self.pending_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def finish(self):
+        """Run or save the queued triggers, at the end of an operation"""
+        if not self.defer:
+            self.run()
+        elif not self.is_empty():
+            self.save()
+            log.info("Run 'batis run-triggers' to update the desktop caches")
+
+    def _clear(self):
+        self.desktop = self.mime = False
+        self.icon_themes = set()
+
+def main(argv=None):
+    from .install import get_install_scheme
+    ap = argparse.ArgumentParser(prog='batis run-triggers')
+    ap.add_argument('--system', action='store_true',
+            help='Run triggers for systemwide installs, instead of the user')
+    args = ap.parse_args(argv)
+    enable_colourful_output(level=logging.INFO)
+    scheme = get_install_scheme('system' if args.system else 'user')
+    TriggerQueue(scheme).run()
@@ -1,13 +1,16 @@
 import argparse
 import errno
-import json
 import logging
 import os
 import shutil
-from subprocess import call
 
-from .install import get_install_scheme
+from .install import get_install_scheme, load_installed_files
+from .integrity import check_file
 from .log import enable_colourful_output
+from .registry import file_owners, record_uninstall, release_files
+from .snapshots import remove_snapshots
+from .store import collect_garbage
+from .triggers import TriggerQueue
 from .util import compress_user
 
 pjoin = os.path.join
@@ -31,21 +34,44 @@ def find_installed_application(name, scheme_search_order=('user', 'system')):
     raise UnknownApplication(name)
 
 class ApplicationUninstaller(object):
-    def __init__(self, appdir, scheme):
+    def __init__(self, appdir, scheme, triggers=None):
+        """Remove an installed application.
+
+        triggers is a :class:`.TriggerQueue` to note the caches to rebuild in.
+        If it's shared with other operations, don't call :meth:`run_triggers`;
+        call the queue's ``finish()`` method once they are all done.
+        """
         self.appdir = appdir
         self.scheme = scheme
-        self.desktop_files = False
-        self.mime_files = False
-        self.icon_themes = set()
+        self.triggers = triggers if triggers is not None \
+                        else TriggerQueue(scheme)
     
     def remove_files(self):
         """Remove files copied or linked outside the main application directory"""
-        with open(pjoin(self.appdir, 'batis_info', 'installed_files.json')) as f:
-            manifest = json.load(f)
-        
-        for info in manifest:
-            # TODO: check that files have not been modified since installation?
-            path = info['path']
+        manifest = load_installed_files(self.appdir)
+        for info in manifest['files']:
+            if 'size' in info and \
+                    check_file(info['path'], info, quick=True) == 'modified':
+                log.warn('%s was modified after it was installed',
+                         info['path'])
+        self.remove_paths([info['path'] for info in manifest['files']],
+                          os.path.basename(self.appdir))
+
+    def remove_paths(self, paths, name=None):
+        """Remove the given files, noting which triggers need to run
+
+        If name is given, files which another application has since
+        installed at the same paths are left in place.
+        """
+        if name is not None:
+            owners = file_owners(self.scheme, paths)
+            for path in paths:
+                if owners.get(path, name) != name:
+                    log.info('Leaving %s, which belongs to %s',
+                             path, owners[path])
+            paths = [p for p in paths if owners.get(p, name) == name]
+
+        for path in paths:
             try:
                 os.unlink(path)
             except OSError as e:
@@ -54,22 +80,14 @@ class ApplicationUninstaller(object):
                 else:
                     raise
 
-            if path.startswith(self.scheme['desktop']):
-                self.desktop_files = True
-            elif path.startswith(self.scheme['mimetypes']):
-                self.mime_files = True
-            elif path.startswith(self.scheme['icons']):
-                theme = path[len(self.scheme['icons']):].lstrip('/').split('/')[0]
-                self.icon_themes.add(theme)
-        
+            self.triggers.path_changed(path)
+
+        if name is not None:
+            release_files(self.scheme, name, paths)
+
     def run_triggers(self):
         """Run external commands to rebuild caches affected by files we remove"""
-        if self.desktop_files:
-            call(['update-desktop-database', self.scheme['desktop']])
-        if self.mime_files:
-            call(['update-mime-database', self.scheme['mimetypes']])
-        for theme in self.icon_themes:
-            call(['xdg-icon-resource', 'forceupdate', '--theme', theme])
+        self.triggers.finish()
     
     def remove_appdir(self):
         """Remove the main application directory"""
@@ -79,12 +97,19 @@ class ApplicationUninstaller(object):
         self.remove_files()
         self.run_triggers()
         self.remove_appdir()
+        record_uninstall(self.scheme, os.path.basename(self.appdir))
+        remove_snapshots(self.scheme, os.path.basename(self.appdir))
+        collect_garbage(self.scheme)
         log.info('Uninstalled %s', compress_user(self.appdir))
 
 def main(argv=None):
     ap = argparse.ArgumentParser(prog='batis uninstall')
+    ap.add_argument('--defer-triggers', action='store_true',
+            help="Don't update desktop, mime type and icon caches until "
+                 "'batis run-triggers' is run")
     ap.add_argument('name', help='The application name to uninstall')
     args = ap.parse_args(argv)
     enable_colourful_output(level=logging.INFO)
     appdir, scheme = find_installed_application(args.name)
-    ApplicationUninstaller(appdir, scheme).run()
+    triggers = TriggerQueue(scheme, defer=args.defer_triggers)
+    ApplicationUninstaller(appdir, scheme, triggers).run()
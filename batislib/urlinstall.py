@@ -1,16 +1,32 @@
 # -*- coding: utf-8 -*-
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import gzip
 import hashlib
+from itertools import chain
+import json
 import logging
-import os.path
+import os
+import queue
+import re
 import requests
 from shutil import rmtree
-from tempfile import mkdtemp
+from tempfile import mkdtemp, NamedTemporaryFile, TemporaryFile
+import threading
+import time
 from urllib.parse import urlparse, urlunparse
+import urllib3
 
-from .install import ApplicationInstaller, get_install_scheme
+from .cache import DownloadCache, IndexCache
+from .install import (ApplicationInstaller, find_installed_build,
+                      get_install_scheme)
 from .log import enable_colourful_output
-from . import select_build
+from .triggers import TriggerQueue
+from .util import compress_user, format_size
+from . import mirrors, select_build
+
+log = logging.getLogger(__name__)
 
 INDEX_FORMAT_MAJOR = 1
 INDEX_FORMAT_MINOR = 0
@@ -35,41 +51,681 @@ class NullProgress(object):
     def finish(self):
         pass
 
-def download(url, target, progress=None, hashobj=None):
+# Size of chunks to read from the network
+CHUNK_SIZE = 64 * 1024
+
+# Consecutive connection failures to retry while downloading, and the delay
+# in seconds before the first retry, which doubles each time.
+DOWNLOAD_RETRIES = 5
+RETRY_BACKOFF = 1.0
+
+# How many times to download a build again if its hash doesn't match
+HASH_RETRIES = 2
+
+# (connect, read) timeouts in seconds, so a stalled connection gets retried
+TIMEOUT = (30, 60)
+
+# How many downloads to run at once when installing several applications
+DEFAULT_JOBS = 4
+
+# Large builds are downloaded in segments of this many bytes, spread over
+# up to DEFAULT_CONNECTIONS connections, if the server supports range requests.
+SEGMENT_SIZE = 8 * 1024 * 1024
+DEFAULT_CONNECTIONS = 4
+
+# Builds are only unpacked while they download, before their hash is checked,
+# from URLs with these schemes. Over plain HTTP, the data could be tampered
+# with to attack the tarball extraction.
+PIPELINE_SCHEMES = {'https'}
+
+def _user_agent():
+    from . import __version__
+    return 'Batis/' + __version__
+
+class CorruptedDownload(ValueError):
+    def __str__(self):
+        return "Download was corrupted - hash didn't match"
+
+class ChunkStream(object):
+    """File-like object reading from an iterable of byte strings.
+
+    Data is added to hashobj as it is read.
+    """
+    def __init__(self, chunks, hashobj=None):
+        self.hashobj = hashobj
+        self.chunks = self._iter_chunks(chunks)
+        self.buffer = b''
+
+    def _iter_chunks(self, chunks):
+        for chunk in chunks:
+            if chunk:
+                self._received(chunk)
+                yield chunk
+
+    def _received(self, chunk):
+        if self.hashobj is not None:
+            self.hashobj.update(chunk)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.buffer + b''.join(self.chunks)
+            self.buffer = b''
+            return data
+
+        parts = [self.buffer]
+        buffered = len(self.buffer)
+        for chunk in self.chunks:
+            parts.append(chunk)
+            buffered += len(chunk)
+            if buffered >= size:
+                break
+        data = b''.join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def finish(self):
+        """Read the rest of the data, so hashobj covers all of it.
+
+        tarfile may stop reading before the end of the data, e.g. at the
+        padding after the end of the archive.
+        """
+        for chunk in self.chunks:
+            pass
+        self.buffer = b''
+
+def _is_transient(error):
+    """Is this an error where trying the download again might work?"""
+    if isinstance(error, requests.HTTPError):
+        return (error.response is not None) \
+                    and (error.response.status_code >= 500)
+    return isinstance(error, (requests.ConnectionError, requests.Timeout,
+                              requests.exceptions.ChunkedEncodingError,
+                              urllib3.exceptions.HTTPError))
+
+def _iter_raw(response):
+    """Iterate over the body of a response, as the data arrives.
+
+    Unlike iter_content(), with urllib3 2.x this doesn't lose data it has
+    already received if the connection is closed, so we can resume exactly
+    where it stopped.
+    """
+    raw = response.raw
+    read = getattr(raw, 'read1', raw.read)
+    while True:
+        chunk = read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+def _read_file_chunks(path, length):
+    with open(path, 'rb') as f:
+        while length > 0:
+            chunk = f.read(min(length, CHUNK_SIZE))
+            if not chunk:
+                raise IOError("Partial download %s is shorter than expected"
+                              % path)
+            length -= len(chunk)
+            yield chunk
+
+class DownloadStream(ChunkStream):
+    """Read a download as a file object, e.g. to unpack it as it arrives.
+
+    Received data is added to hashobj, reported to progress, and written to
+    the file copy_to if given, as it is read.
+
+    If the connection fails, the download is resumed from where it stopped
+    using an HTTP Range request, up to *retries* times in a row, waiting
+    longer after each failure. If copy_to is opened for appending and already
+    contains the start of the download, e.g. from an earlier attempt, that
+    data is read back from the file and only the rest is downloaded.
+
+    Requests are made with *session*, e.g. a :class:`requests.Session` shared
+    between threads, if given.
+    """
+    def __init__(self, url, progress=None, hashobj=None, copy_to=None,
+                 retries=DOWNLOAD_RETRIES, session=None):
+        if progress is None:
+            progress = NullProgress()
+        self.url = url
+        self.session = session if (session is not None) else requests
+        self.progress = progress
+        self.copy_to = copy_to
+        self.retries = retries
+
+        # Byte ranges refer to the encoded data, so don't let the server
+        # compress it on the fly.
+        self.headers = {'user-agent': _user_agent(),
+                        'accept-encoding': 'identity'}
+        # ETag or Last-Modified value to check that we resume the same file
+        self.validator = None
+        self.total = None
+
+        resume_from = copy_to.tell() if (copy_to is not None) else 0
+        failures = 0
+        while True:
+            try:
+                response, skip = self._open(resume_from)
+                break
+            except Exception as e:
+                failures += 1
+                if not self._wait_to_retry(failures, e):
+                    raise
+
+        # Start the progress tracker
+        progress.start(max_value=self.total)
+        self.recvd = 0
+
+        chunks = self._download_chunks(response, skip, resume_from)
+        if resume_from:
+            log.info('Resuming download after %s', format_size(resume_from))
+            chunks = chain(_read_file_chunks(copy_to.name, resume_from),
+                           chunks)
+        super(DownloadStream, self).__init__(chunks, hashobj)
+
+    def _open(self, start):
+        """Request the download from byte *start* onwards.
+
+        Returns the response, and the number of bytes at the start of it to
+        skip, in case the server sends more than we asked for.
+        """
+        headers = self.headers.copy()
+        if start:
+            headers['range'] = 'bytes=%d-' % start
+            if self.validator:
+                headers['if-range'] = self.validator
+        r = self.session.get(self.url, headers=headers, stream=True,
+                         timeout=TIMEOUT)
+        if r.status_code == 416:
+            # Range not satisfiable: get the whole file and skip to start.
+            r.close()
+            del headers['range']
+            r = self.session.get(self.url, headers=headers, stream=True,
+                             timeout=TIMEOUT)
+        r.raise_for_status()
+
+        if self.validator is None:
+            self.validator = r.headers.get('etag') \
+                                or r.headers.get('last-modified')
+
+        length = r.headers.get('content-length')
+        m = re.match(r'bytes (\d+)-\d+/(\d+|\*)',
+                     r.headers.get('content-range', ''))
+        if r.status_code == 206 and m and int(m.group(1)) <= start:
+            skip = start - int(m.group(1))
+            if m.group(2) != '*':
+                self.total = int(m.group(2))
+        else:
+            # The server sent the whole file
+            skip = start
+            if length is not None:
+                self.total = int(length)
+        return r, skip
+
+    def _wait_to_retry(self, failures, error):
+        """Sleep before retrying after an error, or return False to give up"""
+        if failures > self.retries or not _is_transient(error):
+            return False
+        delay = RETRY_BACKOFF * 2 ** (failures - 1)
+        log.warning('Download interrupted (%s); retrying in %g seconds',
+                    error, delay)
+        time.sleep(delay)
+        return True
+
+    def _download_chunks(self, response, skip, position):
+        failures = 0
+        while True:
+            try:
+                if response is None:
+                    response, skip = self._open(position)
+                for chunk in _iter_raw(response):
+                    if skip:
+                        n = min(skip, len(chunk))
+                        chunk = chunk[n:]
+                        skip -= n
+                        if not chunk:
+                            continue
+                    position += len(chunk)
+                    if self.copy_to is not None:
+                        self.copy_to.write(chunk)
+                    failures = 0
+                    yield chunk
+
+                if self.total is not None and position < self.total:
+                    raise requests.ConnectionError(
+                        'Connection closed after %d of %d bytes'
+                        % (position, self.total))
+                return
+            except Exception as e:
+                if response is not None:
+                    response.close()
+                    response = None
+                failures += 1
+                if not self._wait_to_retry(failures, e):
+                    if isinstance(e, urllib3.exceptions.HTTPError):
+                        # Raise the same errors as requests would
+                        raise requests.ConnectionError(e) from e
+                    raise
+
+    def _received(self, chunk):
+        super(DownloadStream, self)._received(chunk)
+        self.recvd += len(chunk)
+        try:
+            self.progress.update(self.recvd)
+        except ValueError:
+            # Probably the HTTP headers lied.
+            pass
+
+    def finish(self):
+        super(DownloadStream, self).finish()
+        self.progress.finish()
+
+def download(url, target, progress=None, hashobj=None, session=None):
     """Download a file using requests.
     
     This is like urllib.request.urlretrieve, but requests validates SSL
     certificates by default.
     """
-    if progress is None:
-        progress = NullProgress()
+    with open(target, 'wb') as f:
+        stream = DownloadStream(url, progress, hashobj, copy_to=f,
+                                session=session)
+        stream.finish()
 
-    from . import __version__
-    headers = {'user-agent': 'Batis/'+__version__}
-    r = requests.get(url, headers=headers, stream=True)
-    r.raise_for_status()
+def check_hash(hashobj, build):
+    if hashobj is not None:
+        if hashobj.hexdigest() != build['sha512']:
+            raise CorruptedDownload()
 
-    # Start the progress tracker
-    max_value = None
-    if 'content-length' in r.headers:
-        max_value = int(r.headers['content-length'])
-    progress.start(max_value=max_value)
-    recvd = 0
+def probe_size(url, session=None):
+    """Find the size of a download, if the server supports range requests.
 
-    with open(target, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
-                if hashobj is not None:
-                    hashobj.update(chunk)
-                recvd += len(chunk)
+    Returns None if it doesn't, or if the request fails.
+    """
+    if session is None:
+        session = requests
+    headers = {'user-agent': _user_agent(), 'accept-encoding': 'identity'}
+    try:
+        r = session.head(url, headers=headers, allow_redirects=True,
+                         timeout=TIMEOUT)
+    except requests.RequestException:
+        return None
+    length = r.headers.get('content-length', '')
+    if r.status_code != 200 or not length.isdigit() \
+            or r.headers.get('accept-ranges') != 'bytes':
+        return None
+    return int(length)
+
+class SegmentedDownload(object):
+    """Download a file as byte ranges over several connections at once.
+
+    The file is split into segments of SEGMENT_SIZE bytes, which *connections*
+    threads fetch in order, spread over the URLs given (the build URL and its
+    mirrors), and write into the file descriptor fd at their offsets. If a
+    request for a segment fails, it's resumed from another URL, up to
+    *retries* times in a row.
+
+    :meth:`chunks` yields the data in order, as soon as it's contiguous from
+    the start of the file, so it can be hashed and unpacked while the rest
+    downloads.
+    """
+    def __init__(self, urls, fd, total, progress=None, session=None,
+                 connections=DEFAULT_CONNECTIONS, retries=DOWNLOAD_RETRIES):
+        self.urls = urls
+        self.fd = fd
+        self.total = total
+        self.progress = progress if (progress is not None) else NullProgress()
+        self.session = session if (session is not None) else requests
+        self.retries = retries
+        self.headers = {'user-agent': _user_agent(),
+                        'accept-encoding': 'identity'}
+
+        self.starts = list(range(0, total, SEGMENT_SIZE))
+        self.written = [0] * len(self.starts)
+        self.todo = queue.Queue()
+        for i in range(len(self.starts)):
+            self.todo.put(i)
+        self.n_threads = min(connections, len(self.starts))
+
+        self.cond = threading.Condition()
+        self.recvd = 0
+        self.error = None
+        self.stopped = False
+
+    def _segment_end(self, i):
+        """The position after the last byte of segment i"""
+        return min(self.starts[i] + SEGMENT_SIZE, self.total)
+
+    def _worker(self, n):
+        try:
+            while not self.stopped:
                 try:
-                    progress.update(recvd)
-                except ValueError:
-                    # Probably the HTTP headers lied.
-                    pass
+                    i = self.todo.get_nowait()
+                except queue.Empty:
+                    return
+                self._fetch_segment(i, n)
+        except Exception as e:
+            with self.cond:
+                if self.error is None:
+                    self.error = e
+                self.cond.notify_all()
+
+    def _fetch_segment(self, i, n):
+        """Download segment i, starting with URL n (wrapping around)"""
+        pos, end = self.starts[i], self._segment_end(i)
+        failures = 0
+        while pos < end:
+            url = self.urls[(n + failures) % len(self.urls)]
+            headers = self.headers.copy()
+            headers['range'] = 'bytes=%d-%d' % (pos, end - 1)
+            response = None
+            try:
+                response = self.session.get(url, headers=headers, stream=True,
+                                            timeout=TIMEOUT)
+                response.raise_for_status()
+                m = re.match(r'bytes (\d+)-\d+/(\d+)',
+                             response.headers.get('content-range', ''))
+                if response.status_code != 206 or not m \
+                        or int(m.group(1)) != pos \
+                        or int(m.group(2)) != self.total:
+                    raise ValueError("%s didn't send the requested range "
+                                     "of %d bytes" % (url, self.total))
+
+                for chunk in _iter_raw(response):
+                    if self.stopped:
+                        return
+                    chunk = chunk[:end - pos]
+                    os.pwrite(self.fd, chunk, pos)
+                    pos += len(chunk)
+                    failures = 0
+                    with self.cond:
+                        self.written[i] += len(chunk)
+                        self.recvd += len(chunk)
+                        self.cond.notify_all()
+                    if pos >= end:
+                        break
+
+                if pos < end:
+                    raise requests.ConnectionError(
+                        'Connection closed after %d of %d bytes'
+                        % (pos - self.starts[i], end - self.starts[i]))
+            except Exception as e:
+                failures += 1
+                if failures > self.retries or self.stopped:
+                    if isinstance(e, urllib3.exceptions.HTTPError):
+                        raise requests.ConnectionError(e) from e
+                    raise
+                delay = RETRY_BACKOFF * 2 ** (failures - 1)
+                log.warning('Downloading from %s failed (%s); retrying in '
+                            '%g seconds', url, e, delay)
+                time.sleep(delay)
+            finally:
+                if response is not None:
+                    response.close()
+
+    def _available(self, i):
+        """Find how much data is ready, from the start of segment i.
+
+        Returns the index of the first incomplete segment, and the position
+        up to which the file is complete.
+        """
+        while i < len(self.starts) and \
+                self.starts[i] + self.written[i] >= self._segment_end(i):
+            i += 1
+        if i == len(self.starts):
+            return i, self.total
+        return i, self.starts[i] + self.written[i]
+
+    def chunks(self):
+        """Download the file, yielding its contents in order"""
+        self.progress.start(max_value=self.total)
+        threads = [threading.Thread(target=self._worker, args=(n,),
+                                    daemon=True)
+                   for n in range(self.n_threads)]
+        for t in threads:
+            t.start()
 
-    progress.finish()
+        try:
+            pos = seg = 0
+            while pos < self.total:
+                with self.cond:
+                    while True:
+                        if self.error is not None:
+                            raise self.error
+                        seg, ready = self._available(seg)
+                        if ready > pos:
+                            break
+                        self.cond.wait()
+                    recvd = self.recvd
+                self.progress.update(recvd)
+
+                while pos < ready:
+                    chunk = os.pread(self.fd, min(CHUNK_SIZE, ready - pos),
+                                     pos)
+                    pos += len(chunk)
+                    yield chunk
+        finally:
+            self.stopped = True
+            for t in threads:
+                t.join()
+
+        self.progress.finish()
+
+def _unpack_verified(stream, build, scheme):
+    """Unpack a tarball from a stream to a staging dir, checking its hash"""
+    hashobj = stream.hashobj
+    try:
+        ai = ApplicationInstaller(stream, scheme)
+    except Exception:
+        # Corrupted data can break unpacking: if so, say that's the problem.
+        if hashobj is not None:
+            try:
+                stream.finish()
+            except requests.RequestException:
+                pass
+            else:
+                check_hash(hashobj, build)
+        raise
+
+    try:
+        stream.finish()
+        check_hash(hashobj, build)
+    except:
+        ai.discard_staging()
+        raise
+    return ai
+
+def _unpack_file(path, build, scheme):
+    """Check the hash of a tarball on disk, then unpack it to a staging dir.
+
+    It's hashed and unpacked through one open file, so it can't be replaced
+    in between. If another user could change it, e.g. in a shared cache, it's
+    copied to a private temporary file as it's hashed, and unpacked from that.
+    """
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_uid == os.getuid() and not (st.st_mode & 0o022):
+            copy = None
+        else:
+            copy = TemporaryFile(prefix='batis-download-')
+        try:
+            hashobj = hashlib.sha512()
+            for chunk in iter(partial(f.read, CHUNK_SIZE), b''):
+                hashobj.update(chunk)
+                if copy is not None:
+                    copy.write(chunk)
+            check_hash(hashobj, build)
+
+            verified = f if (copy is None) else copy
+            verified.seek(0)
+            return ApplicationInstaller(verified, scheme)
+        finally:
+            if copy is not None:
+                copy.close()
+
+def _unpack_cached(build, scheme, cache):
+    cached = cache.get(build['sha512'])
+    if cached is None:
+        return None
+
+    log.info('Using cached download %s', compress_user(cached))
+    try:
+        return _unpack_file(cached, build, scheme)
+    except CorruptedDownload:
+        log.warning('Cached download was corrupted')
+        cache.remove(build['sha512'])
+        return None
+
+def _download_segmented(build, urls, total, scheme, progress, pipeline, cache,
+                        session, connections):
+    hashobj = hashlib.sha512() if ('sha512' in build) else None
+    # The segments arrive out of order, so they're written to a file, even
+    # when unpacking as we download. A partial segmented download can't be
+    # resumed, so it doesn't get the build's partial file in the cache.
+    if cache is not None:
+        f = cache.new_entry()
+    else:
+        f = NamedTemporaryFile(prefix='batis-download-', delete=False)
+    try:
+        f.truncate(total)
+        download = SegmentedDownload(urls, f.fileno(), total, progress,
+                                     session, connections)
+        stream = ChunkStream(download.chunks(), hashobj)
+        if pipeline:
+            ai = _unpack_verified(stream, build, scheme)
+        else:
+            stream.finish()
+            check_hash(hashobj, build)
+            ai = ApplicationInstaller(f.name, scheme)
+    except:
+        f.close()
+        os.unlink(f.name)
+        raise
+
+    if cache is not None:
+        cache.commit(f, build['sha512'])
+    else:
+        f.close()
+        os.unlink(f.name)
+    return ai
+
+def _download_build(build, urls, scheme, progress, pipeline, cache, session,
+                    connections=DEFAULT_CONNECTIONS):
+    if connections > 1 or len(urls) > 1:
+        total = probe_size(urls[0], session)
+        if total is not None and total > SEGMENT_SIZE:
+            return _download_segmented(build, urls, total, scheme, progress,
+                                       pipeline, cache, session, connections)
+
+    hashobj = hashlib.sha512() if ('sha512' in build) else None
+
+    if cache is None:
+        if pipeline:
+            stream = DownloadStream(urls[0], progress=progress,
+                                    hashobj=hashobj, session=session)
+            return _unpack_verified(stream, build, scheme)
+
+        td = mkdtemp()
+        try:
+            tarball = os.path.join(td, 'app.tar.gz')
+            download(urls[0], tarball, progress=progress,
+                     hashobj=hashobj, session=session)
+            check_hash(hashobj, build)
+            return ApplicationInstaller(tarball, scheme)
+        finally:
+            rmtree(td)
+
+    # Download into the cache. If this fails part way, the partial download
+    # is kept, and resumed next time.
+    f = cache.new_entry(build['sha512'])
+    if f.tell():
+        # The start comes from disk, so check it all before unpacking it
+        pipeline = False
+    try:
+        stream = DownloadStream(urls[0], progress=progress,
+                                hashobj=hashobj, copy_to=f, session=session)
+        if pipeline:
+            ai = _unpack_verified(stream, build, scheme)
+        else:
+            stream.finish()
+            f.flush()
+            ai = _unpack_file(f.name, build, scheme)
+    except CorruptedDownload:
+        cache.discard(f)
+        raise
+    except:
+        f.close()
+        raise
+
+    cache.commit(f, build['sha512'])
+    return ai
+
+def fetch_build(build, scheme, progress=None, pipeline=True, cache=None,
+                retries=HASH_RETRIES, session=None,
+                connections=DEFAULT_CONNECTIONS, mirror_ranking=None):
+    """Download a build, and unpack it into a staging directory.
+
+    With pipeline=True, the tarball is unpacked as it downloads over HTTPS,
+    without writing it to disk first. Either way, the hash is checked before
+    anything is installed, and the download is tried again up to *retries*
+    times if it doesn't match. If cache is a :class:`~.cache.DownloadCache`,
+    builds with a sha512 hash are looked up there first, and stored after
+    downloading. Data read back from the cache, including the start of a
+    download resumed from there, is always checked before it's unpacked.
+
+    Builds larger than SEGMENT_SIZE are downloaded in segments over up to
+    *connections* connections at once, spread across the build's URL and its
+    mirrors, if the server supports range requests. If the build has mirrors,
+    they're probed first, and it's downloaded from the fastest (see
+    :func:`.mirrors.rank_urls`, which uses *mirror_ranking*).
+
+    If the build has a 'delta' field and an older version is installed, only
+    the files which have changed are downloaded (see :mod:`.delta`), falling
+    back to the whole build if that fails.
+    Returns an :class:`ApplicationInstaller` ready to install it.
+    """
+    if ('sha512' not in build) and not all(
+            u.startswith('https:')
+            for u in [build['url']] + build.get('mirrors', [])):
+        raise KeyError("'sha512' field is required for HTTP downloads")
+
+    if ('sha512' not in build) or (cache is not None and not cache.enabled):
+        cache = None
+
+    if cache is not None:
+        ai = _unpack_cached(build, scheme, cache)
+        if ai is not None:
+            return ai
+
+    if 'delta' in build:
+        from .delta import fetch_delta
+        try:
+            ai = fetch_delta(build, scheme, session, connections)
+        except Exception as e:
+            log.warning('Downloading changed files failed (%s); '
+                        'downloading the whole build', e)
+        else:
+            if ai is not None:
+                return ai
+
+    urls = mirrors.rank_urls([build['url']] + build.get('mirrors', []),
+                             session, mirror_ranking)
+    if urls[0] != build['url']:
+        log.info('Downloading from mirror %s', urlparse(urls[0]).netloc)
+    if pipeline and any(urlparse(u).scheme not in PIPELINE_SCHEMES
+                        for u in urls):
+        log.debug('Not unpacking an unencrypted download before checking it')
+        pipeline = False
+
+    attempt = 0
+    while True:
+        try:
+            return _download_build(build, urls, scheme, progress, pipeline,
+                                   cache, session, connections)
+        except CorruptedDownload:
+            attempt += 1
+            if attempt > retries:
+                raise
+            log.warning('Download was corrupted; trying again (%d of %d)',
+                        attempt, retries)
 
 def prepare_index_url(url):
     if '//' not in url:
@@ -81,50 +737,150 @@ def prepare_index_url(url):
 
     return urlunparse(('https',) + parsed[1:])
 
-def install(url, scheme, confirm=False, backend=False):
-    url = prepare_index_url(url)
-    r = requests.get(url)
-    index = r.json()
-    
-    if index['format_version'][0] > INDEX_FORMAT_MAJOR:
-        raise FutureIndexFormat(index['format_version'][0])
-
-    print('Installing from', urlparse(url).netloc, ':')
-    print('--', index['name'], '--')
-    print(index['byline'])
-    print()
-    if confirm:
-        res = input('Continue installation? [y]/n >')
-        if res and (res[0].lower() != 'y'):
-            print('Not installing')
-            return
-    
-    build = select_build.select_latest(
-                select_build.filter_eligible(index['builds']))
-    
-    if 'sha512' in build:
-        hashobj = hashlib.sha512()
-    elif not build['url'].startswith('https:'):
-        raise KeyError("'sha512' field is required for HTTP downloads")
-    else:
-        hashobj = None
+def fetch_index(url, cache=None, session=None):
+    """Download and parse an index file.
 
-    td = mkdtemp()
-    tarball = os.path.join(td, 'app.tar.gz')
-    
-    from progressbar import DataTransferBar
-    try:
-        download(build['url'], tarball, progress=DataTransferBar(),
-                 hashobj=hashobj)
-        if hashobj is not None:
-            if hashobj.hexdigest() != build['sha512']:
-                # TODO: Automatic retrying?
-                raise ValueError("Download was corrupted - hash didn't match")
-        ai = ApplicationInstaller(tarball, scheme)
-        ai.install(backend=backend)
-    finally:
-        rmtree(td)
+    If cache is an :class:`~.cache.IndexCache`, the request is conditional
+    on the index having changed since it was cached, and the cached copy is
+    used if the server says it hasn't. Indexes may be served gzipped, either
+    with Content-Encoding or as a .json.gz file.
+    """
+    headers = {'user-agent': _user_agent()}
+    cached = cache.get(url) if (cache is not None) else None
+    if cached is not None:
+        if cached['etag']:
+            headers['if-none-match'] = cached['etag']
+        if cached['last_modified']:
+            headers['if-modified-since'] = cached['last_modified']
+
+    if session is None:
+        session = requests
+    r = session.get(url, headers=headers, timeout=TIMEOUT)
+    if r.status_code == 304 and cached is not None:
+        log.debug('Index at %s has not changed', url)
+        return cached['index']
+    r.raise_for_status()
+
+    body = r.content
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    index = json.loads(body.decode('utf-8'))
+
+    etag = r.headers.get('etag')
+    last_modified = r.headers.get('last-modified')
+    if cache is not None and (etag or last_modified):
+        cache.store(url, index, etag, last_modified)
+    return index
+
+def make_session(pool_size):
+    """Make a requests session which can share connections between threads"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def install_many(urls, scheme, confirm=False, backend=False, pipeline=True,
+                 cache=None, index_cache=None, jobs=DEFAULT_JOBS,
+                 connections=DEFAULT_CONNECTIONS, mirror_ranking=None,
+                 in_place=False, defer_triggers=False, reinstall=False):
+    """Install applications from one or more index URLs.
+
+    The index files and then the builds are downloaded concurrently, up to
+    *jobs* at a time, sharing a pool of connections. Each build may use up to
+    *connections* connections itself (see :func:`fetch_build`). Each
+    application is installed once its download is ready, one at a time, in
+    the order given. The desktop, mime type and icon caches are updated once
+    at the end, or saved for ``batis run-triggers`` if defer_triggers is True.
+
+    Builds with a hash which are already installed and intact are skipped,
+    unless reinstall is True.
+
+    If installing from a single URL fails, the error is raised. With several
+    URLs, errors are logged, and the URLs which failed are returned.
+    """
+    urls = [prepare_index_url(url) for url in urls]
+    failed = []
+    def failure(url, e):
+        if len(urls) == 1:
+            raise e
+        log.error('Installing from %s failed: %s', url, e)
+        failed.append(url)
+
+    session = make_session(jobs * max(connections, 1))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        index_futures = [executor.submit(fetch_index, url, index_cache,
+                                         session) for url in urls]
+        builds = []
+        for url, future in zip(urls, index_futures):
+            try:
+                index = future.result()
+                if index['format_version'][0] > INDEX_FORMAT_MAJOR:
+                    raise FutureIndexFormat(index['format_version'][0])
+                build = select_build.select_latest(
+                            select_build.filter_eligible(index['builds']))
+            except Exception as e:
+                failure(url, e)
+                continue
+
+            print('Installing from', urlparse(url).netloc, ':')
+            print('--', index['name'], '--')
+            print(index['byline'])
+            print()
+
+            existing = None
+            if 'sha512' in build and not reinstall:
+                existing = find_installed_build(scheme, build['sha512'])
+            if existing is not None:
+                print('Version', build['version'], 'is already installed at',
+                      compress_user(existing))
+                if backend:
+                    print('finished')
+                continue
+            builds.append((url, build))
+
+        if confirm and builds:
+            res = input('Continue installation? [y]/n >')
+            if res and (res[0].lower() != 'y'):
+                print('Not installing')
+                return failed
+
+        if len(builds) == 1:
+            from progressbar import DataTransferBar
+            progress = DataTransferBar()
+        else:
+            # Several progress bars at once would garble the terminal
+            progress = None
+
+        fetch_futures = [executor.submit(fetch_build, build, scheme, progress,
+                                         pipeline, cache, session=session,
+                                         connections=connections,
+                                         mirror_ranking=mirror_ranking)
+                         for (url, build) in builds]
+        triggers = TriggerQueue(scheme, defer=defer_triggers)
+        try:
+            for (url, build), future in zip(builds, fetch_futures):
+                try:
+                    ai = future.result()
+                    ai.source_sha512 = build.get('sha512')
+                    ai.version = build.get('version', ai.version)
+                    ai.install(backend=backend, in_place=in_place,
+                               triggers=triggers)
+                except Exception as e:
+                    failure(url, e)
+        finally:
+            triggers.finish()
+
+    return failed
 
+def install(url, scheme, confirm=False, backend=False, pipeline=True,
+            cache=None, index_cache=None, in_place=False,
+            defer_triggers=False, reinstall=False):
+    install_many([url], scheme, confirm=confirm, backend=backend,
+                 pipeline=pipeline, cache=cache, index_cache=index_cache,
+                 in_place=in_place, defer_triggers=defer_triggers,
+                 reinstall=reinstall)
 
 def main(argv=None):
     ap = argparse.ArgumentParser(prog='batis install')
@@ -134,7 +890,27 @@ def main(argv=None):
             help=argparse.SUPPRESS)
     ap.add_argument('--system', action='store_true',
             help='Install systemwide, instead of for the user')
-    ap.add_argument('url', help='The URL from which to install')
+    ap.add_argument('--download-first', action='store_true',
+            help='Download the whole tarball before unpacking it')
+    ap.add_argument('--no-cache', action='store_true',
+            help="Don't use or store downloads and index files in the cache")
+    ap.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+            help='How many applications to download at once (default: %d)'
+                 % DEFAULT_JOBS)
+    ap.add_argument('--in-place', action='store_true',
+            help='Upgrade installed versions by changing only the files '
+                 'which differ')
+    ap.add_argument('--defer-triggers', action='store_true',
+            help="Don't update desktop, mime type and icon caches until "
+                 "'batis run-triggers' is run")
+    ap.add_argument('--reinstall', action='store_true',
+            help='Install the latest build even if it is already installed')
+    ap.add_argument('--connections', type=int, default=DEFAULT_CONNECTIONS,
+            help='How many connections to download each large build over '
+                 '(default: %d)' % DEFAULT_CONNECTIONS)
+    ap.add_argument('url', nargs='+',
+            help='The URL from which to install. Give several URLs to '
+                 'install multiple applications.')
     args = ap.parse_args(argv)
     
     enable_colourful_output(level=logging.INFO)
@@ -143,7 +919,20 @@ def main(argv=None):
 
     try:
         scheme = get_install_scheme('system' if args.system else 'user')
-        install(args.url, scheme, confirm=args.confirm)
+        if args.no_cache:
+            cache = index_cache = mirror_ranking = None
+        else:
+            cache, index_cache = DownloadCache(), IndexCache()
+            mirror_ranking = mirrors.MirrorRanking()
+        failed = install_many(args.url, scheme, confirm=args.confirm,
+                    pipeline=(not args.download_first), cache=cache,
+                    index_cache=index_cache, jobs=max(args.jobs, 1),
+                    connections=max(args.connections, 1),
+                    mirror_ranking=mirror_ranking, in_place=args.in_place,
+                    defer_triggers=args.defer_triggers,
+                    reinstall=args.reinstall)
+        if failed:
+            exitcode = 1
     except:
         import traceback
         traceback.print_exc()
@@ -1,3 +1,5 @@
+import ctypes
+import errno
 import os
 import sys
 
@@ -73,3 +75,58 @@ def compress_user(p):
     if p.startswith(_home):
         return '~' + p[len(_home):]
     return p
+
+def format_size(n):
+    """Format a number of bytes for people to read, e.g. '3.2 MiB'"""
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if n < 1024 or unit == 'GiB':
+            break
+        n /= 1024.
+    if unit == 'bytes':
+        return '%d bytes' % n
+    return '%.1f %s' % (n, unit)
+
+def parse_size(s):
+    """Parse a size like '500M' or '2G' into a number of bytes"""
+    s = s.strip().upper().rstrip('IB')
+    multiplier = 1
+    for i, unit in enumerate('KMGT', start=1):
+        if s.endswith(unit):
+            multiplier = 1024 ** i
+            s = s[:-1]
+            break
+    return int(float(s) * multiplier)
+
+# Flag for the Linux renameat2() system call, and the 'current directory'
+# file descriptor to use with it.
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+def _renameat2():
+    try:
+        return ctypes.CDLL(None, use_errno=True).renameat2
+    except (AttributeError, OSError):
+        # Not Linux, or glibc older than 2.28
+        return None
+
+def exchange_paths(a, b):
+    """Atomically swap two paths, e.g. two directories.
+
+    This uses renameat2() with RENAME_EXCHANGE, so there's no moment when
+    either path is missing. Returns False if the system or filesystem doesn't
+    support it.
+    """
+    renameat2 = _renameat2()
+    if renameat2 is None:
+        return False
+    fsencoding = sys.getfilesystemencoding()
+    if not isinstance(a, bytes):
+        a = a.encode(fsencoding)
+    if not isinstance(b, bytes):
+        b = b.encode(fsencoding)
+    if renameat2(AT_FDCWD, a, AT_FDCWD, b, RENAME_EXCHANGE) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            return False
+        raise OSError(err, os.strerror(err), a)
+    return True
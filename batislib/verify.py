@@ -2,9 +2,9 @@ import argparse
 import json
 import os
 import re
-import tarfile
 from xml.etree import ElementTree
 import sys
+from .compression import is_tarball
 from .tarball import unpack_app_tarball
 
 from xdg.DesktopEntry import DesktopEntry
@@ -259,8 +259,8 @@ class UnpackedDirVerifier(object):
         return problems
 
 def verify_tarball(path):
-    if not tarfile.is_tarfile(path):
-        return ['%s is not a tar file']
+    if not is_tarball(path):
+        return ['%s is not a tar file' % path]
     return UnpackedDirVerifier(unpack_app_tarball(path)).verify()
 
 def verify_tarball_or_directory(path):
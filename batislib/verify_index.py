@@ -3,15 +3,15 @@ import argparse
 import json
 import os.path
 import re
-import requests
 
-from .urlinstall import prepare_index_url
+from .cache import IndexCache
+from .urlinstall import fetch_index, prepare_index_url
 
 def load_index(path_or_url):
     if path_or_url.startswith(('http://', 'https://')) \
             or not os.path.isfile(path_or_url):
         url = prepare_index_url(path_or_url)
-        return requests.get(url).json()
+        return fetch_index(url, cache=IndexCache())
     else:
         with open(path_or_url) as f:
             return json.load(f)
@@ -92,7 +92,24 @@ class IndexVerifier:
                 pa("Build must have 'sha512' field with http:// URL")
         else:
             pa("Build is missing 'url' field")
-        
+
+        if 'mirrors' in b:
+            mirrors = b['mirrors']
+            if not isinstance(mirrors, list) \
+                    or not all(isinstance(m, str) for m in mirrors):
+                pa("Build 'mirrors' field should be a list of URL strings")
+            else:
+                for m in mirrors:
+                    if not m.startswith(('http://', 'https://')):
+                        pa("Mirror URL should start with 'https://' or "
+                           "'http://': {!r}".format(m))
+                    elif m.startswith('http://') and 'sha512' not in b:
+                        pa("Build must have 'sha512' field with http:// "
+                           "mirror URL {!r}".format(m))
+
+        if 'delta' in b:
+            self.verify_delta_json(b['delta'], problems)
+
         if 'sha512' in b:
             if not isinstance(b['sha512'], str):
                 pa("build 'sha512' field should be a string, not {}"
@@ -122,6 +139,28 @@ class IndexVerifier:
                         .format(field))
         
 
+    def verify_delta_json(self, delta, problems):
+        pa = problems.append
+        if not isinstance(delta, dict):
+            pa("Build 'delta' field should be an object - found {}"
+                .format(type(delta)))
+            return
+
+        for field in ('url', 'manifest_url'):
+            if not isinstance(delta.get(field), str):
+                pa("Build 'delta' field must have a '{}' string".format(field))
+            elif not delta[field].startswith(('http://', 'https://')):
+                pa("Delta {} should start with 'https://' or 'http://'"
+                    .format(field))
+
+        if 'manifest_sha512' in delta:
+            if not isinstance(delta['manifest_sha512'], str) \
+                    or len(delta['manifest_sha512']) != 128:
+                pa("Delta 'manifest_sha512' should be a 128 character string")
+        elif str(delta.get('manifest_url')).startswith('http://'):
+            pa("Delta must have 'manifest_sha512' field with http:// "
+               "manifest_url")
+
     def verify(self):
         problems = []
         self.verify_json(problems)
@@ -0,0 +1,46 @@
+import os
+import testpath
+from testpath.tempdir import TemporaryDirectory
+
+from batislib import cache
+
+pjoin = os.path.join
+
+def _add(dc, sha512, size, last_used):
+    f = dc.new_entry()
+    f.write(b'x' * size)
+    dc.commit(f, sha512)
+    os.utime(dc.get(sha512), (last_used, last_used))
+
+def test_lru_prune():
+    with TemporaryDirectory() as td:
+        dc = cache.DownloadCache(td, max_size=250)
+        _add(dc, 'aa', 100, 1000)
+        _add(dc, 'bb', 100, 2000)
+        assert [e[0] for e in dc.entries()] == ['aa', 'bb']
+
+        # Using 'aa' makes 'bb' the least recently used
+        assert dc.get('aa') is not None
+        assert [e[0] for e in dc.entries()] == ['bb', 'aa']
+
+        _add(dc, 'cc', 100, 3000)
+        assert dc.get('bb') is None
+        assert sorted(e[0] for e in dc.entries()) == ['aa', 'cc']
+
+        assert sorted(dc.prune(0)) == ['aa', 'cc']
+        assert dc.entries() == []
+
+def test_discard():
+    with TemporaryDirectory() as td:
+        dc = cache.DownloadCache(td)
+        f = dc.new_entry()
+        f.write(b'partial')
+        dc.discard(f)
+        assert os.listdir(pjoin(td, 'downloads')) == []
+
+def test_config_from_env():
+    with testpath.modified_env({'BATIS_CACHE_DIR': '/srv/batis-cache',
+                                'BATIS_CACHE_SIZE': '10G'}):
+        dc = cache.DownloadCache()
+    assert dc.directory == '/srv/batis-cache/downloads'
+    assert dc.max_size == 10 * 1024 ** 3
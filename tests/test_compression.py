@@ -0,0 +1,34 @@
+import gzip
+import io
+import random
+
+from batislib import compression
+
+def test_parallel_gzip_roundtrip():
+    rng = random.Random(42)
+    words = [b'batis', b'install', b'application', b'tarball', b'\x00' * 20]
+    data = b' '.join(rng.choice(words) for _ in range(50000))
+
+    buf = io.BytesIO()
+    w = compression.ParallelGzipWriter(buf, jobs=4, blocksize=10000)
+    for i in range(0, len(data), 3000):
+        w.write(data[i:i+3000])
+    w.close()
+
+    assert gzip.decompress(buf.getvalue()) == data
+    # Back-references across blocks should keep it much smaller than the input
+    assert len(buf.getvalue()) < len(data) / 4
+
+def test_parallel_gzip_empty():
+    buf = io.BytesIO()
+    w = compression.ParallelGzipWriter(buf, jobs=2)
+    w.close()
+    assert gzip.decompress(buf.getvalue()) == b''
+
+def test_detect_codec():
+    assert compression.detect_codec(gzip.compress(b'foo')) == 'gz'
+    assert compression.detect_codec(b'\xfd7zXZ\x00\x00\x04') == 'xz'
+    assert compression.detect_codec(b'\x28\xb5\x2f\xfd\x04') == 'zst'
+    assert compression.detect_codec(b'BZh91AY&SY') == 'bz2'
+    assert compression.detect_codec(b'sampleapp/\x00\x00\x00') == 'none'
+    assert compression.detect_codec(b'') == 'none'
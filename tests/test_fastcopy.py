@@ -0,0 +1,75 @@
+import errno
+import os
+from os.path import join as pjoin
+import stat
+import pytest
+from testpath import assert_isfile
+from testpath.tempdir import TemporaryDirectory
+
+from batislib import fastcopy
+
+def _write(path, contents, mode=0o644):
+    with open(path, 'w') as f:
+        f.write(contents)
+    os.chmod(path, mode)
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def _unsupported(*args):
+    raise OSError(errno.EOPNOTSUPP, 'Not supported')
+
+@pytest.mark.parametrize('broken', [
+    [],
+    ['ioctl'],
+    ['ioctl', 'copy_file_range'],
+    ['ioctl', 'copy_file_range', 'sendfile'],
+])
+def test_copy_fallbacks(monkeypatch, broken):
+    if 'ioctl' in broken:
+        monkeypatch.setattr(fastcopy.fcntl, 'ioctl', _unsupported)
+    for name in ('copy_file_range', 'sendfile'):
+        if name in broken and hasattr(os, name):
+            monkeypatch.setattr(os, name, _unsupported)
+
+    with TemporaryDirectory() as td:
+        src, dst = pjoin(td, 'src'), pjoin(td, 'dst')
+        contents = 'abcdefgh' * 300000  # Bigger than one chunk
+        _write(src, contents, 0o755)
+        fastcopy.copy(src, dst)
+        assert _read(dst) == contents
+        assert stat.S_IMODE(os.stat(dst).st_mode) == 0o755
+        assert os.stat(dst).st_ino != os.stat(src).st_ino
+
+def test_hardlink():
+    with TemporaryDirectory() as td:
+        src, dst = pjoin(td, 'src'), pjoin(td, 'dst')
+        _write(src, 'hello')
+        fastcopy.copy2(src, dst, hardlink=True)
+        assert os.stat(dst).st_ino == os.stat(src).st_ino
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_copytree(jobs):
+    with TemporaryDirectory() as td:
+        src = pjoin(td, 'src')
+        os.makedirs(pjoin(src, 'a', 'b'))
+        _write(pjoin(src, 'top.txt'), 'top')
+        _write(pjoin(src, 'a', 'b', 'deep.sh'), 'deep', 0o755)
+        os.symlink('../top.txt', pjoin(src, 'a', 'link'))
+        os.chmod(pjoin(src, 'a'), 0o555)
+
+        try:
+            fastcopy.copytree(src, pjoin(td, 'dst'), jobs=jobs)
+            dst = pjoin(td, 'dst')
+            assert _read(pjoin(dst, 'a', 'b', 'deep.sh')) == 'deep'
+            assert stat.S_IMODE(os.stat(pjoin(dst, 'a', 'b', 'deep.sh'))
+                                .st_mode) == 0o755
+            # Like shutil.copytree(), symlinks are followed
+            assert_isfile(pjoin(dst, 'a', 'link'))
+            assert _read(pjoin(dst, 'a', 'link')) == 'top'
+            assert stat.S_IMODE(os.stat(pjoin(dst, 'a')).st_mode) == 0o555
+        finally:
+            os.chmod(pjoin(src, 'a'), 0o755)
+            if os.path.isdir(pjoin(td, 'dst', 'a')):
+                os.chmod(pjoin(td, 'dst', 'a'), 0o755)
@@ -1,5 +1,6 @@
 import json
 import os
+import shutil
 from os.path import dirname, join as pjoin
 import testpath
 from testpath.tempdir import TemporaryDirectory
@@ -10,10 +11,22 @@ try:
 except ImportError:
     import mock  # Python 2
 
-from batislib import install
+from batislib import install, tarball
+from .util import InstallTestCase
 
 batis_root = dirname(dirname(__file__))
 
+class _Output(object):
+    """Collect what is printed"""
+    def __init__(self):
+        self.parts = []
+
+    def write(self, s):
+        self.parts.append(s)
+
+    def flush(self):
+        pass
+
 class InstallerTests(TestCase):
     def setUp(self):
         sampleapp = pjoin(batis_root, 'sampleapp')
@@ -30,6 +43,18 @@ class InstallerTests(TestCase):
         testpath.assert_isdir(d)
         testpath.assert_isfile(pjoin(d, 'run.sh'))
 
+    def test_copy_application_jobs(self):
+        sampleapp = pjoin(batis_root, 'sampleapp')
+        installer = install.ApplicationInstaller(sampleapp,
+                        install.get_install_scheme('user'), jobs=4)
+        installer.copy_application()
+        d = pjoin(self.td, 'installed-applications', 'sampleapp')
+        for dirpath, dirnames, filenames in os.walk(sampleapp):
+            for f in filenames:
+                relpath = os.path.relpath(pjoin(dirpath, f), sampleapp)
+                testpath.assert_isfile(pjoin(d, relpath))
+        assert os.access(pjoin(d, 'run.sh'), os.X_OK)
+
     def test_install_system_packages(self):
         with testpath.assert_calls('sudo', ['apt-get', '--yes', 'install',
                                             'python3', 'python3-pyqt4']):
@@ -76,8 +101,38 @@ class InstallerTests(TestCase):
         
         testpath.assert_path_exists(foobar_script)
         self.installer.copy_application()
+        self.installer.remove_stale_files()
         testpath.assert_not_path_exists(foobar_script)
 
+    def test_install_backend_steps(self):
+        installer = self.installer
+        installer.scheme['commands'] = pjoin(self.td, 'bin')
+        installer.install_system_packages = lambda backend: 'no distro match'
+        output = _Output()
+        with mock.patch('batislib.triggers.call'), \
+                mock.patch('sys.stdout', output):
+            installer.install(backend=True)
+        assert ''.join(output.parts).splitlines() == [
+            'step: system_packages',
+            'problem: system_packages: no distro match',
+            'step: copy_dir',
+            'step: install_commands',
+            'step: install_icons',
+            'step: install_mimetypes',
+            'step: install_desktop',
+            'step: write_manifest',
+            'finished',
+        ]
+        appdir = pjoin(self.td, 'installed-applications', 'sampleapp')
+        manifest = install.load_installed_files(appdir)
+        paths = [i['path'] for i in manifest['files']]
+        assert paths == sorted(paths)
+        assert pjoin(self.td, 'bin', 'launch-sampleapp') in paths
+
+        # Older versions of Batis expect a list of files in this file
+        with open(pjoin(appdir, install.INSTALLED_FILES)) as f:
+            assert [i['path'] for i in json.load(f)] == paths
+
     def test_ensure_path_env(self):
         def mock_expanduser(p):
             return p.replace('~', self.td)
@@ -93,3 +148,153 @@ class InstallerTests(TestCase):
         with open(profile_file, 'r') as f:
             contents = f.read()
         assert self.installer.scheme['commands']+':$PATH' in contents
+
+class TarballInstallerTests(InstallTestCase):
+    def setUp(self):
+        super(TarballInstallerTests, self).setUp()
+        self.tarball = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                            pjoin(self.td, 'sampleapp.app.tar.gz'),
+                            install_script=False)
+
+    def test_unpack_to_staging(self):
+        installer = install.ApplicationInstaller(self.tarball, self.scheme)
+        appsdir = pjoin(self.td, 'installed-applications')
+        assert installer.directory.startswith(installer.staging_dir)
+        assert os.path.dirname(installer.staging_dir) == appsdir
+
+        installer.copy_application()
+        d = pjoin(appsdir, 'sampleapp')
+        testpath.assert_isfile(pjoin(d, 'run.sh'))
+        assert installer.directory == d
+        assert os.listdir(appsdir) == ['sampleapp']
+
+    def _replace_installed(self):
+        appsdir = pjoin(self.td, 'installed-applications')
+        install.ApplicationInstaller(self.tarball, self.scheme) \
+            .copy_application()
+        with open(pjoin(appsdir, 'sampleapp', 'old_file'), 'w'):
+            pass
+
+        installer = install.ApplicationInstaller(self.tarball, self.scheme)
+        installer.copy_application()
+        installer.cleanup_thread.join()
+        d = pjoin(appsdir, 'sampleapp')
+        testpath.assert_isfile(pjoin(d, 'run.sh'))
+        testpath.assert_not_path_exists(pjoin(d, 'old_file'))
+        assert os.listdir(appsdir) == ['sampleapp']
+
+    def test_unpack_jobs_default(self):
+        with mock.patch('batislib.install.cpu_count', return_value=64), \
+                mock.patch('batislib.tarball.unpack_app_tarball',
+                           wraps=tarball.unpack_app_tarball) as unpack:
+            installer = install.ApplicationInstaller(self.tarball,
+                                                     self.scheme)
+        assert installer.jobs == install.MAX_DEFAULT_JOBS
+        assert unpack.call_args[0][2] == install.MAX_DEFAULT_JOBS
+        installer.discard_staging()
+
+    def test_installtar_already_installed(self):
+        with mock.patch('batislib.install.get_install_scheme',
+                        return_value=self.scheme), \
+                mock.patch.object(install.ApplicationInstaller,
+                                  'install_system_packages'):
+            install.main([self.tarball])
+            appdir = pjoin(self.td, 'installed-applications', 'sampleapp')
+            manifest = install.load_installed_files(appdir)
+            assert manifest['source_sha512'] == \
+                install.file_sha512(self.tarball)
+
+            with mock.patch('batislib.install.ApplicationInstaller') as ai:
+                install.main([self.tarball])
+            assert ai.call_count == 0
+
+    def test_replace_atomically(self):
+        with mock.patch('batislib.install.exchange_paths',
+                        wraps=install.exchange_paths) as exchange:
+            self._replace_installed()
+        assert exchange.call_count == 1
+
+    def test_replace_without_exchange(self):
+        with mock.patch('batislib.install.exchange_paths',
+                        return_value=False):
+            self._replace_installed()
+
+
+class InPlaceUpgradeTests(InstallTestCase):
+    def setUp(self):
+        super(InPlaceUpgradeTests, self).setUp()
+        self.appdir = pjoin(self.td, 'installed-applications', 'sampleapp')
+
+        self.v1 = pjoin(self.td, 'v1', 'sampleapp')
+        shutil.copytree(pjoin(batis_root, 'sampleapp'), self.v1)
+        self.install_steps(install.ApplicationInstaller(self.v1, self.scheme))
+
+    def install_steps(self, installer, in_place=False):
+        installer.copy_application(in_place)
+        installer.install_commands()
+        installer.install_icons()
+        installer.install_mimetypes()
+        installer.install_desktop_files()
+        installer.remove_stale_files()
+        installer.write_manifest()
+        installer.triggers.finish()
+
+    def test_upgrade_in_place(self):
+        v2 = pjoin(self.td, 'v2', 'sampleapp')
+        shutil.copytree(self.v1, v2)
+        with open(pjoin(v2, 'run.sh'), 'a') as f:
+            f.write('echo version 2\n')
+        os.unlink(pjoin(v2, 'batis_info', 'desktop', 'fooview.desktop'))
+
+        metadata_ino = os.stat(pjoin(self.appdir, 'batis_info',
+                                     'metadata.json')).st_ino
+        with mock.patch('batislib.triggers.call') as call:
+            self.install_steps(install.ApplicationInstaller(v2, self.scheme),
+                               in_place=True)
+
+        with open(pjoin(self.appdir, 'run.sh')) as f:
+            assert f.read().endswith('echo version 2\n')
+        # Unchanged files are left alone
+        assert os.stat(pjoin(self.appdir, 'batis_info',
+                             'metadata.json')).st_ino == metadata_ino
+        testpath.assert_islink(pjoin(self.td, 'bin', 'launch-sampleapp'))
+
+        # Only the desktop files changed, so only their trigger runs
+        desktop_dir = pjoin(self.td, 'applications')
+        testpath.assert_not_path_exists(pjoin(desktop_dir, 'fooview.desktop'))
+        testpath.assert_isfile(pjoin(desktop_dir,
+                                     'script_in_install_dir.desktop'))
+        call.assert_called_once_with(['update-desktop-database', desktop_dir])
+
+        manifest = install.load_installed_files(self.appdir)
+        installed = set(i['path'] for i in manifest['files'])
+        assert pjoin(desktop_dir, 'fooview.desktop') not in installed
+        assert pjoin(desktop_dir, 'script_in_install_dir.desktop') in installed
+
+    def test_reinstall_unchanged(self):
+        mime_file = pjoin(self.td, 'mime', 'packages', 'example-diff.xml')
+        mime_ino = os.stat(mime_file).st_ino
+        with mock.patch('batislib.triggers.call') as call:
+            self.install_steps(install.ApplicationInstaller(self.v1,
+                                                            self.scheme))
+        # The exported files match the hashes in the manifest, so they're
+        # not written again, and no caches need updating.
+        assert os.stat(mime_file).st_ino == mime_ino
+        assert call.call_count == 0
+
+        manifest = install.load_installed_files(self.appdir)
+        installed = {i['path']: i for i in manifest['files']}
+        assert installed[mime_file]['sha256'] == tarball.hash_file(mime_file)
+        assert installed[mime_file]['size'] == os.path.getsize(mime_file)
+
+    def test_reinstall_modified(self):
+        mime_file = pjoin(self.td, 'mime', 'packages', 'example-diff.xml')
+        with open(mime_file, 'a') as f:
+            f.write('<!-- edited -->')
+        with mock.patch('batislib.triggers.call') as call:
+            self.install_steps(install.ApplicationInstaller(self.v1,
+                                                            self.scheme))
+        with open(mime_file) as f:
+            assert 'edited' not in f.read()
+        call.assert_called_once_with(['update-mime-database',
+                                      pjoin(self.td, 'mime')])
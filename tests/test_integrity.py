@@ -0,0 +1,85 @@
+import io
+import os
+
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock  # Python 2
+
+from batislib import install, integrity, tarball
+from .util import InstallTestCase, batis_root
+
+pjoin = os.path.join
+
+class VerifyInstalledTests(InstallTestCase):
+    def setUp(self):
+        super(VerifyInstalledTests, self).setUp()
+        self.appdir = pjoin(self.scheme['application'], 'sampleapp')
+
+    def install(self, path):
+        self.install_app(path, jobs=4)
+
+    def verify(self, quick=False):
+        manifest = install.load_installed_files(self.appdir)
+        return integrity.verify_application(self.appdir, manifest, quick)
+
+    def test_manifest(self):
+        self.install(pjoin(batis_root, 'sampleapp'))
+        manifest = install.load_installed_files(self.appdir)
+        run_sh = manifest['app_files']['run.sh']
+        assert run_sh['sha256'] == tarball.hash_file(pjoin(self.appdir,
+                                                           'run.sh'))
+        assert run_sh['size'] == os.path.getsize(pjoin(self.appdir, 'run.sh'))
+        assert run_sh['mode'] & 0o100
+        assert install.INSTALLED_FILES not in manifest['app_files']
+        assert install.INSTALLED_FILES_META not in manifest['app_files']
+
+        command = [i for i in manifest['files'] if i['type'] == 'symlink'][0]
+        assert command['target'] == pjoin(self.appdir, 'run.sh')
+
+    def test_unchanged(self):
+        packed = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                                      pjoin(self.td, 'sampleapp.app.tar.gz'),
+                                      install_script=False)
+        self.install(packed)
+        assert self.verify() == []
+        assert self.verify(quick=True) == []
+
+    def test_problems(self):
+        self.install(pjoin(batis_root, 'sampleapp'))
+        mime_file = pjoin(self.td, 'mime', 'packages', 'example-diff.xml')
+        with open(mime_file, 'a') as f:
+            f.write('<!-- edited -->')
+        # Same size and time, but different contents
+        run_sh = pjoin(self.appdir, 'run.sh')
+        st = os.stat(run_sh)
+        with open(run_sh, 'r+') as f:
+            f.write('X')
+        os.utime(run_sh, (st.st_atime, st.st_mtime))
+        os.unlink(pjoin(self.appdir, 'batis_info', 'metadata.json'))
+        os.unlink(pjoin(self.td, 'bin', 'launch-sampleapp'))
+        with open(pjoin(self.appdir, 'new_file'), 'w'):
+            pass
+
+        assert self.verify() == [
+            ('extra', pjoin(self.appdir, 'new_file')),
+            ('missing', pjoin(self.td, 'bin', 'launch-sampleapp')),
+            ('missing', pjoin(self.appdir, 'batis_info', 'metadata.json')),
+            ('modified', run_sh),
+            ('modified', mime_file),
+        ]
+        # Quick checks miss the change which kept the size and time
+        assert ('modified', run_sh) not in self.verify(quick=True)
+
+    def test_verify_installed_command(self):
+        self.install(pjoin(batis_root, 'sampleapp'))
+        with mock.patch('batislib.install.get_install_scheme',
+                        return_value=self.scheme), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            assert integrity.main(['-j', '2']) == 0
+            assert stdout.getvalue() == 'sampleapp: OK\n'
+
+            os.unlink(pjoin(self.appdir, 'run.sh'))
+            assert integrity.main(['--quick', 'sampleapp']) == 1
+            assert 'sampleapp: missing: {}\n'.format(
+                pjoin(self.appdir, 'run.sh')) in stdout.getvalue()
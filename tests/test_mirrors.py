@@ -0,0 +1,42 @@
+from batislib import mirrors
+
+SCORES = {
+    'https://slow.example.com/app.tar.gz': 3.0,
+    'https://fast.example.org/app.tar.gz': 0.5,
+    'https://down.example.net/app.tar.gz': float('inf'),
+}
+
+def fake_probe(probed):
+    def probe(url, session=None):
+        probed.append(url)
+        return SCORES[url]
+    return probe
+
+def test_rank_urls(monkeypatch):
+    probed = []
+    monkeypatch.setattr(mirrors, 'probe', fake_probe(probed))
+    urls = list(SCORES)
+    assert mirrors.rank_urls(urls) == [urls[1], urls[0], urls[2]]
+    assert sorted(probed) == sorted(urls)
+
+    # Nothing to choose between
+    del probed[:]
+    assert mirrors.rank_urls(urls[:1]) == urls[:1]
+    assert probed == []
+
+def test_ranking_cached(monkeypatch, tmpdir):
+    probed = []
+    monkeypatch.setattr(mirrors, 'probe', fake_probe(probed))
+    ranking = mirrors.MirrorRanking(str(tmpdir))
+    urls = list(SCORES)
+    mirrors.rank_urls(urls, ranking=ranking)
+    assert ranking.get('https://fast.example.org/other.tar.gz') == 0.5
+
+    # Hosts which failed aren't remembered, so they're probed again
+    del probed[:]
+    assert mirrors.rank_urls(urls, ranking=ranking) == \
+                            [urls[1], urls[0], urls[2]]
+    assert probed == [urls[2]]
+
+    monkeypatch.setattr(mirrors, 'RANKING_MAX_AGE', -1)
+    assert ranking.get(urls[1]) is None
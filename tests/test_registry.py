@@ -0,0 +1,159 @@
+import io
+import json
+import os
+import shutil
+import testpath
+
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock  # Python 2
+
+from batislib import list as batis_list, registry, uninstall
+from .util import InstallTestCase, batis_root
+
+pjoin = os.path.join
+
+class RegistryTests(InstallTestCase):
+    def install(self, name='sampleapp', version=None):
+        src = pjoin(self.td, 'src', name)
+        shutil.copytree(pjoin(batis_root, 'sampleapp'), src)
+        self.install_app(src, version=version, source_sha512='abc123')
+
+    def test_install_and_uninstall(self):
+        assert registry.installed_applications(self.scheme) == []
+        self.install(version='1.2')
+        apps = registry.installed_applications(self.scheme)
+        assert [a['name'] for a in apps] == ['sampleapp']
+        assert apps[0]['version'] == '1.2'
+        assert apps[0]['source_sha512'] == 'abc123'
+        assert apps[0]['path'] == pjoin(self.scheme['application'],
+                                        'sampleapp')
+        assert apps[0]['size'] == registry.application_size(apps[0]['path'])
+        assert apps[0]['size'] > 0
+        assert registry.find_by_source(self.scheme, 'abc123') == ['sampleapp']
+
+        uninstall.ApplicationUninstaller(apps[0]['path'], self.scheme).run()
+        assert registry.installed_applications(self.scheme) == []
+        assert registry.find_by_source(self.scheme, 'abc123') == []
+
+    def test_rebuild_missing(self):
+        self.install()
+        self.install('otherapp')
+        os.unlink(registry.registry_path(self.scheme))
+        # Directories which aren't applications are skipped
+        os.mkdir(pjoin(self.scheme['application'], 'not-an-app'))
+
+        apps = registry.installed_applications(self.scheme)
+        assert [a['name'] for a in apps] == ['otherapp', 'sampleapp']
+        assert apps[1]['source_sha512'] == 'abc123'
+        testpath.assert_isfile(registry.registry_path(self.scheme))
+
+    def test_update_changed_dirs(self):
+        self.install()
+        self.install('otherapp')
+        # Installed and removed without updating the registry
+        appsdir = self.scheme['application']
+        shutil.copytree(pjoin(appsdir, 'sampleapp'), pjoin(appsdir, 'newapp'))
+        shutil.rmtree(pjoin(appsdir, 'otherapp'))
+        command = pjoin(self.td, 'bin', 'launch-sampleapp')
+
+        with mock.patch('batislib.registry._scan',
+                        wraps=registry._scan) as scan:
+            apps = registry.installed_applications(self.scheme)
+        assert [a['name'] for a in apps] == ['newapp', 'sampleapp']
+        # Only the new directory is looked at
+        scan.assert_called_once_with(self.scheme, ['newapp'])
+        assert registry.file_owners(self.scheme, [command]) == \
+            {command: 'newapp'}
+
+        with mock.patch('batislib.registry._scan') as scan:
+            registry.installed_applications(self.scheme)
+        assert scan.call_count == 0
+
+    def test_update_read_only(self):
+        self.install()
+        self.install('otherapp')
+        appsdir = self.scheme['application']
+        shutil.copytree(pjoin(appsdir, 'sampleapp'), pjoin(appsdir, 'newapp'))
+        shutil.rmtree(pjoin(appsdir, 'otherapp'))
+        path = registry.registry_path(self.scheme)
+        with open(path, 'rb') as f:
+            before = f.read()
+
+        real_access = os.access
+        def access(p, mode):
+            if mode == os.W_OK and p in (path, appsdir):
+                return False
+            return real_access(p, mode)
+        with mock.patch('os.access', side_effect=access), \
+                mock.patch('batislib.registry._scan',
+                           wraps=registry._scan) as scan:
+            apps = registry.installed_applications(self.scheme)
+        assert [a['name'] for a in apps] == ['newapp', 'sampleapp']
+        scan.assert_called_once_with(self.scheme, ['newapp'])
+        # newapp has no files.json, so its size isn't worked out
+        assert apps[0]['size'] is None
+        assert apps[1]['size'] > 0
+        with open(path, 'rb') as f:
+            assert f.read() == before
+
+    def list_schemes(self, schemename):
+        # The user scheme for these tests, and no system applications
+        if schemename == 'user':
+            return self.scheme
+        return dict(self.scheme, application=pjoin(self.td, 'nonexistant'))
+
+    def test_list_missing_dirs(self):
+        with mock.patch('batislib.list.get_install_scheme',
+                        side_effect=self.list_schemes):
+            shutil.rmtree(self.scheme['application'], ignore_errors=True)
+            assert list(batis_list.iter_installed_applications()) == []
+
+    def test_list_json(self):
+        self.install(version='1.2')
+        with mock.patch('batislib.list.get_install_scheme',
+                        side_effect=self.list_schemes), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            batis_list.main(['--json'])
+        apps = json.loads(stdout.getvalue())
+        assert [a['name'] for a in apps] == ['sampleapp']
+        assert apps[0]['version'] == '1.2'
+        assert apps[0]['scheme'] == 'user'
+
+    def test_file_owners(self):
+        command = pjoin(self.td, 'bin', 'launch-sampleapp')
+        desktop = pjoin(self.td, 'applications', 'fooview.desktop')
+        self.install()
+        assert registry.file_owners(self.scheme, [command, desktop]) == \
+            {command: 'sampleapp', desktop: 'sampleapp'}
+
+        # otherapp installs the same files, so now they belong to it
+        with self.assertLogs('batislib.install', 'WARNING') as logs:
+            self.install('otherapp')
+        assert any('installed by sampleapp' in m for m in logs.output)
+        assert registry.file_owners(self.scheme, [command]) == \
+            {command: 'otherapp'}
+
+        appdir = pjoin(self.scheme['application'], 'sampleapp')
+        uninstall.ApplicationUninstaller(appdir, self.scheme).run()
+        testpath.assert_islink(command, pjoin(self.scheme['application'],
+                                              'otherapp', 'run.sh'))
+        testpath.assert_isfile(desktop)
+        assert registry.file_owners(self.scheme, [command]) == \
+            {command: 'otherapp'}
+
+    def test_owns_command(self):
+        self.install()
+        command = pjoin(self.td, 'bin', 'launch-sampleapp')
+        with mock.patch('batislib.install.get_install_scheme',
+                        side_effect=self.list_schemes), \
+                mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            assert registry.owns_main([command]) == 0
+        assert stdout.getvalue() == \
+            '{}: sampleapp (user)\n'.format(command)
+
+        with mock.patch('batislib.install.get_install_scheme',
+                        side_effect=self.list_schemes), \
+                mock.patch('sys.stderr', new_callable=io.StringIO):
+            assert registry.owns_main([pjoin(self.td, 'bin', 'foo')]) == 1
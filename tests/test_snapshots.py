@@ -0,0 +1,111 @@
+import os
+import shutil
+import stat
+import testpath
+
+from batislib import install, snapshots, tarball, uninstall
+from .util import InstallTestCase, batis_root
+
+pjoin = os.path.join
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+class SnapshotTests(InstallTestCase):
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.appdir = pjoin(self.scheme['application'], 'sampleapp')
+
+    def make_tarball(self, version, run_sh_version=None, run_sh_mode=None):
+        d = pjoin(self.td, 'src', version, 'sampleapp')
+        shutil.copytree(pjoin(batis_root, 'sampleapp'), d)
+        with open(pjoin(d, 'run.sh'), 'a') as f:
+            f.write('echo version %s\n' % (run_sh_version or version))
+        if run_sh_mode is not None:
+            os.chmod(pjoin(d, 'run.sh'), run_sh_mode)
+        if version != '1':
+            os.unlink(pjoin(d, 'batis_info', 'desktop', 'fooview.desktop'))
+        return tarball.pack_tarball(d, pjoin(self.td, 'sampleapp-%s.tar.gz'
+                                             % version), install_script=False)
+
+    def install(self, version, in_place=False, keep_versions=None, **kwargs):
+        self.install_app(self.make_tarball(version, **kwargs), in_place,
+                         version=version, keep_versions=keep_versions)
+
+    def test_upgrade_and_rollback(self):
+        self.install('1')
+        self.install('2')
+        snaps = snapshots.list_snapshots(self.scheme, 'sampleapp')
+        assert len(snaps) == 1
+        old = snaps[0][1]
+        assert _read(pjoin(old, 'run.sh')).endswith('echo version 1\n')
+        assert _read(pjoin(self.appdir, 'run.sh')).endswith('echo version 2\n')
+        # Unchanged files are shared with the installed version
+        metadata = pjoin('batis_info', 'metadata.json')
+        assert os.stat(pjoin(old, metadata)).st_ino \
+            == os.stat(pjoin(self.appdir, metadata)).st_ino
+        assert os.stat(pjoin(old, 'run.sh')).st_ino \
+            != os.stat(pjoin(self.appdir, 'run.sh')).st_ino
+
+        desktop_file = pjoin(self.td, 'applications', 'fooview.desktop')
+        testpath.assert_not_path_exists(desktop_file)
+        self.call.reset_mock()
+        ai = snapshots.rollback(self.scheme, 'sampleapp')
+        assert ai.version == '1'
+        assert _read(pjoin(self.appdir, 'run.sh')).endswith('echo version 1\n')
+        testpath.assert_isfile(desktop_file)
+        self.call.assert_called_once_with(['update-desktop-database',
+                                           self.scheme['desktop']])
+        assert install.load_installed_files(self.appdir)['version'] == '1'
+
+        # The version rolled back from is kept, so this can be undone
+        snaps = snapshots.list_snapshots(self.scheme, 'sampleapp')
+        assert len(snaps) == 1
+        assert _read(pjoin(snaps[0][1], 'run.sh')) \
+            .endswith('echo version 2\n')
+        snapshots.rollback(self.scheme, 'sampleapp', version='2')
+        testpath.assert_not_path_exists(desktop_file)
+
+    def test_keep_versions(self):
+        for version in ('1', '2', '3', '4'):
+            self.install(version, keep_versions=2)
+        snaps = snapshots.list_snapshots(self.scheme, 'sampleapp')
+        assert [snapshots._snapshot_version(p) for (n, p) in snaps] \
+            == ['2', '3']
+
+        self.install('5', keep_versions=0)
+        assert len(snapshots.list_snapshots(self.scheme, 'sampleapp')) == 2
+
+    def test_in_place(self):
+        self.install('1')
+        self.install('2', in_place=True)
+        snaps = snapshots.list_snapshots(self.scheme, 'sampleapp')
+        assert len(snaps) == 1
+        old = snaps[0][1]
+        assert _read(pjoin(old, 'run.sh')).endswith('echo version 1\n')
+        assert install.load_installed_files(old)['version'] == '1'
+        testpath.assert_isfile(pjoin(old, 'batis_info', 'desktop',
+                                     'fooview.desktop'))
+
+    def test_rollback_after_mode_change(self):
+        self.install('1')
+        run_sh = pjoin(self.appdir, 'run.sh')
+        mode = stat.S_IMODE(os.stat(run_sh).st_mode)
+        # Only the permissions of run.sh change, and the snapshot of version
+        # 1 shares the file, so it must not be changed in place.
+        self.install('2', in_place=True, run_sh_version='1', run_sh_mode=0o700)
+        assert stat.S_IMODE(os.stat(run_sh).st_mode) == 0o700
+        snaps = snapshots.list_snapshots(self.scheme, 'sampleapp')
+        old_run_sh = pjoin(snaps[0][1], 'run.sh')
+        assert stat.S_IMODE(os.stat(old_run_sh).st_mode) == mode
+
+        snapshots.rollback(self.scheme, 'sampleapp')
+        assert stat.S_IMODE(os.stat(run_sh).st_mode) == mode
+
+    def test_uninstall(self):
+        self.install('1')
+        self.install('2')
+        uninstall.ApplicationUninstaller(self.appdir, self.scheme).run()
+        testpath.assert_not_path_exists(
+            snapshots.snapshots_dir(self.scheme, 'sampleapp'))
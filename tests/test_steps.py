@@ -0,0 +1,52 @@
+import threading
+import pytest
+
+from batislib.steps import StepGraph
+
+def test_run_concurrently():
+    b_started = threading.Event()
+    order = []
+    def a():
+        # Deadlocks if b doesn't run at the same time
+        assert b_started.wait(5)
+        order.append('a')
+        return 1
+    def b():
+        b_started.set()
+        order.append('b')
+        return 2
+    def c():
+        order.append('c')
+        return 3
+
+    graph = StepGraph()
+    graph.add('a', a)
+    graph.add('b', b)
+    graph.add('c', c, after=['a', 'b'])
+    events = []
+    results = graph.run(started=lambda name: events.append(('start', name)),
+                        finished=lambda name, res: events.append((name, res)))
+    assert results == {'a': 1, 'b': 2, 'c': 3}
+    assert order[-1] == 'c'
+    assert events == [('start', 'a'), ('a', 1), ('start', 'b'), ('b', 2),
+                      ('start', 'c'), ('c', 3)]
+
+def test_failure():
+    ran = []
+    def fail():
+        raise ValueError('oops')
+    graph = StepGraph()
+    graph.add('independent', lambda: ran.append('independent'))
+    graph.add('fail', fail)
+    graph.add('dependent', lambda: ran.append('dependent'), after=['fail'])
+    with pytest.raises(ValueError):
+        graph.run()
+    assert ran == ['independent']
+
+def test_shared_dependency():
+    # Several steps waiting for one must all be woken when it finishes
+    graph = StepGraph()
+    graph.add('a', lambda: 1)
+    for name in 'bcd':
+        graph.add(name, lambda: 2, after=['a'])
+    assert graph.run() == {'a': 1, 'b': 2, 'c': 2, 'd': 2}
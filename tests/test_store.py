@@ -0,0 +1,99 @@
+import os
+import shutil
+import stat
+import testpath
+
+from batislib import store, tarball, uninstall
+from .util import InstallTestCase, batis_root
+
+pjoin = os.path.join
+
+class SharedStoreTests(InstallTestCase):
+
+    def install(self, name, run_sh_mode=None, in_place=False):
+        src = pjoin(self.td, 'src', name)
+        if os.path.isdir(src):
+            shutil.rmtree(src)
+        shutil.copytree(pjoin(batis_root, 'sampleapp'), src)
+        if run_sh_mode is not None:
+            os.chmod(pjoin(src, 'run.sh'), run_sh_mode)
+        tb = tarball.pack_tarball(src, pjoin(self.td, name + '.app.tar.gz'),
+                                  name=name, install_script=False)
+        self.install_app(tb, in_place, shared_store=True)
+        return pjoin(self.scheme['application'], name)
+
+    def blobs(self):
+        root = store.store_dir(self.scheme)
+        return [pjoin(root, d, f) for d in os.listdir(root)
+                for f in os.listdir(pjoin(root, d))]
+
+    def test_share_and_free(self):
+        app1 = self.install('app1')
+        app2 = self.install('app2')
+        run1, run2 = pjoin(app1, 'run.sh'), pjoin(app2, 'run.sh')
+        assert os.stat(run1).st_ino == os.stat(run2).st_ino
+        # The store, and the two applications
+        assert os.stat(run1).st_nlink == 3
+        sha256 = tarball.hash_file(run1)
+        blob = store._blob_path(store.store_dir(self.scheme), sha256,
+                                stat.S_IMODE(os.stat(run1).st_mode))
+        assert os.stat(blob).st_ino == os.stat(run1).st_ino
+
+        # Including the Batis metadata
+        assert os.stat(pjoin(app1, 'batis_info', 'metadata.json')).st_nlink == 3
+
+        uninstall.ApplicationUninstaller(app1, self.scheme).run()
+        assert os.stat(blob).st_nlink == 2
+        nblobs = len(self.blobs())
+        assert nblobs > 0
+
+        uninstall.ApplicationUninstaller(app2, self.scheme).run()
+        testpath.assert_not_path_exists(blob)
+        assert self.blobs() == []
+
+    def test_collect_garbage_keeps_used(self):
+        app1 = self.install('app1')
+        assert store.collect_garbage(self.scheme) == 0
+        assert os.stat(pjoin(app1, 'run.sh')).st_nlink == 2
+
+    def test_permissions_in_key(self):
+        d = pjoin(self.td, 'tree')
+        os.makedirs(d)
+        for name, mode in [('a', 0o644), ('b', 0o755), ('c', 0o644)]:
+            with open(pjoin(d, name), 'w') as f:
+                f.write('same')
+            os.chmod(pjoin(d, name), mode)
+        store.share_tree(self.scheme, d, jobs=2)
+        ino = lambda n: os.stat(pjoin(d, n)).st_ino
+        assert ino('a') == ino('c') != ino('b')
+        assert stat.S_IMODE(os.stat(pjoin(d, 'b')).st_mode) == 0o755
+
+    def test_in_place_mode_change(self):
+        app1 = self.install('app1', run_sh_mode=0o755)
+        app2 = self.install('app2', run_sh_mode=0o755)
+        run1, run2 = pjoin(app1, 'run.sh'), pjoin(app2, 'run.sh')
+        blob = store._blob_path(store.store_dir(self.scheme),
+                                tarball.hash_file(run1), 0o755)
+
+        # Only the permissions of run.sh change, which mustn't affect app2
+        self.install('app1', run_sh_mode=0o644, in_place=True)
+        mode = lambda p: stat.S_IMODE(os.stat(p).st_mode)
+        assert mode(run1) == 0o644
+        assert mode(run2) == mode(blob) == 0o755
+        assert os.stat(run2).st_ino == os.stat(blob).st_ino
+        assert os.stat(run1).st_ino != os.stat(blob).st_ino
+
+    def test_changed_blob_replaced(self):
+        app1 = self.install('app1')
+        run1 = pjoin(app1, 'run.sh')
+        mode = stat.S_IMODE(os.stat(run1).st_mode)
+        blob = store._blob_path(store.store_dir(self.scheme),
+                                tarball.hash_file(run1), mode)
+        # Changing an application's file changes the file in the store
+        os.chmod(run1, 0o600)
+        with self.assertLogs('batislib.store', 'WARNING'):
+            app2 = self.install('app2')
+        run2 = pjoin(app2, 'run.sh')
+        assert os.stat(run2).st_ino == os.stat(blob).st_ino != \
+            os.stat(run1).st_ino
+        assert stat.S_IMODE(os.stat(run2).st_mode) == mode
@@ -0,0 +1,77 @@
+import os
+from os.path import join as pjoin
+import shutil
+from testpath import assert_isfile, assert_islink, assert_not_path_exists
+from testpath.tempdir import TemporaryDirectory
+
+from batislib import sync
+
+def _write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(contents)
+
+def _read(path):
+    with open(path) as f:
+        return f.read()
+
+def test_sync_tree():
+    with TemporaryDirectory() as td:
+        old, new = pjoin(td, 'old'), pjoin(td, 'new')
+        _write(pjoin(old, 'same.txt'), 'same')
+        _write(pjoin(old, 'changed.txt'), 'version 1')
+        _write(pjoin(old, 'a', 'moved.txt'), 'moved')
+        _write(pjoin(old, 'gone', 'x.txt'), 'x')
+        _write(pjoin(old, 'keep.json'), 'kept')
+        os.symlink('same.txt', pjoin(old, 'link'))
+        shutil.copytree(old, new, symlinks=True)
+
+        _write(pjoin(new, 'changed.txt'), 'version 2')
+        os.makedirs(pjoin(new, 'b'))
+        os.rename(pjoin(new, 'a', 'moved.txt'), pjoin(new, 'b', 'moved.txt'))
+        shutil.rmtree(pjoin(new, 'gone'))
+        os.unlink(pjoin(new, 'keep.json'))
+        os.unlink(pjoin(new, 'link'))
+        os.symlink('changed.txt', pjoin(new, 'link'))
+        moved_ino = os.stat(pjoin(old, 'a', 'moved.txt')).st_ino
+        same_ino = os.stat(pjoin(old, 'same.txt')).st_ino
+
+        changed = sync.sync_tree(new, old, keep=('keep.json',))
+        assert changed == ['a/moved.txt', 'b', 'b/moved.txt', 'changed.txt',
+                           'gone', 'gone/x.txt', 'link']
+
+        assert _read(pjoin(old, 'changed.txt')) == 'version 2'
+        assert os.stat(pjoin(old, 'same.txt')).st_ino == same_ino
+        assert os.stat(pjoin(old, 'b', 'moved.txt')).st_ino == moved_ino
+        assert_not_path_exists(pjoin(old, 'a', 'moved.txt'))
+        assert_not_path_exists(pjoin(old, 'gone'))
+        assert_islink(pjoin(old, 'link'), to='changed.txt')
+        assert_isfile(pjoin(old, 'keep.json'))
+
+        # Nothing to do the second time
+        assert sync.sync_tree(new, old, keep=('keep.json',)) == []
+
+def test_sync_tree_linked_files():
+    with TemporaryDirectory() as td:
+        old, new = pjoin(td, 'old'), pjoin(td, 'new')
+        _write(pjoin(old, 'run.sh'), 'echo hi')
+        _write(pjoin(old, 'a', 'moved.txt'), 'moved')
+        os.chmod(pjoin(old, 'run.sh'), 0o644)
+        shutil.copytree(old, new)
+        os.chmod(pjoin(new, 'run.sh'), 0o755)
+        os.makedirs(pjoin(new, 'b'))
+        os.rename(pjoin(new, 'a', 'moved.txt'), pjoin(new, 'b', 'moved.txt'))
+        os.utime(pjoin(new, 'b', 'moved.txt'), (1, 1))
+
+        # Another directory shares the files, so they must be replaced
+        shared = pjoin(td, 'shared')
+        os.mkdir(shared)
+        os.link(pjoin(old, 'run.sh'), pjoin(shared, 'run.sh'))
+        os.link(pjoin(old, 'a', 'moved.txt'), pjoin(shared, 'moved.txt'))
+
+        sync.sync_tree(new, old)
+        assert os.stat(pjoin(old, 'run.sh')).st_mode & 0o777 == 0o755
+        assert os.stat(pjoin(old, 'b', 'moved.txt')).st_mtime == 1
+        assert os.stat(pjoin(shared, 'run.sh')).st_mode & 0o777 == 0o644
+        assert os.stat(pjoin(shared, 'moved.txt')).st_mtime != 1
@@ -0,0 +1,216 @@
+import io
+import os
+import shutil
+import stat
+import tarfile
+import pytest
+import testpath
+from testpath.tempdir import TemporaryDirectory
+
+from batislib import compression, tarball
+
+pjoin = os.path.join
+batis_root = os.path.dirname(os.path.dirname(__file__))
+
+class NonSeekable(object):
+    """Wrap a file so it can only be read sequentially, like a pipe"""
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        return self.f.read(size)
+
+def _make_tarball(path, members):
+    with tarfile.open(path, 'w:gz') as tf:
+        for tarinfo, data in members:
+            tf.addfile(tarinfo, io.BytesIO(data) if data else None)
+
+def test_unpack_non_seekable():
+    with TemporaryDirectory() as td:
+        tb = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                                  pjoin(td, 'sampleapp.app.tar.gz'),
+                                  install_script=False)
+        with open(tb, 'rb') as f:
+            d = tarball.unpack_app_tarball(NonSeekable(f), pjoin(td, 'out'))
+        assert d == pjoin(td, 'out', 'sampleapp')
+        testpath.assert_isfile(pjoin(d, 'batis_info', 'metadata.json'))
+        testpath.assert_isfile(pjoin(d, 'run.sh'))
+        assert os.access(pjoin(d, 'run.sh'), os.X_OK)
+
+def _snapshot(root):
+    """Describe the files under root, to compare two extractions"""
+    res = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = pjoin(dirpath, name)
+            st = os.lstat(path)
+            info = (stat.S_IMODE(st.st_mode), int(st.st_mtime))
+            if stat.S_ISLNK(st.st_mode):
+                info += (os.readlink(path),)
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    info += (f.read(), st.st_nlink)
+            res[os.path.relpath(path, root)] = info
+    return res
+
+def test_unpack_parallel(monkeypatch):
+    monkeypatch.setattr(tarball, 'PARALLEL_MAX_FILE_SIZE', 1024)
+    members = []
+    def add(name, data=b'', type=tarfile.REGTYPE, mode=0o644, linkname=''):
+        ti = tarfile.TarInfo(name)
+        ti.type, ti.mode, ti.linkname = type, mode, linkname
+        ti.mtime = 1500000000 + len(members)
+        ti.size = len(data)
+        members.append((ti, data))
+    add('app', type=tarfile.DIRTYPE, mode=0o755)
+    add('app/batis_info', type=tarfile.DIRTYPE, mode=0o755)
+    add('app/batis_info/metadata.json', b'{}')
+    for i in range(50):
+        add('app/lib/mod%d.py' % i, b'x = %d\n' % i, mode=0o600 + i % 2)
+    add('app/big.bin', b'b' * 5000, mode=0o755)
+    add('app/run', type=tarfile.SYMTYPE, linkname='lib/mod1.py')
+    add('app/lib/mod3.py', b'replaced')
+    add('app/same.py', type=tarfile.LNKTYPE, linkname='app/lib/mod2.py')
+
+    with TemporaryDirectory() as td:
+        tb = pjoin(td, 'app.tar.gz')
+        _make_tarball(tb, members)
+        serial = tarball.unpack_app_tarball(tb, pjoin(td, 'serial'))
+        parallel = tarball.unpack_app_tarball(tb, pjoin(td, 'parallel'),
+                                              jobs=4)
+        assert _snapshot(parallel) == _snapshot(serial)
+        with open(pjoin(parallel, 'lib', 'mod3.py'), 'rb') as f:
+            assert f.read() == b'replaced'
+
+def test_reject_parent_dir():
+    with TemporaryDirectory() as td:
+        tb = pjoin(td, 'bad.tar.gz')
+        _make_tarball(tb, [(tarfile.TarInfo('app/../../evil'), b'')])
+        with pytest.raises(ValueError):
+            tarball.unpack_app_tarball(tb, pjoin(td, 'out'))
+
+def test_reject_through_symlink():
+    with TemporaryDirectory() as td:
+        link = tarfile.TarInfo('app/link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = td
+        data = b'gotcha'
+        f = tarfile.TarInfo('app/link/evil')
+        f.size = len(data)
+        tb = pjoin(td, 'bad.tar.gz')
+        _make_tarball(tb, [(link, b''), (f, data)])
+        with pytest.raises(ValueError):
+            tarball.unpack_app_tarball(tb, pjoin(td, 'out'))
+        testpath.assert_not_path_exists(pjoin(td, 'evil'))
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_reject_replacing_symlink(jobs):
+    with TemporaryDirectory() as td:
+        outside = pjoin(td, 'outside')
+        link = tarfile.TarInfo('app/link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = outside
+        data = b'gotcha'
+        f = tarfile.TarInfo('app/link')
+        f.size = len(data)
+        tb = pjoin(td, 'bad.tar.gz')
+        _make_tarball(tb, [(link, b''), (f, data)])
+        with pytest.raises(ValueError):
+            tarball.unpack_app_tarball(tb, pjoin(td, 'out'), jobs=jobs)
+        testpath.assert_not_path_exists(outside)
+
+@pytest.mark.parametrize('link_name, file_name', [
+    ('./app/d', 'app/d/pwned'),
+    ('app/d', './app/d/pwned'),
+    ('app//d', 'app/d/pwned'),
+    ('app/d', 'app/./d/pwned'),
+    ('app/d/', 'app//d/pwned'),
+    ('app/d/pwned', './app/d/pwned'),
+])
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_reject_aliased_symlink(link_name, file_name, jobs):
+    with TemporaryDirectory() as td:
+        outside = pjoin(td, 'outside')
+        os.mkdir(outside)
+        link = tarfile.TarInfo(link_name)
+        link.type = tarfile.SYMTYPE
+        link.linkname = outside
+        if link_name.endswith('pwned'):
+            link.linkname = pjoin(outside, 'pwned')
+        data = b'gotcha'
+        f = tarfile.TarInfo(file_name)
+        f.size = len(data)
+        tb = pjoin(td, 'bad.tar.gz')
+        _make_tarball(tb, [(link, b''), (f, data)])
+        with pytest.raises(ValueError):
+            tarball.unpack_app_tarball(tb, pjoin(td, 'out'), jobs=jobs)
+        testpath.assert_not_path_exists(pjoin(outside, 'pwned'))
+
+def test_reject_hardlink_to_symlink():
+    with TemporaryDirectory() as td:
+        link = tarfile.TarInfo('app/link')
+        link.type = tarfile.SYMTYPE
+        link.linkname = pjoin(td, 'secret')
+        hard = tarfile.TarInfo('app/hard')
+        hard.type = tarfile.LNKTYPE
+        hard.linkname = 'app/link'
+        tb = pjoin(td, 'bad.tar.gz')
+        _make_tarball(tb, [(link, b''), (hard, b'')])
+        with pytest.raises(ValueError):
+            tarball.unpack_app_tarball(tb, pjoin(td, 'out'))
+
+def test_pack_parallel():
+    with TemporaryDirectory() as td:
+        tb = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                                  pjoin(td, 'sampleapp.app.tar.gz'), jobs=4)
+        with tarfile.open(tb, 'r:gz') as tf:
+            assert 'sampleapp/batis_info/metadata.json' in tf.getnames()
+            assert 'sampleapp/batis_info/batislib/install.py' in tf.getnames()
+
+        d = tarball.unpack_app_tarball(tb, pjoin(td, 'out'))
+        testpath.assert_isfile(pjoin(d, 'install.sh'))
+
+@pytest.mark.parametrize('codec', compression.available_codecs())
+def test_pack_unpack_codec(codec):
+    with TemporaryDirectory() as td:
+        tb = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'), codec=codec,
+                                  output_file=pjoin(td, 'sampleapp.app.tar'))
+        assert compression.detect_file_codec(tb) == codec
+        assert compression.is_tarball(tb)
+
+        with open(tb, 'rb') as f:
+            d = tarball.unpack_app_tarball(NonSeekable(f), pjoin(td, 'out'))
+        testpath.assert_isfile(pjoin(d, 'batis_info', 'metadata.json'))
+        testpath.assert_isfile(pjoin(d, 'install.sh'))
+
+def test_pack_file_hashes():
+    with TemporaryDirectory() as td:
+        tb = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                                  pjoin(td, 'sampleapp.app.tar.gz'))
+        d = tarball.unpack_app_tarball(tb, pjoin(td, 'out'))
+        hashes = tarball.load_file_hashes(d)
+        files = hashes['files']
+        assert files['run.sh'] == {
+            'sha256': tarball.hash_file(pjoin(d, 'run.sh')),
+            'size': os.path.getsize(pjoin(d, 'run.sh')),
+            'mode': stat.S_IMODE(
+                        os.stat(pjoin(batis_root, 'sampleapp', 'run.sh')).st_mode),
+        }
+        assert 'install.sh' in files
+        assert 'batis_info/batislib/tarball.py' in files
+        assert tarball.FILE_HASHES not in files
+        assert not any('__pycache__' in name for name in files)
+
+def test_pack_file_hashes_hardlink():
+    with TemporaryDirectory() as td:
+        src = pjoin(td, 'sampleapp')
+        shutil.copytree(pjoin(batis_root, 'sampleapp'), src)
+        os.link(pjoin(src, 'run.sh'), pjoin(src, 'run2.sh'))
+        tb = tarball.pack_tarball(src, pjoin(td, 'sampleapp.app.tar.gz'),
+                                  install_script=False)
+        d = tarball.unpack_app_tarball(tb, pjoin(td, 'out'))
+        files = tarball.load_file_hashes(d)['files']
+        assert files['run2.sh'] == files['run.sh']
+        for name, info in files.items():
+            assert tarball.hash_file(pjoin(d, name)) == info['sha256']
+            assert os.path.getsize(pjoin(d, name)) == info['size']
@@ -0,0 +1,64 @@
+import json
+import os
+import testpath
+
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock  # Python 2
+
+from batislib import triggers
+from .util import InstallTestCase, batis_root
+
+pjoin = os.path.join
+
+class TriggerQueueTests(InstallTestCase):
+    mock_triggers = False
+
+    def test_coalesce(self):
+        q = triggers.TriggerQueue(self.scheme)
+        for path in [pjoin(self.td, 'applications', 'a.desktop'),
+                     pjoin(self.td, 'applications', 'b.desktop'),
+                     pjoin(self.td, 'mime', 'packages', 'a.xml'),
+                     pjoin(self.td, 'icons', 'hicolor', '48x48', 'apps', 'a.png'),
+                     pjoin(self.td, 'icons', 'hicolor', '32x32', 'apps', 'b.png')]:
+            q.path_changed(path)
+
+        with mock.patch('batislib.triggers.call', return_value=0) as call:
+            q.finish()
+            q.finish()
+        assert call.call_args_list == [
+            mock.call(['update-desktop-database', self.scheme['desktop']]),
+            mock.call(['update-mime-database', self.scheme['mimetypes']]),
+            mock.call(['xdg-icon-resource', 'forceupdate', '--theme', 'hicolor']),
+        ]
+
+    def test_defer(self):
+        q = triggers.TriggerQueue(self.scheme, defer=True)
+        q.desktop_changed()
+        q.finish()
+        q = triggers.TriggerQueue(self.scheme, defer=True)
+        q.icons_changed('hicolor')
+        q.finish()
+
+        pending = pjoin(self.scheme['application'], triggers.PENDING_FILE)
+        with open(pending) as f:
+            assert json.load(f) == {'desktop': True, 'mime': False,
+                                    'icon_themes': ['hicolor']}
+
+        with testpath.assert_calls('update-desktop-database'), \
+                testpath.assert_calls('xdg-icon-resource'):
+            triggers.main([])
+        testpath.assert_not_path_exists(pending)
+
+    def test_install_several(self):
+        q = triggers.TriggerQueue(self.scheme)
+        for name in ('app1', 'app2'):
+            self.install_app(pjoin(batis_root, 'sampleapp'), triggers=q)
+            os.rename(pjoin(self.scheme['application'], 'sampleapp'),
+                      pjoin(self.scheme['application'], name))
+        assert q.desktop and q.mime and q.icon_themes == {'hicolor'}
+
+        with mock.patch('batislib.triggers.call', return_value=0) as call:
+            q.finish()
+        assert call.call_count == 3
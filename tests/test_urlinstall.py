@@ -0,0 +1,607 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+import requests
+import testpath
+from testpath.tempdir import TemporaryDirectory
+
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock  # Python 2
+
+from batislib import cache, delta, install, tarball, urlinstall
+
+pjoin = os.path.join
+batis_root = os.path.dirname(os.path.dirname(__file__))
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serve files from server.files, supporting simple Range requests.
+
+    Test can make the server misbehave by setting:
+
+    - server.drop_after: a list of byte counts; each response sends that many
+      bytes of its body and then closes the connection.
+    - server.corrupt: the number of responses to corrupt.
+    """
+    def do_HEAD(self):
+        data = self.server.files.get(self.path)
+        if data is None or not self.server.ranges_ok:
+            self.send_error(404 if data is None else 405)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        self.server.ranges.append(self.headers.get('Range'))
+        self.server.paths.append(self.path)
+
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        if self.server.corrupt:
+            self.server.corrupt -= 1
+            data = data[:100] + b'X' + data[101:]
+
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range') or '')
+        if m and self.server.ranges_ok:
+            start = int(m.group(1))
+            end = int(m.group(2)) + 1 if m.group(2) else len(data)
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d'
+                             % (start, end - 1, len(data)))
+        else:
+            start, end = 0, len(data)
+            self.send_response(200)
+        body = data[start:end]
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        if self.server.drop_after:
+            self.wfile.write(body[:self.server.drop_after.pop(0)])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def http_server(monkeypatch):
+    # Let the plain HTTP test server exercise unpacking while downloading
+    monkeypatch.setattr(urlinstall, 'PIPELINE_SCHEMES', {'http', 'https'})
+    server = HTTPServer(('127.0.0.1', 0), FileHandler)
+    server.files = {}
+    server.ranges = []
+    server.paths = []
+    server.ranges_ok = True
+    server.drop_after = []
+    server.corrupt = 0
+    server.not_modified = 0
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    server.url = 'http://127.0.0.1:%d' % server.server_port
+    yield server
+    server.shutdown()
+    t.join()
+    server.server_close()
+
+@pytest.fixture
+def scheme(tmpdir):
+    td = str(tmpdir)
+    with testpath.modified_env({'XDG_DATA_HOME': td}):
+        yield install.get_install_scheme('user')
+
+def assert_nothing_installed(scheme):
+    appsdir = scheme['application']
+    assert (not os.path.exists(appsdir)) or os.listdir(appsdir) == []
+
+@pytest.fixture(scope='module')
+def sampleapp_tarball():
+    with TemporaryDirectory() as td:
+        # Include the Batis files to make it big enough to break up
+        tb = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                                  pjoin(td, 'sampleapp.app.tar.gz'))
+        with open(tb, 'rb') as f:
+            yield f.read()
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_fetch_build(http_server, scheme, sampleapp_tarball, pipeline):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+
+    ai = urlinstall.fetch_build(build, scheme, pipeline=pipeline)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.copy_application()
+    testpath.assert_isfile(pjoin(scheme['application'], 'sampleapp', 'run.sh'))
+    assert os.listdir(scheme['application']) == ['sampleapp']
+
+def test_no_pipeline_over_http(http_server, scheme, sampleapp_tarball,
+                               monkeypatch):
+    monkeypatch.setattr(urlinstall, 'PIPELINE_SCHEMES', {'https'})
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+    unpack = mock.Mock(side_effect=AssertionError('unpacked too soon'))
+    monkeypatch.setattr(urlinstall, '_unpack_verified', unpack)
+
+    ai = urlinstall.fetch_build(build, scheme, pipeline=True)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    assert unpack.call_count == 0
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_fetch_build_bad_hash(http_server, scheme, sampleapp_tarball, pipeline):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(b'something else').hexdigest()}
+
+    with pytest.raises(ValueError, match='corrupted'):
+        urlinstall.fetch_build(build, scheme, pipeline=pipeline)
+    # Nothing should be left in the install location
+    assert_nothing_installed(scheme)
+
+def test_fetch_build_truncated(http_server, scheme, sampleapp_tarball):
+    data = sampleapp_tarball[:len(sampleapp_tarball) // 2]
+    http_server.files['/app.tar.gz'] = data
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+
+    with pytest.raises(ValueError, match='corrupted'):
+        urlinstall.fetch_build(build, scheme)
+    assert_nothing_installed(scheme)
+
+def test_fetch_build_cached(http_server, scheme, sampleapp_tarball, tmpdir):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    sha512 = hashlib.sha512(sampleapp_tarball).hexdigest()
+    build = {'url': http_server.url + '/app.tar.gz', 'sha512': sha512}
+    dc = cache.DownloadCache(str(tmpdir.join('cache')))
+
+    ai = urlinstall.fetch_build(build, scheme, cache=dc)
+    ai.discard_staging()
+    assert [e[0] for e in dc.entries()] == [sha512]
+
+    # The second time, it shouldn't need the server
+    del http_server.files['/app.tar.gz']
+    ai = urlinstall.fetch_build(build, scheme, cache=dc)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+
+    # If other users could change it, it's copied before it's checked
+    os.chmod(dc.get(sha512), 0o666)
+    ai = urlinstall.fetch_build(build, scheme, cache=dc)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+
+def test_fetch_build_cache_corrupted(http_server, scheme, sampleapp_tarball,
+                                     tmpdir):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    sha512 = hashlib.sha512(sampleapp_tarball).hexdigest()
+    build = {'url': http_server.url + '/app.tar.gz', 'sha512': sha512}
+    dc = cache.DownloadCache(str(tmpdir.join('cache')))
+    f = dc.new_entry()
+    f.write(sampleapp_tarball[:1000])
+    dc.commit(f, sha512)
+
+    # The bad cache entry should be replaced by downloading it again
+    ai = urlinstall.fetch_build(build, scheme, cache=dc)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+    with open(dc.get(sha512), 'rb') as f:
+        assert f.read() == sampleapp_tarball
+
+def test_fetch_build_cache_tampered(http_server, scheme, sampleapp_tarball,
+                                    tmpdir, monkeypatch):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    sha512 = hashlib.sha512(sampleapp_tarball).hexdigest()
+    build = {'url': http_server.url + '/app.tar.gz', 'sha512': sha512}
+    dc = cache.DownloadCache(str(tmpdir.join('cache')))
+    # A different, valid tarball under the build's hash
+    other = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                                 str(tmpdir.join('other.app.tar.gz')),
+                                 name='otherapp', install_script=False)
+    f = dc.new_entry()
+    f.write(_read(other))
+    dc.commit(f, sha512)
+    installers = []
+    def make_installer(path, scheme):
+        installers.append(path)
+        return install.ApplicationInstaller(path, scheme)
+    monkeypatch.setattr(urlinstall, 'ApplicationInstaller', make_installer)
+
+    # It's not unpacked before it's found to be wrong
+    ai = urlinstall.fetch_build(build, scheme, cache=dc)
+    assert len(installers) == 1
+    assert os.path.basename(ai.directory) == 'sampleapp'
+    ai.discard_staging()
+    assert _read(dc.get(sha512)) == sampleapp_tarball
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(urlinstall, 'RETRY_BACKOFF', 0)
+
+@pytest.mark.parametrize('ranges_ok', [True, False])
+def test_resume_after_dropped_connection(http_server, scheme, no_backoff,
+                                         sampleapp_tarball, ranges_ok):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    http_server.drop_after = [5000, 3000]
+    http_server.ranges_ok = ranges_ok
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+
+    ai = urlinstall.fetch_build(build, scheme)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+    if ranges_ok:
+        assert http_server.ranges == [None, 'bytes=5000-', 'bytes=8000-']
+    else:
+        # The server sends the whole file each time, so we skip the start
+        assert http_server.ranges == [None, 'bytes=5000-', 'bytes=5000-']
+
+def test_give_up_after_retries(http_server, scheme, no_backoff,
+                               sampleapp_tarball):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    # Retries are counted until we get some more data
+    http_server.drop_after = [1000] + [0] * (urlinstall.DOWNLOAD_RETRIES + 1)
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+
+    with pytest.raises(requests.ConnectionError):
+        urlinstall.fetch_build(build, scheme, pipeline=False)
+
+def test_retry_on_bad_hash(http_server, scheme, sampleapp_tarball):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    http_server.corrupt = urlinstall.HASH_RETRIES
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+
+    ai = urlinstall.fetch_build(build, scheme)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+
+    http_server.corrupt = urlinstall.HASH_RETRIES + 1
+    with pytest.raises(urlinstall.CorruptedDownload):
+        urlinstall.fetch_build(build, scheme)
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_resume_partial_download(http_server, scheme, sampleapp_tarball,
+                                 tmpdir, pipeline):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    sha512 = hashlib.sha512(sampleapp_tarball).hexdigest()
+    build = {'url': http_server.url + '/app.tar.gz', 'sha512': sha512}
+    dc = cache.DownloadCache(str(tmpdir.join('cache')))
+
+    # Left over from an earlier process which was interrupted
+    with dc.new_entry(sha512) as f:
+        f.write(sampleapp_tarball[:6000])
+
+    ai = urlinstall.fetch_build(build, scheme, pipeline=pipeline, cache=dc)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+    assert http_server.ranges == ['bytes=6000-']
+    assert [e[0] for e in dc.entries()] == [sha512]
+    assert os.listdir(dc.directory) == [sha512]
+
+def test_resumed_download_checked_first(http_server, scheme,
+                                        sampleapp_tarball, tmpdir,
+                                        monkeypatch):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    sha512 = hashlib.sha512(sampleapp_tarball).hexdigest()
+    build = {'url': http_server.url + '/app.tar.gz', 'sha512': sha512}
+    dc = cache.DownloadCache(str(tmpdir.join('cache')))
+    with dc.new_entry(sha512) as f:
+        f.write(sampleapp_tarball[:6000])
+    unpack = mock.Mock(side_effect=AssertionError('unpacked too soon'))
+    monkeypatch.setattr(urlinstall, '_unpack_verified', unpack)
+
+    ai = urlinstall.fetch_build(build, scheme, pipeline=True, cache=dc)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+    assert unpack.call_count == 0
+
+def test_fetch_index_cached(http_server, tmpdir):
+    index = {'name': 'Sample', 'builds': []}
+    http_server.files['/batis_index.json'] = json.dumps(index).encode()
+    url = http_server.url + '/batis_index.json'
+    ic = cache.IndexCache(str(tmpdir))
+
+    assert urlinstall.fetch_index(url, cache=ic) == index
+    assert ic.get(url)['etag']
+
+    # The server responds 304 Not Modified, and the cached copy is used
+    assert urlinstall.fetch_index(url, cache=ic) == index
+    assert http_server.not_modified == 1
+
+    # If it's changed, the server sends the new version
+    index['name'] = 'Renamed'
+    http_server.files['/batis_index.json'] = json.dumps(index).encode()
+    assert urlinstall.fetch_index(url, cache=ic) == index
+    assert ic.get(url)['index'] == index
+
+def test_fetch_index_gzipped(http_server):
+    index = {'name': 'Sample', 'builds': []}
+    http_server.files['/batis_index.json.gz'] = gzip.compress(
+                                                json.dumps(index).encode())
+    url = http_server.url + '/batis_index.json.gz'
+    assert urlinstall.fetch_index(url) == index
+
+def test_install_many(http_server, scheme, sampleapp_tarball, tmpdir,
+                      monkeypatch):
+    monkeypatch.setattr(urlinstall, 'prepare_index_url', lambda url: url)
+    monkeypatch.setattr(install.ApplicationInstaller,
+                        'install_system_packages', lambda self, backend: None)
+    scheme['commands'] = str(tmpdir.join('bin'))
+
+    otherapp = tarball.pack_tarball(pjoin(batis_root, 'sampleapp'),
+                                    str(tmpdir.join('otherapp.app.tar.gz')),
+                                    name='otherapp', install_script=False)
+    with open(otherapp, 'rb') as f:
+        otherapp_tarball = f.read()
+
+    urls = []
+    for name, data in [('sampleapp', sampleapp_tarball),
+                       ('otherapp', otherapp_tarball)]:
+        http_server.files['/%s.tar.gz' % name] = data
+        index = {'name': name, 'byline': 'Test app', 'format_version': [1, 0],
+                 'builds': [{'url': '%s/%s.tar.gz' % (http_server.url, name),
+                             'sha512': hashlib.sha512(data).hexdigest(),
+                             'version': '1.0'}]}
+        http_server.files['/%s.json' % name] = json.dumps(index).encode()
+        urls.append(http_server.url + '/%s.json' % name)
+    urls.append(http_server.url + '/missing.json')
+
+    failed = urlinstall.install_many(urls, scheme, jobs=3)
+    assert failed == [http_server.url + '/missing.json']
+    for name in ('sampleapp', 'otherapp'):
+        testpath.assert_isfile(pjoin(scheme['application'], name,
+                                     'batis_info', 'installed_files.json'))
+
+def test_install_already_installed(http_server, scheme, sampleapp_tarball,
+                                   tmpdir, monkeypatch):
+    monkeypatch.setattr(urlinstall, 'prepare_index_url', lambda url: url)
+    monkeypatch.setattr(install.ApplicationInstaller,
+                        'install_system_packages', lambda self, backend: None)
+    scheme['commands'] = str(tmpdir.join('bin'))
+    sha512 = hashlib.sha512(sampleapp_tarball).hexdigest()
+    http_server.files['/sampleapp.tar.gz'] = sampleapp_tarball
+    index = {'name': 'sampleapp', 'byline': 'Test app', 'format_version': [1, 0],
+             'builds': [{'url': http_server.url + '/sampleapp.tar.gz',
+                         'sha512': sha512, 'version': '1.0'}]}
+    http_server.files['/sampleapp.json'] = json.dumps(index).encode()
+    url = http_server.url + '/sampleapp.json'
+
+    urlinstall.install(url, scheme)
+    appdir = pjoin(scheme['application'], 'sampleapp')
+    manifest = install.load_installed_files(appdir)
+    assert manifest['source_sha512'] == sha512
+    assert manifest['version'] == '1.0'
+    assert install.find_installed_build(scheme, sha512) == appdir
+
+    # Installing the same build again doesn't download it
+    del http_server.paths[:]
+    urlinstall.install(url, scheme)
+    assert '/sampleapp.tar.gz' not in http_server.paths
+
+    # Unless it's been damaged
+    os.unlink(pjoin(scheme['commands'], 'launch-sampleapp'))
+    assert install.find_installed_build(scheme, sha512) is None
+    urlinstall.install(url, scheme)
+    assert '/sampleapp.tar.gz' in http_server.paths
+    testpath.assert_islink(pjoin(scheme['commands'], 'launch-sampleapp'))
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(urlinstall, 'SEGMENT_SIZE', 4096)
+
+@pytest.mark.parametrize('pipeline', [True, False])
+def test_segmented_download(http_server, scheme, sampleapp_tarball,
+                            small_segments, pipeline):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    http_server.files['/mirror/app.tar.gz'] = sampleapp_tarball
+    build = {'url': http_server.url + '/app.tar.gz',
+             'mirrors': [http_server.url + '/mirror/app.tar.gz'],
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+
+    ai = urlinstall.fetch_build(build, scheme, pipeline=pipeline,
+                                connections=3)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+
+    # Each segment is fetched once, after probing the two URLs
+    size = len(sampleapp_tarball)
+    segments = ['bytes=%d-%d' % (start, min(start + 4096, size) - 1)
+                for start in range(0, size, 4096)]
+    assert sorted(http_server.ranges[2:]) == sorted(segments)
+    assert set(http_server.paths) == {'/app.tar.gz', '/mirror/app.tar.gz'}
+
+def test_segmented_download_mirror_fails(http_server, scheme, no_backoff,
+                                         sampleapp_tarball, small_segments,
+                                         tmpdir):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    sha512 = hashlib.sha512(sampleapp_tarball).hexdigest()
+    build = {'url': http_server.url + '/app.tar.gz',
+             'mirrors': [http_server.url + '/missing/app.tar.gz'],
+             'sha512': sha512}
+    dc = cache.DownloadCache(str(tmpdir.join('cache')))
+
+    # Segments the mirror can't send are fetched from the main URL instead
+    ai = urlinstall.fetch_build(build, scheme, cache=dc, connections=2)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+    assert os.listdir(dc.directory) == [sha512]
+
+def test_segmented_download_bad_hash(http_server, scheme, sampleapp_tarball,
+                                     small_segments):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    build = {'url': http_server.url + '/app.tar.gz',
+             'sha512': hashlib.sha512(b'something else').hexdigest()}
+
+    with pytest.raises(urlinstall.CorruptedDownload):
+        urlinstall.fetch_build(build, scheme, retries=0)
+    assert_nothing_installed(scheme)
+
+def test_fastest_mirror(http_server, scheme, sampleapp_tarball):
+    http_server.files['/mirror/app.tar.gz'] = sampleapp_tarball
+    build = {'url': http_server.url + '/missing/app.tar.gz',
+             'mirrors': [http_server.url + '/mirror/app.tar.gz'],
+             'sha512': hashlib.sha512(sampleapp_tarball).hexdigest()}
+
+    # The main URL doesn't work, so it's ranked last
+    ai = urlinstall.fetch_build(build, scheme, connections=1)
+    testpath.assert_isfile(pjoin(ai.directory, 'run.sh'))
+    ai.discard_staging()
+    assert http_server.paths == ['/mirror/app.tar.gz'] * 2
+
+def test_http_mirror_needs_hash(http_server, scheme, sampleapp_tarball):
+    http_server.files['/app.tar.gz'] = sampleapp_tarball
+    build = {'url': 'https://example.invalid/app.tar.gz',
+             'mirrors': [http_server.url + '/app.tar.gz']}
+
+    with pytest.raises(KeyError, match='sha512'):
+        urlinstall.fetch_build(build, scheme)
+    assert http_server.paths == []
+    assert_nothing_installed(scheme)
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def delta_build(http_server, tmpdir):
+    """Version 2 of sampleapp, with a delta upgrade from version 1"""
+    td = str(tmpdir)
+    v2 = pjoin(td, 'v2', 'sampleapp')
+    shutil.copytree(pjoin(batis_root, 'sampleapp'), v2)
+    with open(pjoin(v2, 'run.sh'), 'a') as f:
+        f.write('echo upgraded\n')
+    with open(pjoin(v2, 'new.txt'), 'w') as f:
+        f.write('new file\n')
+    full = tarball.pack_tarball(v2, pjoin(td, 'v2.app.tar.gz'))
+    payload = tarball.pack_tarball(v2, pjoin(td, 'v2.app.tar'), codec='none')
+    manifest = delta.write_delta_manifest(payload)
+    assert manifest == pjoin(td, 'v2.app.files.json')
+
+    for path in (full, payload, manifest):
+        http_server.files['/' + os.path.basename(path)] = _read(path)
+    return {
+        'url': http_server.url + '/v2.app.tar.gz',
+        'sha512': hashlib.sha512(_read(full)).hexdigest(),
+        'delta': {
+            'url': http_server.url + '/v2.app.tar',
+            'manifest_url': http_server.url + '/v2.app.files.json',
+            'manifest_sha512': hashlib.sha512(_read(manifest)).hexdigest(),
+        },
+    }
+
+def test_delta_upgrade(http_server, scheme, sampleapp_tarball, delta_build):
+    ai = install.ApplicationInstaller(io.BytesIO(sampleapp_tarball), scheme)
+    ai.copy_application()
+
+    ai = urlinstall.fetch_build(delta_build, scheme, connections=1)
+    with open(pjoin(ai.directory, 'run.sh')) as f:
+        assert f.read().endswith('echo upgraded\n')
+    testpath.assert_isfile(pjoin(ai.directory, 'new.txt'))
+    testpath.assert_isfile(pjoin(ai.directory, 'batis_info', 'batislib',
+                                 'install.py'))
+    assert os.access(pjoin(ai.directory, 'run.sh'), os.X_OK)
+    ai.copy_application()
+    installed = pjoin(scheme['application'], 'sampleapp')
+    hashes = tarball.load_file_hashes(installed)
+    assert 'new.txt' in hashes['files']
+    for name, info in hashes['files'].items():
+        assert tarball.hash_file(pjoin(installed, name)) == info['sha256']
+
+    # Only the changed files were downloaded
+    assert '/v2.app.tar.gz' not in http_server.paths
+    downloaded = 0
+    for path, r in zip(http_server.paths, http_server.ranges):
+        if path != '/v2.app.tar':
+            continue
+        start, end = re.match(r'bytes=(\d+)-(\d+)$', r).groups()
+        downloaded += int(end) + 1 - int(start)
+    assert downloaded < len(http_server.files['/v2.app.tar']) // 4
+
+def test_delta_not_installed(http_server, scheme, delta_build):
+    ai = urlinstall.fetch_build(delta_build, scheme)
+    testpath.assert_isfile(pjoin(ai.directory, 'new.txt'))
+    ai.discard_staging()
+    assert '/v2.app.tar' not in http_server.paths
+
+@pytest.mark.parametrize('order', ['file_first', 'symlink_first'])
+def test_delta_symlink_replaced(http_server, scheme, sampleapp_tarball,
+                                tmpdir, monkeypatch, order):
+    ai = install.ApplicationInstaller(io.BytesIO(sampleapp_tarball), scheme)
+    ai.copy_application()
+    outside = pjoin(str(tmpdir), 'outside')
+    run_sh = tarball.load_file_hashes(ai.directory)['files']['run.sh']
+    file = {'name': 'sampleapp/x', 'type': 'file', 'offset': 0,
+            'size': run_sh['size'], 'sha256': run_sh['sha256'],
+            'mode': 0o644, 'mtime': 0}
+    link = {'name': 'sampleapp/x', 'type': 'symlink', 'linkname': outside}
+    members = [{'name': 'sampleapp', 'type': 'dir', 'mode': 0o755,
+                'mtime': 0}]
+    members += [file, link] if order == 'file_first' else [link, file]
+    monkeypatch.setattr(delta, 'fetch_delta_manifest',
+                        lambda d, session: {'name': 'sampleapp',
+                                            'members': members})
+
+    with pytest.raises(ValueError):
+        delta.fetch_delta({'delta': {'url': http_server.url + '/none'}},
+                          scheme)
+    testpath.assert_not_path_exists(outside)
+    assert [d for d in os.listdir(scheme['application'])
+            if d.startswith('.')] == []
+
+def test_delta_aliased_symlink(http_server, scheme, sampleapp_tarball,
+                               tmpdir, monkeypatch):
+    ai = install.ApplicationInstaller(io.BytesIO(sampleapp_tarball), scheme)
+    ai.copy_application()
+    outside = str(tmpdir.mkdir('outside'))
+    run_sh = tarball.load_file_hashes(ai.directory)['files']['run.sh']
+    members = [
+        {'name': 'sampleapp', 'type': 'dir', 'mode': 0o755, 'mtime': 0},
+        {'name': 'sampleapp/d', 'type': 'symlink', 'linkname': outside},
+        # The same path as the symlink, spelled differently
+        {'name': 'sampleapp/./d/x', 'type': 'file', 'offset': 0,
+         'size': run_sh['size'], 'sha256': run_sh['sha256'],
+         'mode': 0o644, 'mtime': 0},
+    ]
+    monkeypatch.setattr(delta, 'fetch_delta_manifest',
+                        lambda d, session: {'name': 'sampleapp',
+                                            'members': members})
+
+    with pytest.raises(ValueError):
+        delta.fetch_delta({'delta': {'url': http_server.url + '/none'}},
+                          scheme)
+    assert os.listdir(outside) == []
+
+def test_delta_fallback(http_server, scheme, sampleapp_tarball, delta_build):
+    ai = install.ApplicationInstaller(io.BytesIO(sampleapp_tarball), scheme)
+    ai.copy_application()
+    # Changed files can't be fetched, so the whole build is downloaded
+    http_server.ranges_ok = False
+
+    ai = urlinstall.fetch_build(delta_build, scheme)
+    testpath.assert_isfile(pjoin(ai.directory, 'new.txt'))
+    ai.discard_staging()
+    assert '/v2.app.tar.gz' in http_server.paths
+    assert [d for d in os.listdir(scheme['application'])
+            if d.startswith('.')] == []
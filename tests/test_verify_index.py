@@ -60,3 +60,45 @@ def test_http_no_hash():
     iv = verify_index.IndexVerifier(None)
     iv.verify_build_json(SAMPLE_BUILD_HTTP_NO_HASH, problems)
     assert len(problems) == 1
+
+SAMPLE_BUILD_MIRRORS = {
+    "url": "https://example.com/downloads/myapp_0.1_linux_64bit.app.tar.gz",
+    "mirrors": [
+        "https://mirror.example.org/myapp_0.1_linux_64bit.app.tar.gz",
+        "http://mirror.example.net/myapp_0.1_linux_64bit.app.tar.gz",
+        "ftp://mirror.example.net/myapp_0.1_linux_64bit.app.tar.gz",
+    ],
+    "version": "0.1",
+}
+
+def test_mirrors():
+    problems = []
+    iv = verify_index.IndexVerifier(None)
+    iv.verify_build_json(SAMPLE_BUILD_MIRRORS, problems)
+    # http:// mirror without a hash, and an ftp:// mirror
+    assert len(problems) == 2
+
+    problems = []
+    iv.verify_build_json(dict(SAMPLE_BUILD_MIRRORS, mirrors='https://a.b/c'),
+                         problems)
+    assert len(problems) == 1
+
+def test_delta():
+    build = {
+        "url": "https://example.com/downloads/myapp_0.1_linux_64bit.app.tar.gz",
+        "version": "0.1",
+        "delta": {
+            "url": "https://example.com/downloads/myapp_0.1_linux_64bit.app.tar",
+            "manifest_url": "https://example.com/downloads/myapp_0.1_linux_64bit.app.files.json",
+        },
+    }
+    problems = []
+    iv = verify_index.IndexVerifier(None)
+    iv.verify_build_json(build, problems)
+    assert problems == []
+
+    build['delta']['manifest_url'] = 'http://example.com/myapp.app.files.json'
+    del build['delta']['url']
+    iv.verify_build_json(build, problems)
+    # No url, and an http manifest without a hash
+    assert len(problems) == 2
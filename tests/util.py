@@ -0,0 +1,50 @@
+"""Common setup for tests which install applications"""
+import os
+import testpath
+from testpath.tempdir import TemporaryDirectory
+from unittest import TestCase
+
+try:
+    from unittest import mock  # Python 3
+except ImportError:
+    import mock  # Python 2
+
+from batislib import install
+
+pjoin = os.path.join
+batis_root = os.path.dirname(os.path.dirname(__file__))
+
+class InstallTestCase(TestCase):
+    """Install applications for the user, in a temporary $XDG_DATA_HOME
+
+    Commands are installed in ``bin`` inside it. Unless mock_triggers is
+    False, the commands to update desktop caches aren't really run; the
+    mock is ``self.call``.
+    """
+    mock_triggers = True
+
+    def setUp(self):
+        td = TemporaryDirectory()
+        self.addCleanup(td.cleanup)
+        self.addCleanup(testpath.make_env_restorer())
+        self.td = os.environ['XDG_DATA_HOME'] = td.name
+        self.scheme = install.get_install_scheme('user')
+        self.scheme['commands'] = pjoin(self.td, 'bin')
+        if self.mock_triggers:
+            patcher = mock.patch('batislib.triggers.call', return_value=0)
+            self.call = patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def install_app(self, path, in_place=False, triggers=None, **kwargs):
+        """Install an application from a tarball or directory
+
+        Keyword arguments are passed to :class:`.ApplicationInstaller`.
+        System packages aren't installed, and the old version is deleted
+        before this returns.
+        """
+        ai = install.ApplicationInstaller(path, self.scheme, **kwargs)
+        ai.install_system_packages = lambda backend: None
+        ai.install(in_place=in_place, triggers=triggers)
+        if ai.cleanup_thread is not None:
+            ai.cleanup_thread.join()
+        return ai